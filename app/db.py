@@ -1,13 +1,79 @@
-"""Database initialization and connection helper for SQLite."""
+"""Database initialization, connection pool, write queue and helpers for SQLite.
+
+The database runs in WAL mode: reads borrow a pooled connection via
+:func:`acquire`, while every write goes through :func:`write`, which hands
+the operation to a single writer task. The writer group-commits everything
+queued within a few milliseconds in one transaction, so the reminder tick
+and user taps never fight over SQLite's write lock.
+"""
 
 from __future__ import annotations
 
+import asyncio
+import logging
 import os
+import time
+from collections.abc import AsyncIterator, Awaitable, Callable
+from contextlib import AbstractAsyncContextManager, asynccontextmanager
+from enum import IntEnum
+from typing import Any, TypeVar
 
 import aiosqlite
 
+from app.migrations import run_migrations
+from app.timeutils import local_to_epoch, user_jitter
+
+logger = logging.getLogger(__name__)
+
 DB_PATH = os.getenv("DB_PATH", "pill_bot.db")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "4"))
+DB_WRITE_BATCH_MS = float(os.getenv("DB_WRITE_BATCH_MS", "5"))
+DB_BUSY_TIMEOUT_MS = 5000
+
+T = TypeVar("T")
+WriteOp = Callable[[aiosqlite.Connection], Awaitable[T]]
+
+
+class DoseStatus(IntEnum):
+    """Compact integer encoding of ``doses.status``."""
+
+    SCHEDULED = 0
+    TAKEN = 1
+    MISSED = 2
+    SKIPPED = 3
+    UNANSWERED = 4  # reminder cap reached without a reply
+
+    @property
+    def label(self) -> str:
+        """String form used by handlers and keyboards (e.g. ``"taken"``)."""
+        return self.name.lower()
+
+
+class OutboxState(IntEnum):
+    """Lifecycle of an ``outbox`` row (see app/services/outbox_service.py)."""
+
+    PENDING = 0
+    SENDING = 1
+    SENT = 2
+    FAILED = 3
+    CANCELLED = 4
+    UNKNOWN = 5
 
+
+class ReminderPriority(IntEnum):
+    """Dispatch order of ``outbox`` rows: lower values are sent first."""
+
+    FIRST = 0
+    REPEAT = 1
+    SNOOZE = 2
+
+    @property
+    def label(self) -> str:
+        return self.name.lower()
+
+
+# Baseline (version 0) schema. Every later change lives in app/migrations.py,
+# so existing databases and fresh ones converge on the same structure.
 SCHEMA = """
 CREATE TABLE IF NOT EXISTS users (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -57,42 +123,352 @@ CREATE TABLE IF NOT EXISTS user_settings (
 """
 
 
-async def init_db(db_path: str = DB_PATH) -> None:
-    """Create tables if they don't exist."""
-    async with aiosqlite.connect(db_path) as db:
-        await db.executescript(SCHEMA)
-        
-        # Миграция: добавляем last_message_id, если его нет
+async def _prepare_connection(db: aiosqlite.Connection) -> None:
+    """Per-connection setup shared by pooled readers and the writer.
+
+    Registers ``local_to_epoch(local_str, tz_name)`` and
+    ``user_jitter(user_id, window)`` so set-based statements can convert
+    wall-clock times to UTC instants in SQL.
+    """
+    db.row_factory = aiosqlite.Row
+    await db.execute("PRAGMA foreign_keys = ON")
+    await db.execute(f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}")
+    await db.create_function("local_to_epoch", 2, local_to_epoch, deterministic=True)
+    await db.create_function("user_jitter", 2, user_jitter, deterministic=True)
+
+
+class ConnectionPool:
+    """Bounded pool of long-lived aiosqlite connections.
+
+    Each connection owns a worker thread, so opening one per query is costly.
+    The pool keeps up to ``size`` connections open, hands them out through
+    :meth:`acquire` and pings connections that sat idle for longer than
+    ``health_check_after`` seconds before reusing them.
+    """
+
+    def __init__(
+        self,
+        db_path: str,
+        size: int = DB_POOL_SIZE,
+        health_check_after: float = 30.0,
+    ) -> None:
+        if size < 1:
+            raise ValueError("Pool size must be at least 1")
+        self.db_path = db_path
+        self.size = size
+        self.health_check_after = health_check_after
+        self._semaphore = asyncio.Semaphore(size)
+        # (connection, last release time) — used as a stack so hot connections are reused first
+        self._idle: list[tuple[aiosqlite.Connection, float]] = []
+        self._closed = False
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    async def _connect(self) -> aiosqlite.Connection:
+        db = await aiosqlite.connect(self.db_path)
+        await _prepare_connection(db)
+        return db
+
+    async def _is_healthy(self, db: aiosqlite.Connection) -> bool:
+        try:
+            await db.execute("SELECT 1")
+            return True
+        except Exception:
+            return False
+
+    async def _checkout(self) -> aiosqlite.Connection:
+        while self._idle:
+            db, released_at = self._idle.pop()
+            if time.monotonic() - released_at < self.health_check_after:
+                return db
+            if await self._is_healthy(db):
+                return db
+            logger.warning("Dropping unhealthy connection to %s", self.db_path)
+            await self._discard(db)
+        return await self._connect()
+
+    async def _discard(self, db: aiosqlite.Connection) -> None:
         try:
-            await db.execute("ALTER TABLE users ADD COLUMN last_message_id INTEGER")
-        except aiosqlite.OperationalError:
-            # Колонка уже существует
-            pass
-            
-        # Миграция: добавляем message_id в doses, если его нет
+            await db.close()
+        except Exception:
+            logger.debug("Error closing connection", exc_info=True)
+
+    @asynccontextmanager
+    async def acquire(self) -> AsyncIterator[aiosqlite.Connection]:
+        """Borrow a connection; it is returned to the pool on exit.
+
+        A transaction left open by the caller (e.g. after an exception)
+        is rolled back before the connection is reused.
+        """
+        if self._closed:
+            raise RuntimeError("Connection pool is closed")
+        async with self._semaphore:
+            db = await self._checkout()
+            reusable = True
+            try:
+                yield db
+            finally:
+                if db.in_transaction:
+                    try:
+                        await db.rollback()
+                    except Exception:
+                        reusable = False
+                if reusable and not self._closed:
+                    self._idle.append((db, time.monotonic()))
+                else:
+                    await self._discard(db)
+
+    async def close(self) -> None:
+        """Close all idle connections; busy ones are closed on release."""
+        self._closed = True
+        idle, self._idle = self._idle, []
+        for db, _ in idle:
+            await self._discard(db)
+
+
+class WriteQueue:
+    """Single writer task that group-commits queued write operations.
+
+    A write operation is an async callable receiving the writer connection.
+    Operations queued within ``batch_window`` seconds of the first one (up to
+    ``max_batch``) share one ``BEGIN IMMEDIATE … COMMIT``. Each runs inside
+    its own savepoint, so a failing operation is rolled back and reported to
+    its caller without affecting the rest of the batch. Results are
+    delivered only after the batch has committed.
+
+    Operations must not call ``commit()``/``rollback()`` or ``executescript``.
+    """
+
+    def __init__(
+        self,
+        db_path: str,
+        batch_window: float = DB_WRITE_BATCH_MS / 1000,
+        max_batch: int = 200,
+    ) -> None:
+        self.db_path = db_path
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self._queue: asyncio.Queue[tuple[WriteOp[Any], asyncio.Future[Any]] | None] = (
+            asyncio.Queue()
+        )
+        self._db: aiosqlite.Connection | None = None
+        self._task: asyncio.Task[None] | None = None
+        self._start_lock = asyncio.Lock()
+        self._closed = False
+        # Counters for logging/diagnostics
+        self.batches_committed = 0
+        self.operations_committed = 0
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    async def _start(self) -> None:
+        async with self._start_lock:
+            if self._task is not None:
+                return
+            db = await aiosqlite.connect(self.db_path, isolation_level=None)
+            await db.execute("PRAGMA journal_mode = WAL")
+            await db.execute("PRAGMA synchronous = NORMAL")
+            await _prepare_connection(db)
+            self._db = db
+            self._task = asyncio.create_task(self._run(), name="db-writer")
+
+    async def submit(self, op: WriteOp[T]) -> T:
+        """Queue ``op`` and wait for the result of its committed batch."""
+        if self._closed:
+            raise RuntimeError("Write queue is closed")
+        if self._task is None:
+            await self._start()
+        future: asyncio.Future[T] = asyncio.get_running_loop().create_future()
+        await self._queue.put((op, future))
+        return await future
+
+    async def _collect(self) -> tuple[list[tuple[WriteOp[Any], asyncio.Future[Any]]], bool]:
+        """Wait for one operation, then gather more for ``batch_window``."""
+        first = await self._queue.get()
+        if first is None:
+            return [], True
+        batch = [first]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.batch_window
+        while len(batch) < self.max_batch:
+            timeout = deadline - loop.time()
+            try:
+                item = (
+                    self._queue.get_nowait()
+                    if timeout <= 0
+                    else await asyncio.wait_for(self._queue.get(), timeout)
+                )
+            except (asyncio.QueueEmpty, TimeoutError):
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    async def _run(self) -> None:
+        stop = False
+        while not stop:
+            batch, stop = await self._collect()
+            if batch:
+                await self._apply(batch)
+
+    async def _apply(self, batch: list[tuple[WriteOp[Any], asyncio.Future[Any]]]) -> None:
+        db = self._db
+        assert db is not None
+        outcomes: list[tuple[asyncio.Future[Any], Any, BaseException | None]] = []
         try:
-            await db.execute("ALTER TABLE doses ADD COLUMN message_id INTEGER")
-        except aiosqlite.OperationalError:
-            # Колонка уже существует
-            pass
-            
-        await db.commit()
+            await db.execute("BEGIN IMMEDIATE")
+            for op, future in batch:
+                if future.cancelled():
+                    continue
+                await db.execute("SAVEPOINT write_op")
+                try:
+                    result = await op(db)
+                except Exception as e:
+                    await db.execute("ROLLBACK TO write_op")
+                    await db.execute("RELEASE write_op")
+                    outcomes.append((future, None, e))
+                else:
+                    await db.execute("RELEASE write_op")
+                    outcomes.append((future, result, None))
+            await db.execute("COMMIT")
+            self.batches_committed += 1
+            self.operations_committed += len(outcomes)
+        except Exception as e:
+            logger.exception("Write batch of %d operation(s) failed", len(batch))
+            if db.in_transaction:
+                await db.execute("ROLLBACK")
+            outcomes = [(future, None, e) for _, future in batch]
+
+        for future, result, error in outcomes:
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    async def close(self) -> None:
+        """Finish queued operations, stop the writer task and close its connection."""
+        if self._closed:
+            return
+        self._closed = True
+        if self._task is not None:
+            await self._queue.put(None)
+            await self._task
+        if self._db is not None:
+            await self._db.close()
+            self._db = None
+
+
+_db_path = DB_PATH
+_pool: ConnectionPool | None = None
+_writer: WriteQueue | None = None
+# Set by close_db(): no new pool or writer until configure_db() is called
+_db_closed = False
+
+
+def _check_open() -> None:
+    if _db_closed:
+        raise RuntimeError("Database is closed")
+
+
+def get_pool() -> ConnectionPool:
+    """Return the process-wide read pool, creating it on first use.
+
+    Raises RuntimeError after :func:`close_db`.
+    """
+    global _pool
+    _check_open()
+    if _pool is None or _pool.closed:
+        _pool = ConnectionPool(_db_path)
+    return _pool
+
+
+def get_writer() -> WriteQueue:
+    """Return the process-wide write queue, creating it on first use.
+
+    Raises RuntimeError after :func:`close_db`.
+    """
+    global _writer
+    _check_open()
+    if _writer is None or _writer.closed:
+        _writer = WriteQueue(_db_path)
+    return _writer
+
+
+def configure_db(db_path: str = DB_PATH) -> None:
+    """Point the pool and the writer at ``db_path`` (e.g. a temp DB in tests).
+
+    The previous pool and writer should be closed with :func:`close_db` first;
+    this also reopens the database after it.
+    """
+    global _db_path, _pool, _writer, _db_closed
+    _db_path = db_path
+    _db_closed = False
+    _pool = None
+    _writer = None
+
+
+async def close_db() -> None:
+    """Flush the write queue and close all connections. Call on shutdown.
+
+    Later reads and writes (e.g. a job still running) raise instead of
+    opening new connections that would never be closed.
+    """
+    global _pool, _writer, _db_closed
+    _db_closed = True
+    if _writer is not None:
+        await _writer.close()
+        _writer = None
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+
+
+def acquire() -> AbstractAsyncContextManager[aiosqlite.Connection]:
+    """Borrow a pooled read connection: ``async with acquire() as db: ...``."""
+    return get_pool().acquire()
+
+
+async def write(op: WriteOp[T]) -> T:
+    """Run ``op(db)`` on the single writer connection and return its result.
+
+    ``op`` is batched with other queued writes into one transaction; the
+    returned awaitable resolves once that transaction has committed.
+    """
+    return await get_writer().submit(op)
+
+
+async def init_db(db_path: str | None = None) -> None:
+    """Create tables if they don't exist and apply pending migrations."""
+    async with aiosqlite.connect(db_path or _db_path, isolation_level=None) as db:
+        await db.execute("PRAGMA journal_mode = WAL")
+        await db.executescript(SCHEMA)
+        applied = await run_migrations(db)
+        if applied:
+            logger.info("Applied %d schema migration(s)", applied)
 
 
-async def get_db(db_path: str = DB_PATH) -> aiosqlite.Connection:
-    """Open a database connection.
+async def get_db(db_path: str | None = None) -> aiosqlite.Connection:
+    """Open a standalone (non-pooled) database connection.
 
     Caller is responsible for closing it (or use as async context manager).
+    Services should prefer :func:`acquire` and :func:`write`.
     """
-    db = await aiosqlite.connect(db_path)
+    db = await aiosqlite.connect(db_path or _db_path)
     db.row_factory = aiosqlite.Row
     await db.execute("PRAGMA foreign_keys = ON")
     return db
 
 
-async def get_last_message_id(telegram_id: int, db_path: str = DB_PATH) -> int | None:
+async def get_last_message_id(telegram_id: int) -> int | None:
     """Get the ID of the last message sent to the user by the bot."""
-    async with aiosqlite.connect(db_path) as db:
+    async with acquire() as db:
         async with db.execute(
             "SELECT last_message_id FROM users WHERE telegram_id = ?", (telegram_id,)
         ) as cursor:
@@ -102,12 +478,41 @@ async def get_last_message_id(telegram_id: int, db_path: str = DB_PATH) -> int |
             return None
 
 
-async def set_last_message_id(telegram_id: int, message_id: int, db_path: str = DB_PATH) -> None:
+async def set_last_message_id(telegram_id: int, message_id: int) -> None:
     """Save the ID of the last message sent to the user by the bot."""
-    async with aiosqlite.connect(db_path) as db:
-        await db.execute(
+    await set_last_message_ids([(telegram_id, message_id)])
+
+
+async def set_last_message_ids(items: list[tuple[int, int]]) -> None:
+    """Save many ``(telegram_id, message_id)`` pairs in one transaction."""
+
+    async def op(db: aiosqlite.Connection) -> None:
+        await db.executemany(
             "UPDATE users SET last_message_id = ? WHERE telegram_id = ?",
-            (message_id, telegram_id),
+            [(message_id, telegram_id) for telegram_id, message_id in items],
+        )
+
+    await write(op)
+
+
+async def get_state(key: str) -> str | None:
+    """Read a value from the ``app_state`` key/value table."""
+    async with acquire() as db:
+        cursor = await db.execute("SELECT value FROM app_state WHERE key = ?", (key,))
+        row = await cursor.fetchone()
+        return row[0] if row else None
+
+
+async def set_state(key: str, value: str) -> None:
+    """Write a value to the ``app_state`` key/value table."""
+
+    async def op(db: aiosqlite.Connection) -> None:
+        await db.execute(
+            """
+            INSERT INTO app_state (key, value) VALUES (?, ?)
+            ON CONFLICT (key) DO UPDATE SET value = excluded.value
+            """,
+            (key, value),
         )
-        await db.commit()
 
+    await write(op)
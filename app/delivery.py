@@ -0,0 +1,254 @@
+"""Concurrent, rate-limited message delivery for reminder fan-out.
+
+Telegram allows roughly 30 messages per second per bot, one message per
+second per private chat and 20 messages per minute per group. The
+:class:`RateLimiter` models each limit as a token bucket; the
+:class:`DeliveryEngine` runs send jobs with bounded concurrency through it,
+honours ``TelegramRetryAfter`` and reports per-run throughput.
+
+Peak minutes (everyone's 08:00) are smoothed by a :class:`SlotPacer`, which
+releases a backlog in one-second slots at a target rate below the hard
+limits, leaving headroom for interactive replies.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import math
+import os
+import time
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass, field
+from typing import Any
+
+from aiogram.exceptions import TelegramRetryAfter
+
+logger = logging.getLogger(__name__)
+
+GLOBAL_RATE = 30.0  # messages per second across all chats
+PRIVATE_CHAT_RATE = 1.0  # messages per second per private chat
+GROUP_CHAT_RATE = 20 / 60  # messages per second per group (chat_id < 0)
+DELIVERY_CONCURRENCY = 16
+DELIVERY_MAX_ATTEMPTS = 3
+
+# Peak smoothing: target send rate, and the window a backlog should drain in
+DISPATCH_RATE = float(os.getenv("REMINDER_DISPATCH_RATE", "20"))  # messages per second
+DISPATCH_WINDOW = float(os.getenv("REMINDER_DISPATCH_WINDOW", "60"))  # seconds
+DISPATCH_SLOT = 1.0  # seconds
+
+
+class TokenBucket:
+    """Token bucket that hands out reservations instead of polling.
+
+    :meth:`reserve` always takes a token (the balance may go negative) and
+    returns how long the caller must wait for it, so concurrent callers are
+    queued fairly without busy loops.
+    """
+
+    def __init__(self, rate: float, capacity: float = 1.0) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    @property
+    def idle(self) -> bool:
+        """True if the bucket is full and not blocked (safe to forget)."""
+        now = time.monotonic()
+        self._refill(now)
+        return self._tokens >= self.capacity and now >= self._blocked_until
+
+    def reserve(self) -> float:
+        """Take a token and return the delay (seconds) before it may be used."""
+        now = time.monotonic()
+        self._refill(now)
+        self._tokens -= 1
+        wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        return max(wait, self._blocked_until - now)
+
+    def block(self, seconds: float) -> None:
+        """Hold all reservations for ``seconds`` (e.g. after a RetryAfter)."""
+        self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+
+    async def acquire(self) -> None:
+        delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class RateLimiter:
+    """Global plus per-chat token buckets following Telegram's limits."""
+
+    def __init__(
+        self,
+        global_rate: float = GLOBAL_RATE,
+        private_rate: float = PRIVATE_CHAT_RATE,
+        group_rate: float = GROUP_CHAT_RATE,
+        max_chats: int = 10_000,
+    ) -> None:
+        self.global_bucket = TokenBucket(global_rate, capacity=global_rate)
+        self.private_rate = private_rate
+        self.group_rate = group_rate
+        self.max_chats = max_chats
+        self._chats: dict[int, TokenBucket] = {}
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= self.max_chats:
+                self._chats = {cid: b for cid, b in self._chats.items() if not b.idle}
+            rate = self.group_rate if chat_id < 0 else self.private_rate
+            bucket = self._chats[chat_id] = TokenBucket(rate)
+        return bucket
+
+    async def acquire(self, chat_id: int) -> None:
+        # Per-chat first, so a busy chat doesn't hold global capacity while it waits
+        await self._chat_bucket(chat_id).acquire()
+        await self.global_bucket.acquire()
+
+    def retry_after(self, chat_id: int, seconds: float) -> None:
+        """Apply a flood-control hint to the chat and to the whole bot."""
+        self._chat_bucket(chat_id).block(seconds)
+        self.global_bucket.block(seconds)
+
+
+class SlotPacer:
+    """Releases a backlog in fixed time slots at a target rate.
+
+    Each slot admits :meth:`capacity` messages: the target rate, raised when
+    the backlog could not drain within ``window`` at that rate, but never
+    above ``max_rate``. Whatever does not fit waits for the next slot.
+    """
+
+    def __init__(
+        self,
+        rate: float = DISPATCH_RATE,
+        window: float = DISPATCH_WINDOW,
+        slot: float = DISPATCH_SLOT,
+        max_rate: float = GLOBAL_RATE,
+    ) -> None:
+        self.rate = rate
+        self.window = window
+        self.slot = slot
+        self.max_rate = max_rate
+        self._slot_started = time.monotonic()
+
+    def capacity(self, depth: int) -> int:
+        """Messages to release in the current slot for a backlog of ``depth``."""
+        rate = min(max(self.rate, depth / self.window), self.max_rate)
+        return max(math.ceil(rate * self.slot), 1)
+
+    def start_slot(self) -> None:
+        self._slot_started = time.monotonic()
+
+    async def next_slot(self) -> None:
+        """Sleep until the current slot is over, then start the next one."""
+        remaining = self._slot_started + self.slot - time.monotonic()
+        if remaining > 0:
+            await asyncio.sleep(remaining)
+        self.start_slot()
+
+
+@dataclass
+class DeliveryJob:
+    """One message to deliver. ``send`` performs the API call(s)."""
+
+    chat_id: int
+    send: Callable[[], Awaitable[Any]]
+    key: Any = None
+    attempts: int = 0
+
+
+@dataclass
+class DeliveryResult:
+    job: DeliveryJob
+    result: Any = None
+    error: BaseException | None = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+@dataclass
+class DeliveryStats:
+    """Counters for one :meth:`DeliveryEngine.deliver` run."""
+
+    queued: int = 0
+    sent: int = 0
+    failed: int = 0
+    retried: int = 0
+    elapsed: float = 0.0
+    max_queue_depth: int = 0
+    results: list[DeliveryResult] = field(default_factory=list, repr=False)
+
+    @property
+    def throughput(self) -> float:
+        """Messages sent per second."""
+        return self.sent / self.elapsed if self.elapsed > 0 else float(self.sent)
+
+
+class DeliveryEngine:
+    """Runs delivery jobs with bounded concurrency through a :class:`RateLimiter`."""
+
+    def __init__(
+        self,
+        limiter: RateLimiter | None = None,
+        concurrency: int = DELIVERY_CONCURRENCY,
+        max_attempts: int = DELIVERY_MAX_ATTEMPTS,
+    ) -> None:
+        self.limiter = limiter or RateLimiter()
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+
+    async def deliver(self, jobs: list[DeliveryJob]) -> DeliveryStats:
+        """Send all jobs; never raises for individual job failures."""
+        stats = DeliveryStats(queued=len(jobs), max_queue_depth=len(jobs))
+        if not jobs:
+            return stats
+
+        queue: asyncio.Queue[DeliveryJob] = asyncio.Queue()
+        for job in jobs:
+            queue.put_nowait(job)
+        started = time.monotonic()
+
+        async def worker() -> None:
+            while True:
+                try:
+                    job = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                await self.limiter.acquire(job.chat_id)
+                job.attempts += 1
+                try:
+                    result = await job.send()
+                except TelegramRetryAfter as e:
+                    self.limiter.retry_after(job.chat_id, e.retry_after)
+                    if job.attempts < self.max_attempts:
+                        logger.warning(
+                            "Flood control for chat %s, retrying in %ss", job.chat_id, e.retry_after
+                        )
+                        stats.retried += 1
+                        queue.put_nowait(job)
+                        stats.max_queue_depth = max(stats.max_queue_depth, queue.qsize())
+                        continue
+                    stats.failed += 1
+                    stats.results.append(DeliveryResult(job, error=e))
+                except Exception as e:
+                    logger.warning("Delivery to chat %s failed: %s", job.chat_id, e)
+                    stats.failed += 1
+                    stats.results.append(DeliveryResult(job, error=e))
+                else:
+                    stats.sent += 1
+                    stats.results.append(DeliveryResult(job, result=result))
+
+        workers = min(self.concurrency, len(jobs))
+        await asyncio.gather(*(worker() for _ in range(workers)))
+        stats.elapsed = time.monotonic() - started
+        return stats
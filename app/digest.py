@@ -0,0 +1,44 @@
+"""Digest reminders: one message per chat for the doses due in the same tick.
+
+A user who takes four pills at 08:00 gets a single reminder listing them,
+with a button row per dose and "✅ Принял всё". The message id is stored on
+every dose it covers, so the handlers can re-render the digest in place
+when one of them is taken, skipped or snoozed.
+"""
+
+from __future__ import annotations
+
+import os
+
+# Set REMINDER_DIGEST=0 to send one message per dose
+DIGEST_MODE = os.getenv("REMINDER_DIGEST", "1") != "0"
+
+
+def _time_of(dose: dict) -> str:
+    dt = dose["scheduled_datetime"]
+    return dt.split(" ")[1][:5] if " " in dt else dt
+
+
+def _digest_line(dose: dict) -> str:
+    name = dose["medicine_name"]
+    dosage = f" ({dose['dosage']})" if dose.get("dosage") else ""
+    status = dose.get("status", "scheduled")
+    if status == "taken":
+        taken_at = dose.get("taken_at") or ""
+        taken_time = taken_at.split(" ")[1] if " " in taken_at else taken_at
+        return f"✅ {name} — принято в {taken_time}"
+    if status == "skipped":
+        return f"❌ {name} — не сегодня"
+    if status == "missed":
+        return f"❌ {name} — пропущено"
+    if status == "unanswered":
+        return f"❔ {name} — без ответа"
+    return f"💊 {name}{dosage} — {_time_of(dose)}"
+
+
+def digest_text(doses: list[dict]) -> str:
+    """Text of a digest reminder; answered doses are shown with their outcome."""
+    pending = sum(1 for d in doses if d.get("status", "scheduled") == "scheduled")
+    title = f"💊 Время принять ({pending}):" if pending else "👍 Все приёмы отмечены."
+    lines = "\n".join(_digest_line(d) for d in doses)
+    return f"{title}\n\n{lines}" if lines else title
@@ -0,0 +1,163 @@
+"""In-memory queue of upcoming reminder instants and the engine that drains it.
+
+Instead of polling the ``doses`` table every minute, the reminder engine keeps
+a min-heap of ``(next_reminder_at, dose_id)`` pairs and sleeps until the
+earliest one. Services keep the heap in sync as doses are generated,
+snoozed, taken, skipped or reset; a periodic reload from the DB acts as a
+safety net for anything that slipped through.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import heapq
+import logging
+import time
+from collections.abc import Awaitable, Callable, Iterable
+
+logger = logging.getLogger(__name__)
+
+
+class DueQueue:
+    """Min-heap of reminder deadlines (UTC epoch seconds) keyed by dose id.
+
+    Updates are lazy: rescheduling or discarding a dose only touches the
+    ``dose_id → deadline`` map, and stale heap entries are skipped on read.
+    """
+
+    def __init__(self) -> None:
+        self._heap: list[tuple[int, int]] = []
+        self._deadlines: dict[int, int] = {}
+        self._changed = asyncio.Event()
+        self._reload_requested = False
+
+    def __len__(self) -> int:
+        return len(self._deadlines)
+
+    def schedule(self, dose_id: int, at: int) -> None:
+        """Set (or move) the reminder deadline for a dose."""
+        if self._deadlines.get(dose_id) == at:
+            return
+        earliest = self.peek()
+        self._deadlines[dose_id] = at
+        heapq.heappush(self._heap, (at, dose_id))
+        if earliest is None or at < earliest:
+            self._changed.set()
+
+    def discard(self, dose_id: int) -> None:
+        """Forget a dose (taken, skipped, deleted…)."""
+        self._deadlines.pop(dose_id, None)
+
+    def replace_all(self, items: Iterable[tuple[int, int]]) -> None:
+        """Replace the contents with ``(dose_id, at)`` pairs loaded from the DB."""
+        self._deadlines = dict(items)
+        self._heap = [(at, dose_id) for dose_id, at in self._deadlines.items()]
+        heapq.heapify(self._heap)
+        self._changed.set()
+
+    def request_reload(self) -> None:
+        """Ask the engine to reload from the DB (e.g. after bulk generation)."""
+        self._reload_requested = True
+        self._changed.set()
+
+    def take_reload_request(self) -> bool:
+        requested, self._reload_requested = self._reload_requested, False
+        return requested
+
+    def peek(self) -> int | None:
+        """Earliest live deadline, or None if the queue is empty."""
+        while self._heap:
+            at, dose_id = self._heap[0]
+            if self._deadlines.get(dose_id) == at:
+                return at
+            heapq.heappop(self._heap)
+        return None
+
+    def pop_due(self, now: float) -> list[int]:
+        """Remove and return ids of doses whose deadline is ``<= now``."""
+        due: list[int] = []
+        while (at := self.peek()) is not None and at <= now:
+            _, dose_id = heapq.heappop(self._heap)
+            del self._deadlines[dose_id]
+            due.append(dose_id)
+        return due
+
+    async def wait(self, timeout: float | None) -> None:
+        """Sleep until ``timeout`` elapses or the earliest deadline changes."""
+        self._changed.clear()
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+        except TimeoutError:
+            pass
+
+
+due_queue = DueQueue()
+
+
+class ReminderEngine:
+    """Sleeps until the earliest deadline in a :class:`DueQueue`, then fires.
+
+    ``on_due`` receives the ids that became due and the earliest of their
+    deadlines (to measure how late it fired) and is expected to query, send
+    and reschedule them. ``reload`` returns ``(dose_id, at)`` pairs for
+    all pending reminders up to the given epoch; it runs at startup, on
+    request and every ``reload_interval`` seconds.
+    """
+
+    def __init__(
+        self,
+        queue: DueQueue,
+        on_due: Callable[[list[int], int], Awaitable[None]],
+        reload: Callable[[int], Awaitable[Iterable[tuple[int, int]]]],
+        reload_interval: float = 300.0,
+    ) -> None:
+        self.queue = queue
+        self.on_due = on_due
+        self.reload = reload
+        self.reload_interval = reload_interval
+        self._task: asyncio.Task[None] | None = None
+        self._next_reload = 0.0
+
+    async def _reload(self) -> None:
+        # Load one interval past the next reload so nothing falls between two loads
+        horizon = int(time.time() + 2 * self.reload_interval)
+        items = list(await self.reload(horizon))
+        self.queue.replace_all(items)
+        self._next_reload = time.monotonic() + self.reload_interval
+        logger.debug("Reminder queue reloaded: %d pending", len(items))
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                if self.queue.take_reload_request() or time.monotonic() >= self._next_reload:
+                    await self._reload()
+
+                deadline = self.queue.peek()
+                due = self.queue.pop_due(time.time())
+                if due:
+                    await self.on_due(due, deadline)
+                    continue
+
+                earliest = self.queue.peek()
+                timeout = self._next_reload - time.monotonic()
+                if earliest is not None:
+                    timeout = min(timeout, earliest - time.time())
+                await self.queue.wait(max(timeout, 0))
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Reminder engine iteration failed")
+                await asyncio.sleep(1)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name="reminder-engine")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
@@ -3,24 +3,22 @@
 from __future__ import annotations
 
 import re
-from datetime import datetime
 
-import pytz
 from aiogram import Router
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import Message
 
-from app.config import settings
 from app.keyboards import main_menu_kb
-from app.services.dose_service import generate_daily_doses
 from app.services.medicine_service import add_medicine
 from app.services.message_service import send_single_message
+from app.services.settings_service import get_user_timezone
+from app.timeutils import DATE_FMT, now_local
 
 router = Router()
 
-TIME_RE = re.compile(r"^([01]\d|2[0-3]):([0-5]\d)$")
+TIME_RE = re.compile(r"^([01]\d|2[0-3]):([0-5]\d)(:[0-5]\d)?$")
 
 
 class AddMedicine(StatesGroup):
@@ -149,18 +147,16 @@ async def process_times(message: Message, state: FSMContext) -> None:
     if not message.from_user:
         return
 
+    # Generate this medicine's doses for today in the same transaction so /today works right away
+    today = now_local(await get_user_timezone(message.from_user.id), DATE_FMT)
     await add_medicine(
         telegram_id=message.from_user.id,
         name=data["name"],
         dosage=data["dosage"],
         times=valid_times,
+        generate_for=today,
     )
 
-    # Generate doses for today immediately so /today works right away
-    tz = pytz.timezone(settings.timezone)
-    today = datetime.now(tz).strftime("%Y-%m-%d")
-    await generate_daily_doses(today)
-
     times_str = ", ".join(valid_times)
     await state.clear()
     if message.bot:
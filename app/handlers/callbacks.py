@@ -2,18 +2,28 @@
 
 from __future__ import annotations
 
-from datetime import datetime
+import logging
+import time
 
-import pytz
-from aiogram import F, Router
+from aiogram import Bot, F, Router
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import CallbackQuery, Message
 
-from app.config import settings
-from app.keyboards import main_menu_kb, schedule_menu_kb, history_kb
-from app.services.dose_service import mark_taken, snooze
+from app.digest import digest_text
+from app.keyboards import digest_kb, main_menu_kb, schedule_menu_kb, history_kb
+from app.services.dose_service import (
+    get_message_doses,
+    mark_taken,
+    snooze,
+    take_pending_doses,
+)
 from app.services.message_service import send_single_message
+from app.services.settings_service import get_user_timezone
+from app.timeutils import now_local
+
+logger = logging.getLogger(__name__)
 
 router = Router()
 
@@ -66,7 +76,7 @@ async def on_reply_schedule(message: Message) -> None:
 @router.message(F.text == "📋 Сегодня")
 async def on_reply_today(message: Message) -> None:
     """Handle reply keyboard '📋 Сегодня' button."""
-    from app.handlers.today import _format_today
+    from app.handlers.today import render_today
 
     if not message.from_user:
         return
@@ -76,10 +86,8 @@ async def on_reply_today(message: Message) -> None:
     except Exception:
         pass
 
-    text, doses = await _format_today(message.from_user.id)
+    text, reply_markup = await render_today(message.from_user.id)
     if message.bot:
-        from app.keyboards import today_kb, back_to_main_kb
-        reply_markup = today_kb(doses) if doses else back_to_main_kb()
         await send_single_message(
             bot=message.bot,
             chat_id=message.chat.id,
@@ -103,13 +111,15 @@ async def on_reply_settings(message: Message, state: FSMContext) -> None:
         pass
 
     current = await get_settings_by_telegram_id(message.from_user.id)
-    from app.keyboards import back_to_main_kb
+    from app.keyboards import settings_kb
     if message.bot:
         await send_single_message(
             bot=message.bot,
             chat_id=message.chat.id,
-            text=_settings_text(current["reminder_interval_minutes"]),
-            reply_markup=back_to_main_kb()
+            text=_settings_text(
+                current["reminder_interval_minutes"], current["timezone"], current["max_reminders"]
+            ),
+            reply_markup=settings_kb()
         )
     await state.set_state(EditSettings.interval)
 
@@ -227,16 +237,14 @@ async def on_menu_schedule(callback: CallbackQuery) -> None:
 @router.callback_query(F.data == "menu:today")
 async def on_menu_today(callback: CallbackQuery) -> None:
     """Handle inline '📋 Сегодня' button."""
-    from app.handlers.today import _format_today
+    from app.handlers.today import render_today
 
     if not callback.from_user:
         return
 
     await callback.answer()
-    text, doses = await _format_today(callback.from_user.id)
+    text, reply_markup = await render_today(callback.from_user.id)
     if callback.message and callback.message.bot:
-        from app.keyboards import today_kb, back_to_main_kb
-        reply_markup = today_kb(doses) if doses else back_to_main_kb()
         await send_single_message(
             bot=callback.message.bot,
             chat_id=callback.message.chat.id,
@@ -282,13 +290,15 @@ async def on_menu_settings(callback: CallbackQuery, state: FSMContext) -> None:
 
     await callback.answer()
     current = await get_settings_by_telegram_id(callback.from_user.id)
-    from app.keyboards import back_to_main_kb
+    from app.keyboards import settings_kb
     if callback.message and callback.message.bot:
         await send_single_message(
             bot=callback.message.bot,
             chat_id=callback.message.chat.id,
-            text=_settings_text(current["reminder_interval_minutes"]),
-            reply_markup=back_to_main_kb()
+            text=_settings_text(
+                current["reminder_interval_minutes"], current["timezone"], current["max_reminders"]
+            ),
+            reply_markup=settings_kb()
         )
     await state.set_state(EditSettings.interval)
 
@@ -296,6 +306,25 @@ async def on_menu_settings(callback: CallbackQuery, state: FSMContext) -> None:
 # ── Dose action callbacks ──────────────────────────────────────────
 
 
+def _from_digest(data: str) -> bool:
+    """Whether a dose button was pressed on a digest (see ``digest_kb``)."""
+    return data.endswith(":digest")
+
+
+async def _refresh_digest(bot: Bot, chat_id: int, telegram_id: int, message_id: int) -> None:
+    """Re-render a digest reminder in place from its doses' current state."""
+    doses = await get_message_doses(telegram_id, message_id)
+    try:
+        await bot.edit_message_text(
+            digest_text(doses),
+            chat_id=chat_id,
+            message_id=message_id,
+            reply_markup=digest_kb(doses),
+        )
+    except TelegramBadRequest as e:
+        logger.debug("Could not update digest %s: %s", message_id, e)
+
+
 @router.callback_query(F.data.startswith("dose_taken:"))
 async def on_dose_taken(callback: CallbackQuery) -> None:
     """Handle the 'Taken' button press."""
@@ -303,19 +332,60 @@ async def on_dose_taken(callback: CallbackQuery) -> None:
         return
 
     dose_id = int(callback.data.split(":")[1])
-    tz = pytz.timezone(settings.timezone)
-    now_str = datetime.now(tz).strftime("%Y-%m-%d %H:%M")
+    now_str = now_local(await get_user_timezone(callback.from_user.id))
 
-    success = await mark_taken(dose_id, now_str)
+    dose = await mark_taken(dose_id, now_str)
 
-    if success:
+    if dose:
+        message = callback.message
+        if _from_digest(callback.data) and message and message.bot:
+            await _refresh_digest(
+                message.bot, message.chat.id, callback.from_user.id, message.message_id
+            )
+            await callback.answer(f"✅ {dose['medicine_name']}: принято")
+            return
         await callback.message.edit_text(  # type: ignore[union-attr]
-            f"✅ Отмечено как принятое в {now_str}"
+            f"✅ {dose['medicine_name']}: отмечено как принятое в {dose['taken_at']}"
         )
     else:
         await callback.answer("⚠️ Этот приём уже обработан.", show_alert=True)
 
 
+@router.callback_query(F.data == "digest_take_all")
+async def on_digest_take_all(callback: CallbackQuery) -> None:
+    """Handle '✅ Принял всё' on a digest: take every pending dose it lists."""
+    message = callback.message
+    if not message or not message.bot:
+        return
+
+    now_str = now_local(await get_user_timezone(callback.from_user.id))
+    taken = await take_pending_doses(
+        callback.from_user.id, now_str, message_id=message.message_id
+    )
+    if not taken:
+        await callback.answer("⚠️ Эти приёмы уже обработаны.", show_alert=True)
+        return
+
+    await callback.answer(f"✅ Отмечено: {len(taken)}")
+    await _refresh_digest(message.bot, message.chat.id, callback.from_user.id, message.message_id)
+
+
+@router.callback_query(F.data == "take_due")
+async def on_take_due(callback: CallbackQuery) -> None:
+    """Handle 'Принял все текущие' on a reminder: take every dose due by now."""
+    now_str = now_local(await get_user_timezone(callback.from_user.id))
+    taken = await take_pending_doses(callback.from_user.id, now_str, due_by=int(time.time()))
+    if not taken:
+        await callback.answer("⚠️ Эти приёмы уже обработаны.", show_alert=True)
+        return
+
+    await callback.answer()
+    names = ", ".join(dose["medicine_name"] for dose in taken)
+    await callback.message.edit_text(  # type: ignore[union-attr]
+        f"✅ Отмечено как принятое в {now_str.split(' ')[1]}: {names}"
+    )
+
+
 @router.callback_query(F.data.startswith("dose_snooze:"))
 async def on_dose_snooze(callback: CallbackQuery, state: FSMContext) -> None:
     """Handle the 'Snooze' button — ask user for delay duration."""
@@ -323,17 +393,24 @@ async def on_dose_snooze(callback: CallbackQuery, state: FSMContext) -> None:
         return
 
     dose_id = int(callback.data.split(":")[1])
-    await state.update_data(snooze_dose_id=dose_id)
+    await state.update_data(snooze_dose_id=dose_id, snooze_digest_id=None)
     await state.set_state(SnoozeInput.waiting)
 
     await callback.answer()
-    await callback.message.edit_text(  # type: ignore[union-attr]
+    prompt = (
         "⏰ На сколько отложить уведомление?\n\n"
         "Введите время:\n"
         "• <b>30</b> — 30 минут\n"
         "• <b>1:30</b> — 1 час 30 минут\n\n"
         "Для отмены: /cancel"
     )
+    message = callback.message
+    if _from_digest(callback.data) and message and message.bot:
+        # Keep the digest for the other doses; ask in a separate message
+        await state.update_data(snooze_digest_id=message.message_id)
+        await send_single_message(bot=message.bot, chat_id=message.chat.id, text=prompt)
+        return
+    await callback.message.edit_text(prompt)  # type: ignore[union-attr]
 
 
 @router.message(SnoozeInput.waiting)
@@ -362,21 +439,21 @@ async def process_snooze_input(message: Message, state: FSMContext) -> None:
 
     data = await state.get_data()
     dose_id = data["snooze_dose_id"]
+    digest_id = data.get("snooze_digest_id")
     await state.clear()
 
-    tz = pytz.timezone(settings.timezone)
-    now_str = datetime.now(tz).strftime("%Y-%m-%d %H:%M")
-
-    success, used_interval = await snooze(dose_id, minutes, now_str)
+    dose = await snooze(dose_id, minutes, int(time.time()), detach=digest_id is not None)
 
     if message.bot:
-        if success:
-            hours, mins = divmod(used_interval, 60)
+        if dose:
+            if digest_id and message.from_user:
+                await _refresh_digest(message.bot, message.chat.id, message.from_user.id, digest_id)
+            hours, mins = divmod(minutes, 60)
             time_label = f"{hours} ч {mins} мин" if hours else f"{mins} мин"
             await send_single_message(
                 bot=message.bot,
                 chat_id=message.chat.id,
-                text=f"⏰ Напоминание отложено на {time_label}."
+                text=f"⏰ Напоминание о {dose['medicine_name']} отложено на {time_label}."
             )
         else:
             await send_single_message(
@@ -395,11 +472,18 @@ async def on_dose_skip(callback: CallbackQuery) -> None:
     from app.services.dose_service import mark_skipped
     dose_id = int(callback.data.split(":")[1])
     
-    success = await mark_skipped(dose_id)
+    dose = await mark_skipped(dose_id)
 
-    if success:
+    if dose:
+        message = callback.message
+        if _from_digest(callback.data) and message and message.bot:
+            await _refresh_digest(
+                message.bot, message.chat.id, callback.from_user.id, message.message_id
+            )
+            await callback.answer(f"❌ {dose['medicine_name']}: не сегодня")
+            return
         await callback.message.edit_text(  # type: ignore[union-attr]
-            "❌ Отмечено как пропущенное."
+            f"❌ {dose['medicine_name']}: отмечено как пропущенное."
         )
     else:
         await callback.answer("⚠️ Этот приём уже обработан.", show_alert=True)
@@ -434,6 +518,8 @@ async def on_today_edit(callback: CallbackQuery) -> None:
         text += "❌ Пропущено"
     elif dose["status"] == "skipped":
         text += "❌ Не сегодня"
+    elif dose["status"] == "unanswered":
+        text += "❔ Без ответа"
     else:
         text += "⏳ В ожидании"
 
@@ -446,16 +532,14 @@ async def on_today_edit(callback: CallbackQuery) -> None:
 @router.callback_query(F.data == "today_back")
 async def on_today_back(callback: CallbackQuery) -> None:
     """Return to the full Today view from the single dose edit view."""
-    from app.handlers.today import _format_today
+    from app.handlers.today import render_today
     if not callback.from_user:
         return
 
     await callback.answer()
-    text, doses = await _format_today(callback.from_user.id)
-    
+    text, reply_markup = await render_today(callback.from_user.id)
+
     if callback.message:
-        from app.keyboards import today_kb, back_to_main_kb
-        reply_markup = today_kb(doses) if doses else back_to_main_kb()
         await callback.message.edit_text(text, reply_markup=reply_markup)  # type: ignore[union-attr]
 
 
@@ -471,17 +555,40 @@ async def on_today_action(callback: CallbackQuery) -> None:
     action_type = action_parts[0]
     dose_id = int(action_parts[1])
 
-    success = False
+    dose = None
     if action_type == "today_action_taken":
-        tz = pytz.timezone(settings.timezone)
-        now_str = datetime.now(tz).strftime("%Y-%m-%d %H:%M")
-        success = await mark_taken(dose_id, now_str)
+        now_str = now_local(await get_user_timezone(callback.from_user.id))
+        dose = await mark_taken(dose_id, now_str)
     elif action_type == "today_action_skip":
-        success = await mark_skipped(dose_id)
+        dose = await mark_skipped(dose_id)
     elif action_type == "today_action_reset":
-        success = await unmark_dose(dose_id)
+        dose = await unmark_dose(dose_id, int(time.time()))
 
-    if success:
+    if dose:
         await on_today_back(callback)
     else:
         await callback.answer("⚠️ Не удалось обновить статус приёма.", show_alert=True)
+
+
+@router.callback_query(F.data == "today_take_due")
+@router.callback_query(F.data.startswith("today_take_slot:"))
+async def on_today_take_bulk(callback: CallbackQuery) -> None:
+    """Take every dose due by now (or of one time slot) and redraw Today once."""
+    if not callback.data or not callback.from_user:
+        return
+
+    now_str = now_local(await get_user_timezone(callback.from_user.id))
+    if callback.data == "today_take_due":
+        taken = await take_pending_doses(
+            callback.from_user.id, now_str, due_by=int(time.time())
+        )
+    else:
+        slot_of = int(callback.data.split(":")[1])
+        taken = await take_pending_doses(callback.from_user.id, now_str, slot_of=slot_of)
+
+    if taken:
+        await on_today_back(callback)
+    elif callback.data == "today_take_due":
+        await callback.answer("⏳ Нет приёмов, время которых уже наступило.", show_alert=True)
+    else:
+        await callback.answer("⚠️ Эти приёмы уже обработаны.", show_alert=True)
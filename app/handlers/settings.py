@@ -1,16 +1,29 @@
-"""Handler for the /settings command — configure notification preferences."""
+"""Handler for the /settings command — configure notification preferences and time zone."""
 
 from __future__ import annotations
 
-from aiogram import Router
+from aiogram import Bot, F, Router
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.types import Message
-
-from app.keyboards import main_menu_kb
-from app.services.settings_service import get_settings_by_telegram_id, update_settings
+from aiogram.types import CallbackQuery, Message
+
+from app.keyboards import (
+    MAX_REMINDER_CHOICES,
+    main_menu_kb,
+    max_reminders_kb,
+    settings_kb,
+    timezone_kb,
+)
+from app.services.medicine_service import ensure_user
+from app.services.settings_service import (
+    get_settings_by_telegram_id,
+    get_user_timezone,
+    set_user_timezone,
+    update_settings,
+)
 from app.services.message_service import send_single_message
+from app.timeutils import is_valid_tz, now_local
 
 router = Router()
 
@@ -19,12 +32,15 @@ class EditSettings(StatesGroup):
     """FSM states for editing notification settings."""
 
     interval = State()
+    timezone = State()
 
 
-def _settings_text(interval: int) -> str:
+def _settings_text(interval: int, tz_name: str, max_reminders: int) -> str:
     return (
         f"⚙️ Настройки уведомлений:\n\n"
-        f"⏱ Интервал повторных уведомлений: {interval} мин.\n\n"
+        f"⏱ Интервал повторных уведомлений: {interval} мин.\n"
+        f"🔁 Напоминаний о приёме, не больше: {max_reminders}\n"
+        f"🌍 Часовой пояс: {tz_name} (сейчас {now_local(tz_name, '%H:%M')})\n\n"
         f"Введите новый интервал в минутах (1–120):\n"
         f"Для отмены отправьте /cancel"
     )
@@ -46,7 +62,10 @@ async def cmd_settings(message: Message, state: FSMContext) -> None:
         await send_single_message(
             bot=message.bot,
             chat_id=message.chat.id,
-            text=_settings_text(current["reminder_interval_minutes"]),
+            text=_settings_text(
+                current["reminder_interval_minutes"], current["timezone"], current["max_reminders"]
+            ),
+            reply_markup=settings_kb(),
         )
     await state.set_state(EditSettings.interval)
 
@@ -101,7 +120,7 @@ async def process_interval(message: Message, state: FSMContext) -> None:
         return
 
     interval = int(text)
-    await update_settings(message.from_user.id, interval)
+    await update_settings(message.from_user.id, reminder_interval_minutes=interval)
     await state.clear()
     if message.bot:
         await send_single_message(
@@ -113,3 +132,120 @@ async def process_interval(message: Message, state: FSMContext) -> None:
             ),
             reply_markup=main_menu_kb(),
         )
+
+
+async def _apply_timezone(bot: Bot, chat_id: int, telegram_id: int, tz_name: str) -> None:
+    await ensure_user(telegram_id)
+    await set_user_timezone(telegram_id, tz_name)
+    await send_single_message(
+        bot=bot,
+        chat_id=chat_id,
+        text=(
+            f"✅ Часовой пояс сохранён: {tz_name}\n"
+            f"🕐 Местное время: {now_local(tz_name, '%H:%M')}"
+        ),
+        reply_markup=main_menu_kb(),
+    )
+
+
+@router.callback_query(F.data == "settings:tz")
+async def on_choose_timezone(callback: CallbackQuery, state: FSMContext) -> None:
+    """Show the time zone picker; a typed IANA name is accepted too."""
+    if not callback.from_user:
+        return
+
+    await callback.answer()
+    current = await get_user_timezone(callback.from_user.id)
+    await state.set_state(EditSettings.timezone)
+    await callback.message.edit_text(  # type: ignore[union-attr]
+        "🌍 Выберите часовой пояс или введите его название "
+        "(например, <b>Europe/Moscow</b>):",
+        reply_markup=timezone_kb(current),
+    )
+
+
+@router.callback_query(F.data.startswith("tz:"))
+async def on_timezone_selected(callback: CallbackQuery, state: FSMContext) -> None:
+    """Save the time zone picked from the list."""
+    if not callback.from_user or not callback.data:
+        return
+
+    tz_name = callback.data.split(":", 1)[1]
+    if not is_valid_tz(tz_name):
+        await callback.answer("⚠️ Неизвестный часовой пояс.", show_alert=True)
+        return
+
+    await callback.answer()
+    await state.clear()
+    if callback.message and callback.message.bot:
+        await _apply_timezone(
+            callback.message.bot, callback.message.chat.id, callback.from_user.id, tz_name
+        )
+
+
+@router.message(EditSettings.timezone)
+async def process_timezone(message: Message, state: FSMContext) -> None:
+    """Receive a typed IANA time zone name."""
+    try:
+        await message.delete()
+    except Exception:
+        pass
+
+    tz_name = (message.text or "").strip()
+    if not is_valid_tz(tz_name):
+        if message.bot:
+            await send_single_message(
+                bot=message.bot,
+                chat_id=message.chat.id,
+                text="⚠️ Неизвестный часовой пояс. Пример: <b>Europe/Moscow</b>",
+            )
+        return
+
+    if not message.from_user:
+        return
+
+    await state.clear()
+    if message.bot:
+        await _apply_timezone(message.bot, message.chat.id, message.from_user.id, tz_name)
+
+
+@router.callback_query(F.data == "settings:max")
+async def on_choose_max_reminders(callback: CallbackQuery, state: FSMContext) -> None:
+    """Show the reminder cap choices."""
+    if not callback.from_user:
+        return
+
+    await callback.answer()
+    await state.clear()
+    current = await get_settings_by_telegram_id(callback.from_user.id)
+    await callback.message.edit_text(  # type: ignore[union-attr]
+        "🔁 Сколько раз напоминать о приёме, если вы не отвечаете?\n"
+        "После последнего напоминания приём отмечается как оставшийся без ответа.",
+        reply_markup=max_reminders_kb(current["max_reminders"]),
+    )
+
+
+@router.callback_query(F.data.startswith("maxrem:"))
+async def on_max_reminders_selected(callback: CallbackQuery) -> None:
+    """Save the chosen reminder cap."""
+    if not callback.from_user or not callback.data:
+        return
+
+    max_reminders = int(callback.data.split(":", 1)[1])
+    if max_reminders not in MAX_REMINDER_CHOICES:
+        await callback.answer("⚠️ Недопустимое значение.", show_alert=True)
+        return
+
+    await callback.answer()
+    await ensure_user(callback.from_user.id)
+    await update_settings(callback.from_user.id, max_reminders=max_reminders)
+    if callback.message and callback.message.bot:
+        await send_single_message(
+            bot=callback.message.bot,
+            chat_id=callback.message.chat.id,
+            text=(
+                f"✅ Настройки сохранены!\n\n"
+                f"🔁 Напоминаний о приёме, не больше: {max_reminders}"
+            ),
+            reply_markup=main_menu_kb(),
+        )
@@ -8,7 +8,7 @@ from aiogram.fsm.context import FSMContext
 from aiogram.types import Message
 
 from app.keyboards import main_menu_kb, persistent_menu_kb
-from app.services.medicine_service import ensure_user
+from app.services.medicine_service import ensure_user, reactivate_user
 from app.services.message_service import send_single_message
 
 router = Router()
@@ -21,6 +21,8 @@ async def cmd_start(message: Message) -> None:
         return
 
     await ensure_user(message.from_user.id)
+    # Coming back after blocking the bot: reminders resume
+    await reactivate_user(message.from_user.id)
     
     # Delete user's command message to keep chat clean
     try:
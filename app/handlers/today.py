@@ -4,19 +4,19 @@ from __future__ import annotations
 
 from datetime import datetime, timedelta
 
-import pytz
 from aiogram import Router
 from aiogram.filters import Command
-from aiogram.types import Message
+from aiogram.types import InlineKeyboardMarkup, Message
 
-from app.config import settings
-from app.keyboards import history_kb
-from app.services.dose_service import get_dose_history, get_today_doses
+from app.keyboards import back_to_main_kb, history_kb, today_kb
+from app.services.dose_service import get_dose_history, get_today_entry
 from app.services.message_service import send_single_message
+from app.services.settings_service import get_user_timezone
+from app.timeutils import DATE_FMT, get_tz, now_local
 
 router = Router()
 
-STATUS_ICONS = {"taken": "✅", "missed": "❌", "scheduled": "⏳"}
+STATUS_ICONS = {"taken": "✅", "missed": "❌", "unanswered": "❔", "scheduled": "⏳"}
 
 
 def _format_dose(dose: dict) -> str:
@@ -38,30 +38,40 @@ def _format_dose(dose: dict) -> str:
         return f"✅ {name} — {time_part} (принято в {taken_time})"
     elif status == "missed":
         return f"❌ {name} — {time_part} (пропущено)"
+    elif status == "unanswered":
+        return f"❔ {name} — {time_part} (без ответа)"
     else:  # scheduled
         return f"⏳ {name} — {time_part} (ожидается)"
 
 
-async def _format_today(telegram_id: int) -> tuple[str, list[dict]]:
-    """Build the today's schedule text for a user. Reusable by callbacks."""
-    tz = pytz.timezone(settings.timezone)
-    today = datetime.now(tz).strftime("%Y-%m-%d")
-    doses = await get_today_doses(telegram_id, today)
-
+def _today_text(doses: list[dict]) -> str:
+    """Build the today's schedule text from a user's doses."""
     if not doses:
         return (
             "📅 На сегодня нет запланированных приёмов.\n"
             "Добавьте лекарство командой /add"
-        ), []
-
+        )
     lines = [_format_dose(d) for d in doses]
-    return "📅 Сегодня:\n\n" + "\n".join(lines), doses
+    return "📅 Сегодня:\n\n" + "\n".join(lines)
+
+
+async def render_today(telegram_id: int) -> tuple[str, InlineKeyboardMarkup]:
+    """Text and markup of the Today view, cached with the user's day.
+
+    Dose transitions patch the cached day and drop the render, so toggling
+    a dose re-renders without touching the DB.
+    """
+    today = now_local(await get_user_timezone(telegram_id), DATE_FMT)
+    entry = await get_today_entry(telegram_id, today)
+    if entry.rendered is None:
+        markup = today_kb(entry.doses) if entry.doses else back_to_main_kb()
+        entry.rendered = (_today_text(entry.doses), markup)
+    return entry.rendered
 
 
 async def format_history(telegram_id: int, period: str) -> str:
     """Build history text for yesterday or last week."""
-    tz = pytz.timezone(settings.timezone)
-    now = datetime.now(tz)
+    now = datetime.now(get_tz(await get_user_timezone(telegram_id)))
 
     if period == "yesterday":
         day = now - timedelta(days=1)
@@ -97,6 +107,8 @@ async def format_history(telegram_id: int, period: str) -> str:
                 suffix = f" (в {taken_time})"
             elif d["status"] == "missed":
                 suffix = " (пропущено)"
+            elif d["status"] == "unanswered":
+                suffix = " (без ответа)"
             lines.append(f"  {icon} {d['medicine_name']} — {time_part}{suffix}")
         lines.append("")
 
@@ -114,11 +126,8 @@ async def cmd_today(message: Message) -> None:
     except Exception:
         pass
 
-    text, doses = await _format_today(message.from_user.id)
+    text, reply_markup = await render_today(message.from_user.id)
     if message.bot:
-        from app.keyboards import today_kb, back_to_main_kb
-        reply_markup = today_kb(doses) if doses else back_to_main_kb()
-        
         await send_single_message(
             bot=message.bot,
             chat_id=message.chat.id,
@@ -93,7 +93,8 @@ def history_kb() -> InlineKeyboardMarkup:
 def dose_reminder_kb(dose_id: int) -> InlineKeyboardMarkup:
     """Create an inline keyboard for a dose reminder.
 
-    Buttons: ✅ Принял / ⏰ Отложить
+    Buttons: ✅ Принял / ❌ Не сегодня / ⏰ Отложить, then a bulk
+    "take everything due" row.
     """
     return InlineKeyboardMarkup(
         inline_keyboard=[
@@ -110,10 +111,36 @@ def dose_reminder_kb(dose_id: int) -> InlineKeyboardMarkup:
                     text="⏰ Отложить",
                     callback_data=f"dose_snooze:{dose_id}",
                 ),
-            ]
+            ],
+            [InlineKeyboardButton(text="✅ Принял все текущие", callback_data="take_due")],
         ]
     )
 
+
+def digest_kb(doses: list[dict]) -> InlineKeyboardMarkup | None:
+    """Keyboard of a digest reminder: one row per pending dose, then "take all".
+
+    Dose buttons carry a ``:digest`` suffix so their handlers know to
+    re-render the digest. Returns None once no dose in the digest is pending.
+    """
+    pending = [d for d in doses if d.get("status", "scheduled") == "scheduled"]
+    if not pending:
+        return None
+    rows = [
+        [
+            InlineKeyboardButton(
+                text=f"✅ {d['medicine_name']}",
+                callback_data=f"dose_taken:{d['dose_id']}:digest",
+            ),
+            InlineKeyboardButton(text="❌", callback_data=f"dose_skip:{d['dose_id']}:digest"),
+            InlineKeyboardButton(text="⏰", callback_data=f"dose_snooze:{d['dose_id']}:digest"),
+        ]
+        for d in pending
+    ]
+    rows.append([InlineKeyboardButton(text="✅ Принял всё", callback_data="digest_take_all")])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+
 def back_to_main_kb() -> InlineKeyboardMarkup:
     """Inline keyboard with only the main menu button."""
     return InlineKeyboardMarkup(
@@ -130,11 +157,14 @@ def today_kb(doses: list[dict]) -> InlineKeyboardMarkup:
     
     # Add an edit button for each dose
     for dose in doses:
-        status_icon = "✅" if dose["status"] == "taken" else "❌" if dose["status"] == "missed" else "⏳"
+        status_icon = {"taken": "✅", "missed": "❌", "unanswered": "❔"}.get(dose["status"], "⏳")
         time_part = dose["scheduled_datetime"].split(" ")[1] if " " in dose["scheduled_datetime"] else dose["scheduled_datetime"]
         btn_text = f"{status_icon} {dose['medicine_name']} {time_part}"
         buttons.append([InlineKeyboardButton(text=btn_text, callback_data=f"today_edit:{dose['dose_id']}")])
-        
+
+    if any(dose["status"] == "scheduled" for dose in doses):
+        buttons.append([InlineKeyboardButton(text="✅ Принять все текущие", callback_data="today_take_due")])
+
     buttons.append([
         InlineKeyboardButton(text="📅 История", callback_data="menu:history"),
         InlineKeyboardButton(text="🏠 Главное меню", callback_data="menu:main"),
@@ -148,6 +178,9 @@ def edit_today_dose_kb(dose_id: int, status: str) -> InlineKeyboardMarkup:
     
     if status != "taken":
         buttons.append([InlineKeyboardButton(text="✅ Отметить как принятое", callback_data=f"today_action_taken:{dose_id}")])
+
+    if status == "scheduled":
+        buttons.append([InlineKeyboardButton(text="✅ Принять всё в это время", callback_data=f"today_take_slot:{dose_id}")])
     
     if status != "skipped" and status != "missed":
         buttons.append([InlineKeyboardButton(text="❌ Пропустить", callback_data=f"today_action_skip:{dose_id}")])
@@ -157,3 +190,71 @@ def edit_today_dose_kb(dose_id: int, status: str) -> InlineKeyboardMarkup:
         
     buttons.append([InlineKeyboardButton(text="↩️ Назад к списку", callback_data="today_back")])
     return InlineKeyboardMarkup(inline_keyboard=buttons)
+
+
+# Time zones offered on the settings screen; any other IANA name can be typed
+COMMON_TIMEZONES = [
+    ("Калининград", "Europe/Kaliningrad"),
+    ("Москва", "Europe/Moscow"),
+    ("Самара", "Europe/Samara"),
+    ("Екатеринбург", "Asia/Yekaterinburg"),
+    ("Омск", "Asia/Omsk"),
+    ("Новосибирск", "Asia/Novosibirsk"),
+    ("Красноярск", "Asia/Krasnoyarsk"),
+    ("Иркутск", "Asia/Irkutsk"),
+    ("Якутск", "Asia/Yakutsk"),
+    ("Владивосток", "Asia/Vladivostok"),
+    ("Магадан", "Asia/Magadan"),
+    ("Камчатка", "Asia/Kamchatka"),
+    ("Минск", "Europe/Minsk"),
+    ("Киев", "Europe/Kyiv"),
+    ("Алматы", "Asia/Almaty"),
+    ("Тбилиси", "Asia/Tbilisi"),
+    ("Берлин", "Europe/Berlin"),
+    ("Лондон", "Europe/London"),
+    ("Нью-Йорк", "America/New_York"),
+    ("UTC", "UTC"),
+]
+
+
+def settings_kb() -> InlineKeyboardMarkup:
+    """Inline keyboard for the settings screen."""
+    return InlineKeyboardMarkup(
+        inline_keyboard=[
+            [InlineKeyboardButton(text="🔁 Число напоминаний", callback_data="settings:max")],
+            [InlineKeyboardButton(text="🌍 Часовой пояс", callback_data="settings:tz")],
+            [InlineKeyboardButton(text="🏠 Главное меню", callback_data="menu:main")],
+        ]
+    )
+
+
+# Choices for the per-dose reminder cap on the settings screen
+MAX_REMINDER_CHOICES = (1, 2, 3, 5, 10, 20)
+
+
+def max_reminders_kb(current: int) -> InlineKeyboardMarkup:
+    """Inline keyboard with reminder cap choices, three per row."""
+    buttons = [
+        InlineKeyboardButton(
+            text=f"{'✅ ' if n == current else ''}{n}",
+            callback_data=f"maxrem:{n}",
+        )
+        for n in MAX_REMINDER_CHOICES
+    ]
+    rows = [buttons[i:i + 3] for i in range(0, len(buttons), 3)]
+    rows.append([InlineKeyboardButton(text="↩️ Назад", callback_data="menu:settings")])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+def timezone_kb(current: str) -> InlineKeyboardMarkup:
+    """Inline keyboard with common time zones, two per row."""
+    buttons = [
+        InlineKeyboardButton(
+            text=f"{'✅ ' if tz_name == current else ''}{label}",
+            callback_data=f"tz:{tz_name}",
+        )
+        for label, tz_name in COMMON_TIMEZONES
+    ]
+    rows = [buttons[i:i + 2] for i in range(0, len(buttons), 2)]
+    rows.append([InlineKeyboardButton(text="↩️ Назад", callback_data="menu:settings")])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
@@ -0,0 +1,120 @@
+"""In-memory cache of each chat's last bot message id with write-behind.
+
+``send_single_message`` needs the previous message id on every interaction.
+The cache loads it lazily from ``users.last_message_id`` on first use and
+keeps it in an LRU map; new ids are recorded in memory and persisted in
+batches by a background flusher (and on shutdown), so the interactive path
+does no DB I/O once a chat is warm.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+from collections import OrderedDict
+
+from app.db import get_last_message_id, set_last_message_ids
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_CACHE_SIZE = 10_000
+MESSAGE_FLUSH_INTERVAL = 5.0  # seconds
+
+
+class LastMessageCache:
+    """Bounded LRU map ``chat_id → last_message_id`` with batched persistence.
+
+    Unflushed ids live in a separate dirty map, so evicting a chat from the
+    LRU never loses a write. An id leaves the dirty map only once its write
+    has committed, so reads during a flush never fall back to the old row.
+    """
+
+    def __init__(
+        self,
+        capacity: int = MESSAGE_CACHE_SIZE,
+        flush_interval: float = MESSAGE_FLUSH_INTERVAL,
+    ) -> None:
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+        self._ids: OrderedDict[int, int | None] = OrderedDict()
+        self._dirty: dict[int, int] = {}
+        self._task: asyncio.Task[None] | None = None
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    @property
+    def pending(self) -> int:
+        """Number of ids waiting to be flushed."""
+        return len(self._dirty)
+
+    def _remember(self, chat_id: int, message_id: int | None) -> None:
+        self._ids[chat_id] = message_id
+        self._ids.move_to_end(chat_id)
+        while len(self._ids) > self.capacity:
+            self._ids.popitem(last=False)
+
+    async def get(self, chat_id: int) -> int | None:
+        """Last message id for the chat, loading it from the DB on a miss."""
+        if chat_id in self._ids:
+            self.hits += 1
+            self._ids.move_to_end(chat_id)
+            return self._ids[chat_id]
+        if chat_id in self._dirty:
+            self.hits += 1
+            message_id: int | None = self._dirty[chat_id]
+        else:
+            self.misses += 1
+            message_id = await get_last_message_id(chat_id)
+            # A set() may have raced the load; it wins
+            if chat_id in self._ids:
+                return self._ids[chat_id]
+        self._remember(chat_id, message_id)
+        return message_id
+
+    def set(self, chat_id: int, message_id: int) -> None:
+        """Record a new last message id; it is persisted by the next flush."""
+        self._remember(chat_id, message_id)
+        self._dirty[chat_id] = message_id
+
+    async def flush(self) -> int:
+        """Persist all pending ids in one transaction. Returns how many."""
+        if not self._dirty:
+            return 0
+        batch = dict(self._dirty)
+        await set_last_message_ids(list(batch.items()))
+        # Keep ids that changed while the write was in flight
+        for chat_id, message_id in batch.items():
+            if self._dirty.get(chat_id) == message_id:
+                del self._dirty[chat_id]
+        return len(batch)
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Failed to flush last message ids")
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name="message-cache-flush")
+
+    async def stop(self) -> None:
+        """Stop the flusher and write out anything still pending."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        flushed = await self.flush()
+        if flushed:
+            logger.info("Flushed %d last message ids on shutdown", flushed)
+
+
+message_cache = LastMessageCache()
@@ -0,0 +1,355 @@
+"""Versioned schema migrations tracked with ``PRAGMA user_version``.
+
+Each migration is an async function receiving an open connection. They run
+in order, each in its own transaction together with the ``user_version``
+bump, so a crash mid-way never leaves a half-applied step recorded as done.
+Steps must be idempotent: databases created before versioning already have
+some of the changes applied. Avoid ``executescript`` inside a step — it
+commits the surrounding transaction.
+"""
+
+from __future__ import annotations
+
+import logging
+from collections.abc import Awaitable, Callable
+
+import aiosqlite
+
+from app.config import settings
+from app.timeutils import local_to_epoch
+
+logger = logging.getLogger(__name__)
+
+Migration = Callable[[aiosqlite.Connection], Awaitable[None]]
+
+
+async def _column_names(db: aiosqlite.Connection, table: str) -> set[str]:
+    cursor = await db.execute(f"PRAGMA table_info({table})")
+    return {row[1] for row in await cursor.fetchall()}
+
+
+async def _add_column(db: aiosqlite.Connection, table: str, column: str, decl: str) -> None:
+    if column not in await _column_names(db, table):
+        await db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+
+async def _m001_message_id_columns(db: aiosqlite.Connection) -> None:
+    """Add users.last_message_id and doses.message_id to pre-versioning DBs."""
+    await _add_column(db, "users", "last_message_id", "INTEGER")
+    await _add_column(db, "doses", "message_id", "INTEGER")
+
+
+async def _m002_hot_query_indexes(db: aiosqlite.Connection) -> None:
+    """Index the columns used by the reminder tick, generation and deletes."""
+    for statement in (
+        "CREATE INDEX IF NOT EXISTS idx_doses_status_next_reminder"
+        " ON doses (status, next_reminder_at)",
+        "CREATE INDEX IF NOT EXISTS idx_doses_schedule_datetime"
+        " ON doses (schedule_id, scheduled_datetime)",
+        "CREATE INDEX IF NOT EXISTS idx_doses_medicine ON doses (medicine_id)",
+        "CREATE INDEX IF NOT EXISTS idx_schedules_medicine ON schedules (medicine_id)",
+        "CREATE INDEX IF NOT EXISTS idx_medicines_user ON medicines (user_id)",
+    ):
+        await db.execute(statement)
+
+
+async def _m003_epoch_columns_and_int_status(db: aiosqlite.Connection) -> None:
+    """Rebuild ``doses`` with UTC epoch instants, a local date and an int status.
+
+    ``scheduled_datetime`` stays as the local display string; existing rows are
+    backfilled by converting it in the configured time zone. Status strings map
+    to 0=scheduled, 1=taken, 2=missed, 3=skipped.
+    """
+    if "scheduled_at" in await _column_names(db, "doses"):
+        return
+
+    tz_name = settings.timezone
+    await db.create_function(
+        "local_to_epoch",
+        1,
+        lambda value: local_to_epoch(value, tz_name) if value else None,
+        deterministic=True,
+    )
+    await db.execute(
+        """
+        CREATE TABLE doses_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            medicine_id INTEGER NOT NULL,
+            schedule_id INTEGER,
+            scheduled_datetime TEXT NOT NULL,
+            scheduled_at INTEGER NOT NULL,
+            dose_date TEXT NOT NULL,
+            status INTEGER NOT NULL DEFAULT 0 CHECK (status IN (0, 1, 2, 3)),
+            taken_at TEXT,
+            reminder_sent INTEGER DEFAULT 0,
+            reminder_count INTEGER DEFAULT 0,
+            next_reminder_at INTEGER,
+            message_id INTEGER,
+            FOREIGN KEY (medicine_id) REFERENCES medicines(id),
+            FOREIGN KEY (schedule_id) REFERENCES schedules(id)
+        )
+        """
+    )
+    await db.execute(
+        """
+        INSERT INTO doses_new (
+            id, medicine_id, schedule_id, scheduled_datetime, scheduled_at, dose_date,
+            status, taken_at, reminder_sent, reminder_count, next_reminder_at, message_id
+        )
+        SELECT id, medicine_id, schedule_id, scheduled_datetime,
+               local_to_epoch(scheduled_datetime),
+               substr(scheduled_datetime, 1, 10),
+               CASE status
+                   WHEN 'scheduled' THEN 0
+                   WHEN 'taken' THEN 1
+                   WHEN 'skipped' THEN 3
+                   ELSE 2
+               END,
+               taken_at, reminder_sent, reminder_count,
+               local_to_epoch(COALESCE(next_reminder_at, scheduled_datetime)),
+               message_id
+        FROM doses
+        """
+    )
+    await db.execute("DROP TABLE doses")
+    await db.execute("ALTER TABLE doses_new RENAME TO doses")
+    for statement in (
+        "CREATE INDEX idx_doses_status_next_reminder ON doses (status, next_reminder_at)",
+        "CREATE INDEX idx_doses_status_scheduled ON doses (status, scheduled_at)",
+        "CREATE INDEX idx_doses_schedule_date ON doses (schedule_id, dose_date)",
+        "CREATE INDEX idx_doses_medicine_date ON doses (medicine_id, dose_date)",
+    ):
+        await db.execute(statement)
+
+
+async def _m004_unique_dose_per_schedule_day(db: aiosqlite.Connection) -> None:
+    """Enforce one dose per (schedule_id, dose_date).
+
+    Duplicates left by overlapping generation runs are collapsed first,
+    keeping the row the user already acted on (non-scheduled) if any.
+    """
+    await db.execute(
+        """
+        DELETE FROM doses
+        WHERE id IN (
+            SELECT id FROM (
+                SELECT id, ROW_NUMBER() OVER (
+                    PARTITION BY schedule_id, dose_date
+                    ORDER BY status != 0 DESC, id
+                ) AS rn
+                FROM doses
+                WHERE schedule_id IS NOT NULL
+            )
+            WHERE rn > 1
+        )
+        """
+    )
+    await db.execute("DROP INDEX IF EXISTS idx_doses_schedule_date")
+    await db.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_doses_schedule_date"
+        " ON doses (schedule_id, dose_date)"
+    )
+
+
+async def _m005_outbox(db: aiosqlite.Connection) -> None:
+    """Durable outbox of reminder deliveries.
+
+    One row per (dose, reminder number); ``state`` is 0=pending, 1=sending,
+    2=sent, 3=failed, 4=cancelled, 5=unknown (lease expired mid-send).
+    """
+    await db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            dose_id INTEGER NOT NULL,
+            reminder_no INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            state INTEGER NOT NULL DEFAULT 0 CHECK (state IN (0, 1, 2, 3, 4, 5)),
+            attempts INTEGER NOT NULL DEFAULT 0,
+            available_at INTEGER NOT NULL,
+            lease_until INTEGER,
+            message_id INTEGER,
+            last_error TEXT,
+            created_at INTEGER NOT NULL,
+            UNIQUE (dose_id, reminder_no),
+            FOREIGN KEY (dose_id) REFERENCES doses(id) ON DELETE CASCADE
+        )
+        """
+    )
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_outbox_state_available ON outbox (state, available_at)"
+    )
+
+
+async def _m006_app_state(db: aiosqlite.Connection) -> None:
+    """Key/value store for process bookkeeping (e.g. the last processed date)."""
+    await db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS app_state (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        )
+        """
+    )
+
+
+async def _m007_user_timezone_and_day_end(db: aiosqlite.Connection) -> None:
+    """Per-user time zone and a precomputed end of each dose's local day.
+
+    ``users.timezone`` is NULL for the configured default. ``day_end_at`` is
+    the UTC instant of local midnight after ``dose_date`` in the owner's
+    zone, so due selection and rollover are plain range predicates on
+    integer columns for every zone; existing rows use the default zone.
+    """
+    await _add_column(db, "users", "timezone", "TEXT")
+    await _add_column(db, "doses", "day_end_at", "INTEGER")
+
+    tz_name = settings.timezone
+    await db.create_function("local_to_epoch", 2, local_to_epoch, deterministic=True)
+    await db.execute(
+        """
+        UPDATE doses
+        SET day_end_at = local_to_epoch(date(dose_date, '+1 day') || ' 00:00', ?)
+        WHERE day_end_at IS NULL
+        """,
+        (tz_name,),
+    )
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_doses_status_day_end ON doses (status, day_end_at)"
+    )
+
+
+async def _m008_reminder_priority(db: aiosqlite.Connection) -> None:
+    """Dispatch priority of outbox rows and a snooze marker on doses.
+
+    ``outbox.priority`` is 0=first reminder, 1=repeat, 2=snooze; a dose is
+    ``snoozed`` from a snooze until its next reminder goes out.
+    """
+    await _add_column(db, "doses", "snoozed", "INTEGER NOT NULL DEFAULT 0")
+    await _add_column(db, "outbox", "priority", "INTEGER NOT NULL DEFAULT 0")
+
+
+async def _m009_dose_message_index(db: aiosqlite.Connection) -> None:
+    """Look up the doses covered by a (digest) reminder message."""
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_doses_message ON doses (message_id)"
+        " WHERE message_id IS NOT NULL"
+    )
+
+
+async def _m010_unanswered_status(db: aiosqlite.Connection) -> None:
+    """Allow status 4=unanswered and make ``user_settings.max_reminders`` real.
+
+    SQLite cannot alter a CHECK constraint, so ``doses`` is rebuilt with the
+    same columns and indexes. The placeholder cap of 999 that was written
+    for every user becomes the default of 3.
+    """
+    cursor = await db.execute(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'doses'"
+    )
+    if "(0, 1, 2, 3, 4)" not in (await cursor.fetchone())[0]:
+        await db.execute(
+            """
+            CREATE TABLE doses_new (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                medicine_id INTEGER NOT NULL,
+                schedule_id INTEGER,
+                scheduled_datetime TEXT NOT NULL,
+                scheduled_at INTEGER NOT NULL,
+                dose_date TEXT NOT NULL,
+                status INTEGER NOT NULL DEFAULT 0 CHECK (status IN (0, 1, 2, 3, 4)),
+                taken_at TEXT,
+                reminder_sent INTEGER DEFAULT 0,
+                reminder_count INTEGER DEFAULT 0,
+                next_reminder_at INTEGER,
+                message_id INTEGER,
+                day_end_at INTEGER,
+                snoozed INTEGER NOT NULL DEFAULT 0,
+                FOREIGN KEY (medicine_id) REFERENCES medicines(id),
+                FOREIGN KEY (schedule_id) REFERENCES schedules(id)
+            )
+            """
+        )
+        columns = (
+            "id, medicine_id, schedule_id, scheduled_datetime, scheduled_at, dose_date,"
+            " status, taken_at, reminder_sent, reminder_count, next_reminder_at,"
+            " message_id, day_end_at, snoozed"
+        )
+        await db.execute(f"INSERT INTO doses_new ({columns}) SELECT {columns} FROM doses")
+        await db.execute("DROP TABLE doses")
+        await db.execute("ALTER TABLE doses_new RENAME TO doses")
+        for statement in (
+            "CREATE INDEX idx_doses_status_next_reminder ON doses (status, next_reminder_at)",
+            "CREATE INDEX idx_doses_status_scheduled ON doses (status, scheduled_at)",
+            "CREATE INDEX idx_doses_medicine_date ON doses (medicine_id, dose_date)",
+            "CREATE UNIQUE INDEX uq_doses_schedule_date ON doses (schedule_id, dose_date)",
+            "CREATE INDEX idx_doses_status_day_end ON doses (status, day_end_at)",
+            "CREATE INDEX idx_doses_message ON doses (message_id)"
+            " WHERE message_id IS NOT NULL",
+        ):
+            await db.execute(statement)
+
+    await db.execute("UPDATE user_settings SET max_reminders = 3 WHERE max_reminders = 999")
+
+
+async def _m011_user_liveness(db: aiosqlite.Connection) -> None:
+    """Mark users the bot can no longer reach (blocked it, chat gone).
+
+    ``users.active`` is 1 by default; the partial index holds only the few
+    inactive users, which generation, due selection and rollover skip.
+    """
+    await _add_column(db, "users", "active", "INTEGER NOT NULL DEFAULT 1")
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_users_inactive ON users (id) WHERE active = 0"
+    )
+
+
+# Append only: the position in this list (1-based) is the schema version.
+MIGRATIONS: list[Migration] = [
+    _m001_message_id_columns,
+    _m002_hot_query_indexes,
+    _m003_epoch_columns_and_int_status,
+    _m004_unique_dose_per_schedule_day,
+    _m005_outbox,
+    _m006_app_state,
+    _m007_user_timezone_and_day_end,
+    _m008_reminder_priority,
+    _m009_dose_message_index,
+    _m010_unanswered_status,
+    _m011_user_liveness,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+async def get_schema_version(db: aiosqlite.Connection) -> int:
+    cursor = await db.execute("PRAGMA user_version")
+    row = await cursor.fetchone()
+    return int(row[0]) if row else 0
+
+
+async def run_migrations(db: aiosqlite.Connection) -> int:
+    """Apply pending migrations in order. Returns how many were applied.
+
+    The connection must be in autocommit mode (``isolation_level=None``)
+    so that transactions can be managed explicitly.
+    """
+    current = await get_schema_version(db)
+    if current > SCHEMA_VERSION:
+        raise RuntimeError(
+            f"Database schema version {current} is newer than supported {SCHEMA_VERSION}"
+        )
+
+    applied = 0
+    for version, migration in enumerate(MIGRATIONS[current:], start=current + 1):
+        logger.info("Applying migration %d: %s", version, migration.__name__)
+        await db.execute("BEGIN IMMEDIATE")
+        try:
+            await migration(db)
+            await db.execute(f"PRAGMA user_version = {version}")
+            await db.execute("COMMIT")
+        except Exception:
+            await db.execute("ROLLBACK")
+            raise
+        applied += 1
+    return applied
@@ -1,102 +1,412 @@
-"""APScheduler setup: daily dose generation, reminders, auto-miss."""
+"""Scheduling: the reminder tick pipeline, APScheduler jobs and the reminder engine.
+
+All reminder work happens in one tick pipeline (missed-dose rollover, due
+selection, dispatch, bookkeeping) that never overlaps itself. Ticks are
+triggered by the due queue when a reminder falls due, and by a low-frequency
+APScheduler safety-net job.
+
+Peak minutes are spread by a paced dispatcher: first reminders go out
+before repeats, repeats before snoozes, at a target rate, and the overflow
+waits for the next slot. Queue depth and the delivery lag (send time minus
+the reminder's nominal time) per priority are reported per tick and over a
+rolling window as p50/p99.
+"""
 
 from __future__ import annotations
 
+import asyncio
+import functools
 import logging
-from datetime import datetime
+import math
+import time
+from collections import deque
+from collections.abc import Iterable, Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass, field
 
-import pytz
 from aiogram import Bot
-from aiogram.exceptions import TelegramBadRequest
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from apscheduler.events import EVENT_JOB_MAX_INSTANCES, EVENT_JOB_MISSED, JobEvent
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
 from app.config import settings
-from app.keyboards import dose_reminder_kb
+from app.db import ReminderPriority
+from app.delivery import DeliveryEngine, DeliveryJob, SlotPacer
+from app.digest import DIGEST_MODE, digest_text
+from app.due_queue import ReminderEngine, due_queue
+from app.keyboards import digest_kb, dose_reminder_kb
 from app.services.dose_service import (
-    generate_daily_doses,
-    get_due_reminders,
-    mark_reminder_sent,
+    catch_up,
+    get_pending_reminders,
     process_missed_doses,
-    save_dose_message_id,
+    process_unanswered_doses,
+    top_up_horizon,
+)
+from app.services.outbox_service import (
+    claim_deliveries,
+    complete_deliveries,
+    deactivate_chats,
+    enqueue_due_reminders,
+    fail_delivery,
+    outbox_depth,
+    recover_stale_deliveries,
 )
 from app.services.message_service import send_single_message
+from app.timeutils import DATE_FMT, get_tz, now_local
 
 logger = logging.getLogger(__name__)
 
+# Retries are owned by the outbox (with backoff), so the engine makes a single attempt
+delivery_engine = DeliveryEngine(max_attempts=1)
+dispatch_pacer = SlotPacer()
+
+SAFETY_TICK_MINUTES = 5
+HORIZON_TOP_UP_MINUTES = 30
+LAG_WINDOW_SIZE = 10_000  # most recent deliveries kept for lag percentiles
+
+
+async def reconcile(tz_name: str) -> dict:
+    """Catch up on every day since the last processed one and log the outcome."""
+    result = await catch_up(now_local(tz_name, DATE_FMT), int(time.time()))
+    logger.info(
+        "Catch-up %s..%s (%d days): %d doses generated, %d marked missed in %.2fs",
+        result["start"], result["end"], result["days"],
+        result["created"], result["missed"], result["elapsed"],
+    )
+    return result
+
 
 async def _generate_daily(tz_name: str) -> None:
-    """Job: generate doses for today."""
+    """Job: generate doses for today (and any day skipped since the last run)."""
     try:
-        tz = pytz.timezone(tz_name)
-        today = datetime.now(tz).strftime("%Y-%m-%d")
-        created = await generate_daily_doses(today)
-        logger.info("Generated %d doses for %s", created, today)
+        await reconcile(tz_name)
     except Exception:
         logger.exception("Error generating daily doses")
 
 
-async def _process_reminders(bot: Bot, tz_name: str) -> None:
-    """Job: send due reminders."""
+async def _top_up_horizon(tz_name: str) -> None:
+    """Job: keep doses generated through the horizon, in small paced chunks."""
     try:
-        tz = pytz.timezone(tz_name)
-        now_str = datetime.now(tz).strftime("%Y-%m-%d %H:%M")
-
-        # Mark missed doses FIRST so they don't trigger reminders
-        await process_missed_doses(now_str)
-
-        due = await get_due_reminders(now_str)
-
-        for dose in due:
-            time_part = dose["scheduled_datetime"].split(" ")[1]
-            dosage = f" ({dose['dosage']})" if dose["dosage"] else ""
-            text = f"💊 Время принять: {dose['medicine_name']}{dosage}\n🕐 {time_part}"
-
-            try:
-                if dose.get("message_id"):
-                    # Delete the old reminder message to prevent clutter
-                    try:
-                        await bot.delete_message(
-                            chat_id=dose["telegram_id"],
-                            message_id=dose["message_id"],
-                        )
-                    except TelegramBadRequest as e:
-                        logger.warning("Could not delete old message %s: %s", dose["message_id"], e)
-                
-                # Send a new reminder message to ensure a sound notification is triggered
-                new_msg = await bot.send_message(
-                    chat_id=dose["telegram_id"],
-                    text=text,
-                    reply_markup=dose_reminder_kb(dose["dose_id"]),
-                )
-                await save_dose_message_id(dose["dose_id"], new_msg.message_id)
+        today = now_local(tz_name, DATE_FMT)
+        created = await top_up_horizon(today)
+        if created:
+            logger.info("Horizon top-up generated %d doses", created)
+    except Exception:
+        logger.exception("Error topping up the generation horizon")
+
+
+async def _send_reminder(bot: Bot, doses: list[dict]) -> int:
+    """Replace the doses' previous reminders with one fresh message.
+
+    A single dose gets the classic reminder, several doses of one chat a
+    digest. Returns the new message id, shared by all of them.
+    """
+    chat_id = doses[0]["telegram_id"]
+    if len(doses) == 1:
+        dose = doses[0]
+        time_part = dose["scheduled_datetime"].split(" ")[1]
+        dosage = f" ({dose['dosage']})" if dose["dosage"] else ""
+        text = f"💊 Время принять: {dose['medicine_name']}{dosage}\n🕐 {time_part[:5]}"
+        markup = dose_reminder_kb(dose["dose_id"])
+    else:
+        text = digest_text(doses)
+        markup = digest_kb(doses)
+
+    # Delete the old reminder messages (a digest once) to prevent clutter
+    for message_id in dict.fromkeys(d["message_id"] for d in doses if d.get("message_id")):
+        try:
+            await bot.delete_message(chat_id=chat_id, message_id=message_id)
+        except TelegramBadRequest as e:
+            logger.warning("Could not delete old message %s: %s", message_id, e)
+
+    # Send a new reminder message to ensure a sound notification is triggered
+    new_msg = await bot.send_message(chat_id=chat_id, text=text, reply_markup=markup)
+    sent_at = time.time()
+    for dose in doses:
+        dose["sent_at"] = sent_at
+    return new_msg.message_id
+
+
+def percentile(values: list[float], q: float) -> float:
+    """Nearest-rank percentile (``q`` in 0..100) of already sorted ``values``."""
+    if not values:
+        return 0.0
+    rank = max(math.ceil(q / 100 * len(values)), 1)
+    return values[rank - 1]
+
+
+class LagWindow:
+    """Delivery lags (seconds) of the most recent reminders."""
+
+    def __init__(self, size: int = LAG_WINDOW_SIZE) -> None:
+        self._lags: deque[float] = deque(maxlen=size)
+
+    def __len__(self) -> int:
+        return len(self._lags)
+
+    def extend(self, lags: Iterable[float]) -> None:
+        self._lags.extend(lags)
+
+    def percentiles(self) -> tuple[float, float]:
+        """(p50, p99) of the window."""
+        ordered = sorted(self._lags)
+        return percentile(ordered, 50), percentile(ordered, 99)
+
+
+# Rolling delivery lag per priority label ("first", "repeat", "snooze")
+delivery_lag = {priority.label: LagWindow() for priority in ReminderPriority}
+
+
+@dataclass
+class TickReport:
+    """Timing and counters of one reminder tick."""
+
+    trigger: str
+    scheduled_for: float | None
+    started_at: float
+    stages: dict[str, float] = field(default_factory=dict)
+    missed: int = 0
+    unanswered: int = 0
+    recovered: int = 0
+    enqueued: int = 0
+    sent: int = 0
+    failed: int = 0
+    deactivated: int = 0
+    deferred: int = 0  # most rows left over for a later slot at once
+    depth: dict[str, int] = field(default_factory=dict)
+    lags: dict[str, list[float]] = field(default_factory=dict)
+
+    @property
+    def lateness(self) -> float | None:
+        """Seconds between the scheduled and the actual start of the tick."""
+        if self.scheduled_for is None:
+            return None
+        return max(self.started_at - self.scheduled_for, 0.0)
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """Accumulate wall time spent in ``name`` (stages may repeat per batch)."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - started
+
+    def lag_percentiles(self, priority: str) -> tuple[float, float]:
+        """(p50, p99) delivery lag of this tick's reminders of ``priority``."""
+        ordered = sorted(self.lags.get(priority, []))
+        return percentile(ordered, 50), percentile(ordered, 99)
+
+    def summary(self) -> str:
+        stages = ", ".join(f"{name}={secs * 1000:.0f}ms" for name, secs in self.stages.items())
+        lateness = f"{self.lateness:.2f}s" if self.lateness is not None else "n/a"
+        depth = "/".join(str(self.depth.get(p.label, 0)) for p in ReminderPriority)
+        lag = ""
+        for priority in self.lags:
+            p50, p99 = self.lag_percentiles(priority)
+            w50, w99 = delivery_lag[priority].percentiles()
+            lag += (
+                f" lag[{priority}] p50={p50:.1f}s p99={p99:.1f}s"
+                f" (last {len(delivery_lag[priority])}: p50={w50:.1f}s p99={w99:.1f}s)"
+            )
+        return (
+            f"tick[{self.trigger}] late={lateness} missed={self.missed} "
+            f"unanswered={self.unanswered} recovered={self.recovered} "
+            f"enqueued={self.enqueued} depth={depth} "
+            f"sent={self.sent} failed={self.failed} deactivated={self.deactivated} "
+            f"deferred={self.deferred}{lag} ({stages})"
+        )
+
+
+_tick_lock = asyncio.Lock()
+last_tick: TickReport | None = None
+
 
-                await mark_reminder_sent(dose["dose_id"], dose["interval_minutes"])
-            except Exception:
-                logger.exception(
-                    "Failed to send reminder for dose %d", dose["dose_id"]
+def _chat_unreachable(error: BaseException | None) -> bool:
+    """Whether a send failed for good: the user blocked the bot or the chat is gone."""
+    if isinstance(error, TelegramForbiddenError):
+        return True
+    return isinstance(error, TelegramBadRequest) and "chat not found" in str(error).lower()
+
+
+async def _deliver_batch(bot: Bot, batch: list[dict], now_ts: int, report: TickReport) -> None:
+    """Send claimed outbox rows and record the outcome.
+
+    In digest mode the rows of one chat become a single message. Users of
+    unreachable chats are deactivated rather than retried.
+    """
+    groups: dict[int, list[dict]] = {}
+    for dose in batch:
+        key = dose["telegram_id"] if DIGEST_MODE else dose["outbox_id"]
+        groups.setdefault(key, []).append(dose)
+    jobs = [
+        DeliveryJob(
+            chat_id=doses[0]["telegram_id"],
+            send=functools.partial(_send_reminder, bot, doses),
+            key=doses,
+        )
+        for doses in groups.values()
+    ]
+    with report.stage("dispatch"):
+        stats = await delivery_engine.deliver(jobs)
+    report.sent += stats.sent
+    report.failed += stats.failed
+    logger.debug(
+        "Reminders: %d queued, %d sent, %d failed in %.2fs (%.1f msg/s, max depth %d)",
+        stats.queued, stats.sent, stats.failed,
+        stats.elapsed, stats.throughput, stats.max_queue_depth,
+    )
+
+    with report.stage("bookkeeping"):
+        sent = []
+        failed = []
+        unreachable: dict[int, str] = {}
+        lags: dict[str, list[float]] = {}
+        for result in stats.results:
+            for dose in result.job.key:
+                if result.ok:
+                    sent.append(
+                        (dose["outbox_id"], dose["dose_id"], result.result, dose["interval_minutes"])
+                    )
+                    lags.setdefault(dose["priority"], []).append(
+                        max(dose["sent_at"] - dose["nominal_at"], 0.0)
+                    )
+                elif _chat_unreachable(result.error):
+                    unreachable[dose["telegram_id"]] = str(result.error)
+                else:
+                    failed.append((dose, result.error))
+        await complete_deliveries(sent)
+        for priority, values in lags.items():
+            report.lags.setdefault(priority, []).extend(values)
+            delivery_lag[priority].extend(values)
+
+        for chat_id, error in unreachable.items():
+            deactivated = await deactivate_chats([chat_id], error)
+            report.deactivated += deactivated
+            if deactivated:
+                logger.info("Chat %s is unreachable (%s): user marked inactive", chat_id, error)
+
+        for dose, error in failed:
+            retry_after = error.retry_after if isinstance(error, TelegramRetryAfter) else None
+            retry_at = await fail_delivery(
+                dose["outbox_id"], dose["dose_id"], str(error), now_ts, retry_after
+            )
+            logger.warning(
+                "Failed to send reminder for dose %d (attempt %d): %s%s",
+                dose["dose_id"], dose["attempts"], error,
+                "" if retry_at else " — giving up",
+            )
+
+
+async def _dispatch_outbox(bot: Bot, now_ts: int, report: TickReport) -> None:
+    """Send ready outbox rows in paced slots, highest priority first.
+
+    Each slot claims the pacer's capacity for the current queue depth and
+    defers the overflow to the next slot; reminders that fall due in the
+    meantime are enqueued and take their place by priority.
+    """
+    dispatch_pacer.start_slot()
+    while True:
+        with report.stage("select"):
+            depth = await outbox_depth(now_ts)
+            total = sum(depth.values())
+            if not report.depth:
+                report.depth = depth
+            if not total:
+                return
+            capacity = dispatch_pacer.capacity(total)
+            batch = await claim_deliveries(now_ts, limit=capacity)
+        if batch:
+            await _deliver_batch(bot, batch, now_ts, report)
+        if len(batch) >= total:
+            return
+        if len(batch) < capacity:
+            continue  # some rows were cancelled rather than claimed
+
+        # Slot full: the overflow waits for the next one (counted once, at its peak)
+        report.deferred = max(report.deferred, total - len(batch))
+        await dispatch_pacer.next_slot()
+        now_ts = int(time.time())
+        with report.stage("select"):
+            report.enqueued += await enqueue_due_reminders(now_ts)
+
+
+async def run_tick(
+    bot: Bot,
+    scheduled_for: float | None = None,
+    trigger: str = "due",
+    skip_if_running: bool = False,
+) -> TickReport | None:
+    """Run one reminder pipeline: rollover → select → dispatch → bookkeeping.
+
+    Ticks never overlap: a due-driven tick waits for the running one, while
+    a safety-net tick (``skip_if_running``) is coalesced into it and skipped.
+    Returns the tick's report, or None if it was skipped.
+    """
+    global last_tick
+    if skip_if_running and _tick_lock.locked():
+        logger.debug("Skipping %s tick: previous tick still running", trigger)
+        return None
+
+    async with _tick_lock:
+        report = TickReport(trigger=trigger, scheduled_for=scheduled_for, started_at=time.time())
+        try:
+            now_ts = int(report.started_at)
+
+            # Mark missed doses FIRST so they don't trigger reminders
+            with report.stage("rollover"):
+                report.missed = await process_missed_doses(now_ts)
+                report.unanswered = await process_unanswered_doses(now_ts)
+                report.recovered = await recover_stale_deliveries(now_ts)
+            if report.recovered:
+                logger.warning(
+                    "Resolved %d interrupted deliveries without resending", report.recovered
                 )
-    except Exception:
-        logger.exception("Error processing reminders")
 
+            with report.stage("select"):
+                report.enqueued = await enqueue_due_reminders(now_ts)
+            await _dispatch_outbox(bot, now_ts, report)
+        except Exception:
+            logger.exception("Error processing reminders")
+
+        last_tick = report
+        if report.missed or report.unanswered or report.enqueued or report.sent or report.failed:
+            logger.info(report.summary())
+        else:
+            logger.debug(report.summary())
+        return report
+
+
+async def _safety_tick(bot: Bot) -> None:
+    """Job: periodic tick catching rollovers and anything the due queue missed."""
+    # The cron trigger fires on wall-clock multiples of SAFETY_TICK_MINUTES
+    now = time.time()
+    scheduled_for = now - now % (SAFETY_TICK_MINUTES * 60)
+    await run_tick(bot, scheduled_for, trigger="safety", skip_if_running=True)
 
-async def _process_missed(tz_name: str) -> None:
-    """Job: mark overdue doses as missed."""
-    try:
-        tz = pytz.timezone(tz_name)
-        now_str = datetime.now(tz).strftime("%Y-%m-%d %H:%M")
-        count = await process_missed_doses(now_str)
-        if count:
-            logger.info("Marked %d doses as missed", count)
-    except Exception:
-        logger.exception("Error processing missed doses")
+
+def _on_job_event(event: JobEvent) -> None:
+    if event.code == EVENT_JOB_MISSED:
+        logger.warning("Job %s missed its run at %s", event.job_id, event.scheduled_run_time)
+    elif event.code == EVENT_JOB_MAX_INSTANCES:
+        logger.warning("Job %s skipped: previous run still in progress", event.job_id)
 
 
 def setup_scheduler(bot: Bot) -> AsyncIOScheduler:
-    """Create and configure the scheduler with all periodic jobs."""
-    tz = pytz.timezone(settings.timezone)
-    scheduler = AsyncIOScheduler(timezone=tz)
+    """Create and configure the scheduler with all periodic jobs.
+
+    Every job runs at most one instance at a time and coalesces a backlog
+    of missed runs into one; runs later than the grace period are dropped
+    (the next run catches up).
+    """
+    scheduler = AsyncIOScheduler(
+        timezone=get_tz(settings.timezone),
+        job_defaults={"coalesce": True, "max_instances": 1, "misfire_grace_time": 60},
+    )
+    scheduler.add_listener(_on_job_event, EVENT_JOB_MISSED | EVENT_JOB_MAX_INSTANCES)
 
-    # Generate daily doses at 00:01
+    # Missed-day catch-up and rollover bookkeeping at 00:01; with the rolling
+    # horizon the day's doses already exist, so this is a small write
     scheduler.add_job(
         _generate_daily,
         "cron",
@@ -105,26 +415,41 @@ def setup_scheduler(bot: Bot) -> AsyncIOScheduler:
         args=[settings.timezone],
         id="generate_daily_doses",
         replace_existing=True,
+        misfire_grace_time=3600,
     )
 
-    # Process due reminders every 60 seconds
+    # Low-priority top-up of the rolling generation horizon
     scheduler.add_job(
-        _process_reminders,
+        _top_up_horizon,
         "interval",
-        seconds=60,
-        args=[bot, settings.timezone],
-        id="process_reminders",
+        minutes=HORIZON_TOP_UP_MINUTES,
+        jitter=60,
+        args=[settings.timezone],
+        id="top_up_horizon",
         replace_existing=True,
     )
 
-    # Process missed doses every 60 seconds
+    # Safety-net tick: missed-dose rollover and reminders the due queue did not wake for
     scheduler.add_job(
-        _process_missed,
-        "interval",
-        seconds=60,
-        args=[settings.timezone],
-        id="process_missed",
+        _safety_tick,
+        "cron",
+        minute=f"*/{SAFETY_TICK_MINUTES}",
+        args=[bot],
+        id="reminder_tick",
         replace_existing=True,
     )
 
     return scheduler
+
+
+def setup_reminder_engine(bot: Bot) -> ReminderEngine:
+    """Create the engine that runs a tick as soon as a reminder falls due.
+
+    Due doses are still selected from the DB by the tick, so the queue only
+    decides *when* to look; the DB stays the source of truth.
+    """
+
+    async def on_due(dose_ids: list[int], deadline: int) -> None:
+        await run_tick(bot, scheduled_for=deadline, trigger="due")
+
+    return ReminderEngine(due_queue, on_due=on_due, reload=get_pending_reminders)
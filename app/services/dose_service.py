@@ -1,248 +1,668 @@
-"""Service layer for dose management: generation, reminders, state transitions."""
+"""Service layer for dose management: generation, reminders, state transitions.
+
+Instants ("now", snooze targets) are passed in as UTC epoch seconds and days
+as local ``YYYY-MM-DD`` dates, so every query filters on integer columns
+(``scheduled_at``, ``next_reminder_at``, ``day_end_at``) or the local
+``dose_date`` with plain, index-friendly predicates.
+"""
 
 from __future__ import annotations
 
+import asyncio
+import functools
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
 from datetime import datetime, timedelta
 from typing import Any
 
-from app.db import get_db
+import aiosqlite
+
+from app.config import settings
+from app.db import DoseStatus, OutboxState, acquire, get_state, set_state, write
+from app.due_queue import due_queue
+from app.services.settings_service import DEFAULT_MAX_REMINDERS
+from app.timeutils import DATE_FMT, REMINDER_JITTER_SECONDS
+
+# Schedules per INSERT … SELECT batch in generate_doses
+GENERATION_CHUNK_SIZE = 500
+
+# Doses are kept generated this many days past today, topped up in the background
+GENERATION_HORIZON_DAYS = int(os.getenv("GENERATION_HORIZON_DAYS", "2"))
+HORIZON_CHUNK_SIZE = 100
+HORIZON_CHUNK_PAUSE = 0.05  # seconds between top-up chunks, leaves room for user writes
+
+# app_state key of the last local date catch_up() has processed
+LAST_PROCESSED_KEY = "last_processed_date"
+
+# Allowed state transitions: action → (statuses it may start from, new status).
+# Every transition is a single conditional UPDATE, so a double-tapped button
+# racing the reminder tick can apply at most once.
+ALLOWED_TRANSITIONS: dict[str, tuple[frozenset[DoseStatus], DoseStatus]] = {
+    "take": (
+        frozenset({
+            DoseStatus.SCHEDULED, DoseStatus.MISSED, DoseStatus.SKIPPED, DoseStatus.UNANSWERED,
+        }),
+        DoseStatus.TAKEN,
+    ),
+    "skip": (
+        frozenset({
+            DoseStatus.SCHEDULED, DoseStatus.MISSED, DoseStatus.TAKEN, DoseStatus.UNANSWERED,
+        }),
+        DoseStatus.SKIPPED,
+    ),
+    "snooze": (
+        frozenset({DoseStatus.SCHEDULED, DoseStatus.MISSED, DoseStatus.UNANSWERED}),
+        DoseStatus.SCHEDULED,
+    ),
+    "reset": (
+        frozenset({
+            DoseStatus.TAKEN, DoseStatus.MISSED, DoseStatus.SKIPPED, DoseStatus.UNANSWERED,
+        }),
+        DoseStatus.SCHEDULED,
+    ),
+    "miss": (frozenset({DoseStatus.SCHEDULED}), DoseStatus.MISSED),
+    "give_up": (frozenset({DoseStatus.SCHEDULED}), DoseStatus.UNANSWERED),
+}
+
+
+def under_reminder_cap(dose: str = "d", user_id: str = "m.user_id") -> str:
+    """SQL predicate: the dose is still under its owner's reminder cap.
+
+    A snooze always gets its reminder. ``dose`` is the doses alias and
+    ``user_id`` an expression for the owner's id; the enclosing statement
+    binds ``:max_reminders`` (the default cap).
+    """
+    return f"""({dose}.snoozed = 1 OR {dose}.reminder_count < COALESCE(
+        (SELECT us.max_reminders FROM user_settings us WHERE us.user_id = {user_id}),
+        :max_reminders))"""
 
 
-async def generate_daily_doses(date_str: str) -> int:
-    """Generate dose entries for a given date (YYYY-MM-DD).
+def owner_is_active(user_id: str = "m.user_id") -> str:
+    """SQL predicate: the owner (``user_id`` expression) has not blocked the bot.
 
-    Creates one dose per schedule entry, skips if already exists.
-    Returns the number of doses created.
+    Inactive users are few, so the subquery is read once from the partial
+    index ``idx_users_inactive``.
     """
-    db = await get_db()
-    try:
-        cursor = await db.execute(
-            "SELECT id, medicine_id, time FROM schedules"
-        )
-        schedules = await cursor.fetchall()
-
-        created = 0
-        for sch in schedules:
-            schedule_id = sch[0]
-            medicine_id = sch[1]
-            time_str = sch[2]
-            scheduled_dt = f"{date_str} {time_str}"
-
-            # Check for duplicate per schedule entry per day
-            dup = await db.execute(
-                """
-                SELECT id FROM doses
-                WHERE schedule_id = ? AND scheduled_datetime LIKE ?
-                """,
-                (schedule_id, f"{date_str}%"),
-            )
-            if await dup.fetchone():
-                continue
-
-            await db.execute(
-                """
-                INSERT INTO doses (medicine_id, schedule_id, scheduled_datetime, status, reminder_sent, reminder_count, next_reminder_at)
-                VALUES (?, ?, ?, 'scheduled', 0, 0, ?)
-                """,
-                (medicine_id, schedule_id, scheduled_dt, scheduled_dt),
-            )
-            created += 1
+    return f"{user_id} NOT IN (SELECT id FROM users WHERE active = 0)"
+
 
-        await db.commit()
-        return created
-    finally:
-        await db.close()
+# Owner of the current row in statements on ``doses`` without a join
+_DOSE_OWNER = "(SELECT user_id FROM medicines WHERE id = doses.medicine_id)"
 
 
-async def get_due_reminders(now_str: str) -> list[dict[str, Any]]:
-    """Find doses that are due for a reminder.
+# Columns returned by a transition: _dose_row order, then next_reminder_at,
+# the owner's telegram_id and dose_date (to patch the today cache)
+_RETURNING_DOSE = """
+    RETURNING id,
+        (SELECT name FROM medicines WHERE id = doses.medicine_id),
+        (SELECT dosage FROM medicines WHERE id = doses.medicine_id),
+        scheduled_datetime, status, taken_at,
+        COALESCE(next_reminder_at, scheduled_at),
+        (SELECT u.telegram_id FROM medicines m JOIN users u ON m.user_id = u.id
+         WHERE m.id = doses.medicine_id),
+        dose_date
+"""
 
-    Sends reminders indefinitely (until end of day) until user reacts.
-    Uses next_reminder_at to determine when to send the next reminder.
+# Users whose "today" view is kept in memory (LRU)
+TODAY_CACHE_SIZE = 10_000
+
+
+@dataclass
+class TodayEntry:
+    """Cached doses of one user's local day.
+
+    ``rendered`` belongs to the handlers (text and markup built from
+    ``doses``); it is reset whenever ``doses`` is patched.
     """
-    db = await get_db()
-    try:
+
+    date: str
+    doses: list[dict[str, Any]]
+    rendered: Any = None
+
+
+_today_cache: OrderedDict[int, TodayEntry] = OrderedDict()
+# Bumped on every patch/invalidation so a load racing a write is not cached
+_today_epoch = 0
+
+
+def invalidate_today(telegram_id: int | None = None) -> None:
+    """Forget a user's cached day, or everyone's if ``telegram_id`` is None."""
+    global _today_epoch
+    _today_epoch += 1
+    if telegram_id is None:
+        _today_cache.clear()
+    else:
+        _today_cache.pop(telegram_id, None)
+
+
+def _invalidate_today_dates(start_date: str, end_date: str) -> None:
+    """Forget cached days within [start_date, end_date] (after generation)."""
+    global _today_epoch
+    _today_epoch += 1
+    for telegram_id in [
+        tid for tid, entry in _today_cache.items() if start_date <= entry.date <= end_date
+    ]:
+        del _today_cache[telegram_id]
+
+
+def horizon_end(date_str: str, days: int = GENERATION_HORIZON_DAYS) -> str:
+    """Last day of the generation horizon starting at ``date_str``."""
+    return (datetime.strptime(date_str, DATE_FMT) + timedelta(days=days)).strftime(DATE_FMT)
+
+
+def _patch_today(telegram_id: int, date_str: str, dose: dict[str, Any]) -> None:
+    """Apply a transitioned dose to the owner's cached day, if cached."""
+    global _today_epoch
+    _today_epoch += 1
+    entry = _today_cache.get(telegram_id)
+    if entry is None or entry.date != date_str:
+        return
+    for i, cached in enumerate(entry.doses):
+        if cached["dose_id"] == dose["dose_id"]:
+            entry.doses[i] = {**cached, "status": dose["status"], "taken_at": dose["taken_at"]}
+            entry.rendered = None
+            return
+    # Not part of the cached view (shouldn't happen) — reload next time
+    _today_cache.pop(telegram_id, None)
+
+
+def _dose_row(r: aiosqlite.Row) -> dict[str, Any]:
+    """Map (id, name, dosage, scheduled_datetime, status, taken_at) to a dict."""
+    return {
+        "dose_id": r[0],
+        "medicine_name": r[1],
+        "dosage": r[2],
+        "scheduled_datetime": r[3],
+        "status": DoseStatus(r[4]).label,
+        "taken_at": r[5],
+    }
+
+
+def _schedule_filter(
+    user_id: int | None, medicine_id: int | None, schedule_id: int | None
+) -> str:
+    """SQL predicate on ``schedules s`` for the optional generation scope."""
+    clauses = []
+    if user_id is not None:
+        clauses.append("s.medicine_id IN (SELECT id FROM medicines WHERE user_id = :user_id)")
+    if medicine_id is not None:
+        clauses.append("s.medicine_id = :medicine_id")
+    if schedule_id is not None:
+        clauses.append("s.id = :schedule_id")
+    return "".join(f" AND {c}" for c in clauses)
+
+
+async def insert_doses(
+    db: aiosqlite.Connection,
+    start_date: str,
+    end_date: str | None = None,
+    *,
+    user_id: int | None = None,
+    medicine_id: int | None = None,
+    schedule_id: int | None = None,
+    after_id: int = 0,
+    last_id: int | None = None,
+    backfill: bool = False,
+) -> int:
+    """Insert missing doses for every day in [start_date, end_date] on ``db``.
+
+    Runs inside the caller's write operation, so it can share a transaction
+    with e.g. ``add_medicine``. Scope is narrowed by the optional user
+    (internal id), medicine, schedule and ``(after_id, last_id]`` schedule-id
+    window. Dates are local to each schedule's owner, and the first
+    reminder is offset by the owner's :func:`user_jitter`. With ``backfill``
+    (catching up past days), days before a medicine was added are skipped.
+    Users who blocked the bot get no new doses.
+    Returns the number of rows created.
+    """
+    params = {
+        "start": start_date,
+        "end": end_date or start_date,
+        "tz": settings.timezone,
+        "jitter": REMINDER_JITTER_SECONDS,
+        "status": DoseStatus.SCHEDULED,
+        "user_id": user_id,
+        "medicine_id": medicine_id,
+        "schedule_id": schedule_id,
+        "after_id": after_id,
+        "last_id": last_id,
+    }
+    id_window = " AND s.id > :after_id"
+    if last_id is not None:
+        id_window += " AND s.id <= :last_id"
+    # Never backfill days that ended before the medicine was added
+    backfill_guard = (
+        " AND local_to_epoch(days.day || ' 23:59', s.tz)"
+        " >= CAST(strftime('%s', s.created_at) AS INTEGER)"
+        if backfill
+        else ""
+    )
+    # Each schedule is generated in its owner's zone: days are the owner's
+    # local dates, and the UTC instants are computed once, here. Existing
+    # (schedule, day) rows are skipped through uq_doses_schedule_date before
+    # any UDF runs, so a horizon top-up only pays for the new days.
+    cursor = await db.execute(
+        f"""
+        INSERT INTO doses (medicine_id, schedule_id, scheduled_datetime, scheduled_at,
+                           dose_date, day_end_at, status, reminder_sent, reminder_count,
+                           next_reminder_at)
+        WITH RECURSIVE days(day) AS (
+            SELECT :start
+            UNION ALL
+            SELECT date(day, '+1 day') FROM days WHERE day < :end
+        ),
+        sched AS (
+            SELECT s.id, s.medicine_id, s.time, m.created_at, m.user_id,
+                   COALESCE(u.timezone, :tz) AS tz
+            FROM schedules s
+            JOIN medicines m ON m.id = s.medicine_id
+            JOIN users u ON u.id = m.user_id
+            WHERE {owner_is_active()}{id_window}{_schedule_filter(user_id, medicine_id, schedule_id)}
+        )
+        SELECT s.medicine_id, s.id, days.day || ' ' || s.time,
+               local_to_epoch(days.day || ' ' || s.time, s.tz),
+               days.day,
+               local_to_epoch(date(days.day, '+1 day') || ' 00:00', s.tz),
+               :status, 0, 0,
+               local_to_epoch(days.day || ' ' || s.time, s.tz)
+                   + user_jitter(s.user_id, :jitter)
+        FROM sched s CROSS JOIN days
+        WHERE NOT EXISTS (
+            SELECT 1 FROM doses WHERE schedule_id = s.id AND dose_date = days.day
+        ){backfill_guard}
+        ON CONFLICT (schedule_id, dose_date) DO NOTHING
+        """,
+        params,
+    )
+    return cursor.rowcount
+
+
+async def generate_doses(
+    start_date: str,
+    end_date: str | None = None,
+    *,
+    user_id: int | None = None,
+    medicine_id: int | None = None,
+    schedule_id: int | None = None,
+    chunk_size: int = GENERATION_CHUNK_SIZE,
+    backfill: bool = False,
+    pause: float = 0.0,
+) -> int:
+    """Generate doses for [start_date, end_date], optionally scoped.
+
+    Uses a set-based ``INSERT … SELECT … ON CONFLICT DO NOTHING``; the
+    UNIQUE (schedule_id, dose_date) index makes it idempotent, even when runs
+    overlap. Matching schedules are processed in id-ordered chunks, each in
+    its own write, so the writer is released between batches; ``pause``
+    sleeps between chunks for low-priority background runs.
+    Returns the number of doses created.
+    """
+    scope = _schedule_filter(user_id, medicine_id, schedule_id)
+
+    async def op(db: aiosqlite.Connection, after_id: int) -> tuple[int, int | None]:
         cursor = await db.execute(
-            """
-            SELECT d.id, d.medicine_id, d.scheduled_datetime,
-                   m.name, m.dosage, u.telegram_id,
-                   d.reminder_count, d.message_id,
-                   COALESCE(us.reminder_interval_minutes, 5) as interval_min
-            FROM doses d
-            JOIN medicines m ON d.medicine_id = m.id
-            JOIN users u ON m.user_id = u.id
-            LEFT JOIN user_settings us ON us.user_id = u.id
-            WHERE d.status = 'scheduled'
-              AND COALESCE(d.next_reminder_at, d.scheduled_datetime) <= ?
-              AND DATE(d.scheduled_datetime) = DATE(?)
+            f"""
+            SELECT MAX(id) FROM (
+                SELECT s.id FROM schedules s
+                WHERE s.id > :after_id{scope}
+                ORDER BY s.id LIMIT :limit
+            )
             """,
-            (now_str, now_str),
-        )
-        rows = await cursor.fetchall()
-        return [
             {
-                "dose_id": r[0],
-                "medicine_id": r[1],
-                "scheduled_datetime": r[2],
-                "medicine_name": r[3],
-                "dosage": r[4],
-                "telegram_id": r[5],
-                "reminder_count": r[6],
-                "message_id": r[7],
-                "interval_minutes": r[8],
-            }
-            for r in rows
-        ]
-    finally:
-        await db.close()
-
-async def save_dose_message_id(dose_id: int, message_id: int) -> None:
-    """Save the telegram message ID associated with a dose reminder."""
-    db = await get_db()
-    try:
-        await db.execute(
-            "UPDATE doses SET message_id = ? WHERE id = ?",
-            (message_id, dose_id),
+                "after_id": after_id,
+                "limit": chunk_size,
+                "user_id": user_id,
+                "medicine_id": medicine_id,
+                "schedule_id": schedule_id,
+            },
+        )
+        last_id = (await cursor.fetchone())[0]
+        if last_id is None:
+            return 0, None
+        created = await insert_doses(
+            db,
+            start_date,
+            end_date,
+            user_id=user_id,
+            medicine_id=medicine_id,
+            schedule_id=schedule_id,
+            after_id=after_id,
+            last_id=last_id,
+            backfill=backfill,
         )
-        await db.commit()
-    finally:
-        await db.close()
+        return created, last_id
 
+    created = 0
+    after_id: int | None = 0
+    while after_id is not None:
+        count, after_id = await write(functools.partial(op, after_id=after_id))
+        created += count
+        if pause and after_id is not None:
+            await asyncio.sleep(pause)
+    if created:
+        due_queue.request_reload()
+        _invalidate_today_dates(start_date, end_date or start_date)
+    return created
 
-async def mark_reminder_sent(dose_id: int, interval_minutes: int) -> None:
-    """Increment reminder_count and schedule next reminder."""
-    db = await get_db()
-    try:
-        cursor = await db.execute(
-            "SELECT next_reminder_at, scheduled_datetime FROM doses WHERE id = ?",
-            (dose_id,),
-        )
-        row = await cursor.fetchone()
-        if not row:
-            return
 
-        current_time = row[0] or row[1]
-        current_dt = datetime.strptime(current_time, "%Y-%m-%d %H:%M")
-        next_dt = current_dt + timedelta(minutes=interval_minutes)
-        next_str = next_dt.strftime("%Y-%m-%d %H:%M")
+async def generate_daily_doses(date_str: str, chunk_size: int = GENERATION_CHUNK_SIZE) -> int:
+    """Generate dose entries for every schedule for a given date (YYYY-MM-DD).
 
-        await db.execute(
-            """
-            UPDATE doses
-            SET reminder_count = reminder_count + 1,
-                next_reminder_at = ?
-            WHERE id = ?
-            """,
-            (next_str, dose_id),
-        )
-        await db.commit()
-    finally:
-        await db.close()
+    Returns the number of doses created.
+    """
+    return await generate_doses(date_str, chunk_size=chunk_size)
 
 
-async def mark_taken(dose_id: int, taken_at: str) -> bool:
-    """Mark a dose as taken. Returns False if state transition is forbidden."""
-    db = await get_db()
-    try:
+async def top_up_horizon(today: str) -> int:
+    """Keep doses generated from ``today`` through the horizon.
+
+    Runs as a low-priority background job in small, paced chunks, so the
+    day's inserts are spread out instead of landing in one midnight burst.
+    Returns the number of doses created.
+    """
+    return await generate_doses(
+        today,
+        horizon_end(today),
+        chunk_size=HORIZON_CHUNK_SIZE,
+        pause=HORIZON_CHUNK_PAUSE,
+    )
+
+
+async def catch_up(today: str, now_ts: int) -> dict[str, Any]:
+    """Reconcile the downtime window since the last processed day.
+
+    Generates doses for every day from the last processed date through
+    the horizon in one set-based pass, marks the past ones (as of the UTC
+    instant ``now_ts``) missed and records ``today`` (YYYY-MM-DD) as
+    processed. Run at startup (before polling) and by the daily job.
+    Returns the window, row counts and elapsed seconds.
+    """
+    started = time.perf_counter()
+    last = await get_state(LAST_PROCESSED_KEY)
+    # On a fresh database there is no history to reconstruct
+    start = min(last, today) if last else today
+
+    created = await generate_doses(start, horizon_end(today), backfill=True)
+    missed = await process_missed_doses(now_ts)
+    await set_state(LAST_PROCESSED_KEY, today)
+
+    days = (datetime.strptime(today, DATE_FMT) - datetime.strptime(start, DATE_FMT)).days + 1
+    return {
+        "start": start,
+        "end": today,
+        "days": days,
+        "created": created,
+        "missed": missed,
+        "elapsed": time.perf_counter() - started,
+    }
+
+
+async def get_pending_reminders(until_ts: int) -> list[tuple[int, int]]:
+    """Return (dose_id, wake-up epoch) for reminders due by ``until_ts``.
+
+    Covers scheduled doses of active users and outbox rows waiting for a
+    retry. Used to (re)load the in-memory due queue.
+    """
+    async with acquire() as db:
         cursor = await db.execute(
-            "SELECT status FROM doses WHERE id = ?", (dose_id,)
+            f"""
+            SELECT id, next_reminder_at FROM doses
+            WHERE status = ? AND next_reminder_at <= ? AND {owner_is_active(_DOSE_OWNER)}
+            UNION ALL
+            SELECT dose_id, available_at FROM outbox
+            WHERE state = ? AND available_at <= ?
+            """,
+            (DoseStatus.SCHEDULED, until_ts, OutboxState.PENDING, until_ts),
         )
-        row = await cursor.fetchone()
-        if not row:
-            return False
+        return [(r[0], r[1]) for r in await cursor.fetchall()]
 
-        await db.execute(
-            "UPDATE doses SET status = 'taken', taken_at = ? WHERE id = ?",
-            (taken_at, dose_id),
-        )
-        await db.commit()
-        return True
-    finally:
-        await db.close()
+
+_REMINDER_SENT_SQL = """
+    UPDATE doses
+    SET message_id = COALESCE(?, message_id),
+        reminder_count = reminder_count + 1,
+        snoozed = 0,
+        next_reminder_at = COALESCE(next_reminder_at, scheduled_at) + 60 * ?
+    WHERE id = ? AND status = ?
+"""
 
 
-async def snooze(dose_id: int, interval_minutes: int, now_str: str) -> tuple[bool, int]:
-    """Snooze a dose by scheduling next reminder at now + interval_minutes.
+async def apply_reminders_sent(
+    db: aiosqlite.Connection, sent: list[tuple[int, int | None, int]]
+) -> list[tuple[int, int]]:
+    """Record sent reminders on ``db`` in one ``executemany``.
 
-    Returns (success, interval_used).
+    ``sent`` holds (dose_id, message_id, interval_minutes) tuples; a None
+    message id keeps the stored one. The next reminder time is computed in
+    SQL. Returns (dose_id, next_reminder_at) for doses still scheduled.
+    """
+    if not sent:
+        return []
+    await db.executemany(
+        _REMINDER_SENT_SQL,
+        [
+            (message_id, interval, dose_id, DoseStatus.SCHEDULED)
+            for dose_id, message_id, interval in sent
+        ],
+    )
+    dose_ids = [dose_id for dose_id, _, _ in sent]
+    placeholders = ",".join("?" * len(dose_ids))
+    cursor = await db.execute(
+        f"SELECT id, next_reminder_at FROM doses WHERE status = ? AND id IN ({placeholders})",
+        (DoseStatus.SCHEDULED, *dose_ids),
+    )
+    return [(r[0], r[1]) for r in await cursor.fetchall()]
+
+
+def _allowed_from(action: str) -> str:
+    """SQL list of the statuses ``action`` may start from."""
+    sources, _ = ALLOWED_TRANSITIONS[action]
+    return ", ".join(str(int(status)) for status in sorted(sources))
+
+
+async def _transition(
+    dose_id: int,
+    action: str,
+    *,
+    expressions: dict[str, str] | None = None,
+    **changes: Any,
+) -> dict[str, Any] | None:
+    """Apply ``action`` to a dose as one compare-and-set UPDATE … RETURNING.
+
+    ``changes`` are extra columns to set alongside the status; a column in
+    ``expressions`` is set to that SQL instead of its bound value (e.g.
+    ``MAX(scheduled_at, :next_reminder_at)``). Returns the
+    updated dose (see :func:`_dose_row`, plus ``next_reminder_at``), or None
+    if the dose does not exist or its current status does not allow the
+    action.
+    """
+    _, target = ALLOWED_TRANSITIONS[action]
+    expressions = expressions or {}
+    assignments = "".join(
+        f", {column} = {expressions.get(column, ':' + column)}" for column in changes
+    )
+    sql = f"""
+        UPDATE doses
+        SET status = :target{assignments}
+        WHERE id = :dose_id AND status IN ({_allowed_from(action)})
+        {_RETURNING_DOSE}
     """
-    db = await get_db()
-    try:
-        cursor = await db.execute(
-            "SELECT status FROM doses WHERE id = ?",
-            (dose_id,),
-        )
-        row = await cursor.fetchone()
-        if not row or row[0] not in ("scheduled", "missed"):
-            return False, 0
 
-        now_dt = datetime.strptime(now_str, "%Y-%m-%d %H:%M")
-        next_dt = now_dt + timedelta(minutes=interval_minutes)
-        next_dt_str = next_dt.strftime("%Y-%m-%d %H:%M")
+    async def op(db: aiosqlite.Connection) -> aiosqlite.Row | None:
+        cursor = await db.execute(sql, {"target": target, "dose_id": dose_id, **changes})
+        return await cursor.fetchone()
 
-        await db.execute(
-            """
-            UPDATE doses
-            SET status = 'scheduled', reminder_sent = 0,
-                next_reminder_at = ?
-            WHERE id = ?
-            """,
-            (next_dt_str, dose_id),
-        )
-        await db.commit()
-        return True, interval_minutes
-    finally:
-        await db.close()
+    row = await write(op)
+    if row is None:
+        return None
+    dose = _dose_row(row)
+    dose["next_reminder_at"] = row[6]
+    _patch_today(row[7], row[8], dose)
+    if target == DoseStatus.SCHEDULED:
+        due_queue.schedule(dose_id, row[6])
+    else:
+        due_queue.discard(dose_id)
+    return dose
 
 
-async def mark_skipped(dose_id: int) -> bool:
-    """Mark a dose as skipped. Returns False if state transition is forbidden."""
-    db = await get_db()
-    try:
-        cursor = await db.execute(
-            "SELECT status FROM doses WHERE id = ?", (dose_id,)
-        )
-        row = await cursor.fetchone()
-        if not row:
-            return False
+async def mark_taken(dose_id: int, taken_at: str) -> dict[str, Any] | None:
+    """Mark a dose as taken. Returns the updated dose, or None if not allowed."""
+    return await _transition(dose_id, "take", taken_at=taken_at)
 
-        await db.execute(
-            "UPDATE doses SET status = 'skipped' WHERE id = ?",
-            (dose_id,),
+
+async def snooze(
+    dose_id: int, interval_minutes: int, now_ts: int, *, detach: bool = False
+) -> dict[str, Any] | None:
+    """Snooze a dose by scheduling next reminder at now_ts + interval_minutes.
+
+    With ``detach`` the dose forgets its reminder message (a digest shared
+    with other doses), so its next reminder does not delete that message.
+    Returns the updated dose, or None if it is no longer pending.
+    """
+    next_at = now_ts + interval_minutes * 60
+    changes: dict[str, Any] = {"reminder_sent": 0, "snoozed": 1, "next_reminder_at": next_at}
+    if detach:
+        changes["message_id"] = None
+    return await _transition(dose_id, "snooze", **changes)
+
+
+def _take_filter(due_by: int | None, slot_of: int | None, message_id: int | None) -> str:
+    """SQL predicate on ``doses`` for the optional bulk-take scope."""
+    clauses = []
+    if due_by is not None:
+        clauses.append("scheduled_at <= :due_by")
+    if slot_of is not None:
+        clauses.append(
+            "scheduled_datetime = (SELECT scheduled_datetime FROM doses WHERE id = :slot_of)"
         )
-        await db.commit()
-        return True
-    finally:
-        await db.close()
+    if message_id is not None:
+        clauses.append("message_id = :message_id")
+    return "".join(f" AND {c}" for c in clauses)
+
+
+async def take_pending_doses(
+    telegram_id: int,
+    taken_at: str,
+    *,
+    due_by: int | None = None,
+    slot_of: int | None = None,
+    message_id: int | None = None,
+) -> list[dict[str, Any]]:
+    """Mark a user's pending doses as taken in one set-based UPDATE … RETURNING.
+
+    Scope is narrowed by ``due_by`` (scheduled at or before this epoch),
+    ``slot_of`` (same scheduled time as that dose) and ``message_id`` (the
+    doses of one digest reminder). Returns the doses that were taken.
+    """
+    params = {
+        "taken": DoseStatus.TAKEN,
+        "taken_at": taken_at,
+        "scheduled": DoseStatus.SCHEDULED,
+        "telegram_id": telegram_id,
+        "due_by": due_by,
+        "slot_of": slot_of,
+        "message_id": message_id,
+    }
+    sql = f"""
+        UPDATE doses
+        SET status = :taken, taken_at = :taken_at
+        WHERE status = :scheduled
+          AND medicine_id IN (
+              SELECT m.id FROM medicines m JOIN users u ON m.user_id = u.id
+              WHERE u.telegram_id = :telegram_id
+          ){_take_filter(due_by, slot_of, message_id)}
+        {_RETURNING_DOSE}
+    """
+
+    async def op(db: aiosqlite.Connection) -> list[aiosqlite.Row]:
+        cursor = await db.execute(sql, params)
+        return await cursor.fetchall()
 
+    doses = []
+    for row in await write(op):
+        dose = _dose_row(row)
+        _patch_today(row[7], row[8], dose)
+        due_queue.discard(dose["dose_id"])
+        doses.append(dose)
+    return doses
 
-async def process_missed_doses(now_str: str) -> int:
-    """Mark doses as missed if they are from a previous day.
 
-    Today's doses are reminded until end of day; only past-day doses are marked missed.
+async def mark_skipped(dose_id: int) -> dict[str, Any] | None:
+    """Mark a dose as skipped. Returns the updated dose, or None if not allowed."""
+    return await _transition(dose_id, "skip")
+
+
+async def process_missed_doses(now_ts: int) -> int:
+    """Mark doses as missed once their local day is over.
+
+    Today's doses are reminded until end of day; ``day_end_at`` holds the end
+    of each dose's day in its owner's zone, so one range predicate covers
+    every zone. Doses of inactive users are left for when they come back.
     Returns the number of doses marked as missed.
     """
-    db = await get_db()
-    try:
+
+    async def op(db: aiosqlite.Connection) -> int:
         cursor = await db.execute(
-            """
+            f"""
             UPDATE doses
-            SET status = 'missed'
-            WHERE status = 'scheduled'
-              AND DATE(scheduled_datetime) < DATE(?)
+            SET status = ?
+            WHERE status IN ({_allowed_from("miss")})
+              AND day_end_at <= ?
+              AND {owner_is_active(_DOSE_OWNER)}
             """,
-            (now_str,),
+            (DoseStatus.MISSED, now_ts),
         )
-        await db.commit()
         return cursor.rowcount
-    finally:
-        await db.close()
 
+    return await write(op)
 
-async def get_today_doses(telegram_id: int, date_str: str) -> list[dict[str, Any]]:
-    """Get all doses for a user on a given date, sorted by scheduled time."""
-    db = await get_db()
-    try:
+
+async def process_unanswered_doses(now_ts: int) -> int:
+    """Give up on doses whose reminder cap is used up once the next one is due.
+
+    They move to the terminal ``UNANSWERED`` status (still takeable by hand),
+    which takes them out of the scheduled range of the hot indexes.
+    Returns the number of doses updated.
+    """
+
+    async def op(db: aiosqlite.Connection) -> list[aiosqlite.Row]:
+        cursor = await db.execute(
+            f"""
+            UPDATE doses
+            SET status = :unanswered
+            WHERE status IN ({_allowed_from("give_up")})
+              AND next_reminder_at <= :now
+              AND NOT {under_reminder_cap("doses", _DOSE_OWNER)}
+              AND {owner_is_active(_DOSE_OWNER)}
+            {_RETURNING_DOSE}
+            """,
+            {
+                "unanswered": DoseStatus.UNANSWERED,
+                "now": now_ts,
+                "max_reminders": DEFAULT_MAX_REMINDERS,
+            },
+        )
+        return await cursor.fetchall()
+
+    rows = await write(op)
+    for row in rows:
+        dose = _dose_row(row)
+        _patch_today(row[7], row[8], dose)
+        due_queue.discard(dose["dose_id"])
+    return len(rows)
+
+
+async def get_today_entry(telegram_id: int, date_str: str) -> TodayEntry:
+    """Cached doses of a user's day (read-through, see :class:`TodayEntry`)."""
+    entry = _today_cache.get(telegram_id)
+    if entry is not None and entry.date == date_str:
+        _today_cache.move_to_end(telegram_id)
+        return entry
+
+    epoch = _today_epoch
+    async with acquire() as db:
         cursor = await db.execute(
             """
             SELECT d.id, m.name, m.dosage, d.scheduled_datetime,
@@ -251,25 +671,25 @@ async def get_today_doses(telegram_id: int, date_str: str) -> list[dict[str, Any
             JOIN medicines m ON d.medicine_id = m.id
             JOIN users u ON m.user_id = u.id
             WHERE u.telegram_id = ?
-              AND d.scheduled_datetime LIKE ?
-            ORDER BY d.scheduled_datetime
+              AND d.dose_date = ?
+            ORDER BY d.scheduled_at
             """,
-            (telegram_id, f"{date_str}%"),
+            (telegram_id, date_str),
         )
-        rows = await cursor.fetchall()
-        return [
-            {
-                "dose_id": r[0],
-                "medicine_name": r[1],
-                "dosage": r[2],
-                "scheduled_datetime": r[3],
-                "status": r[4],
-                "taken_at": r[5],
-            }
-            for r in rows
-        ]
-    finally:
-        await db.close()
+        entry = TodayEntry(date_str, [_dose_row(r) for r in await cursor.fetchall()])
+
+    if epoch == _today_epoch:
+        _today_cache[telegram_id] = entry
+        _today_cache.move_to_end(telegram_id)
+        while len(_today_cache) > TODAY_CACHE_SIZE:
+            _today_cache.popitem(last=False)
+    return entry
+
+
+async def get_today_doses(telegram_id: int, date_str: str) -> list[dict[str, Any]]:
+    """Get all doses for a user on a given date, sorted by scheduled time."""
+    entry = await get_today_entry(telegram_id, date_str)
+    return [dict(dose) for dose in entry.doses]
 
 
 async def get_dose_history(
@@ -279,8 +699,7 @@ async def get_dose_history(
 
     Returns doses sorted by scheduled_datetime descending.
     """
-    db = await get_db()
-    try:
+    async with acquire() as db:
         cursor = await db.execute(
             """
             SELECT d.id, m.name, m.dosage, d.scheduled_datetime,
@@ -289,32 +708,35 @@ async def get_dose_history(
             JOIN medicines m ON d.medicine_id = m.id
             JOIN users u ON m.user_id = u.id
             WHERE u.telegram_id = ?
-              AND d.scheduled_datetime >= ?
-              AND d.scheduled_datetime < ?
-            ORDER BY d.scheduled_datetime DESC
+              AND d.dose_date BETWEEN ? AND ?
+            ORDER BY d.scheduled_at DESC
             """,
-            (telegram_id, f"{start_date} 00:00", f"{end_date} 23:59"),
+            (telegram_id, start_date, end_date),
         )
-        rows = await cursor.fetchall()
-        return [
-            {
-                "dose_id": r[0],
-                "medicine_name": r[1],
-                "dosage": r[2],
-                "scheduled_datetime": r[3],
-                "status": r[4],
-                "taken_at": r[5],
-            }
-            for r in rows
-        ]
-    finally:
-        await db.close()
+        return [_dose_row(r) for r in await cursor.fetchall()]
+
+
+async def get_message_doses(telegram_id: int, message_id: int) -> list[dict[str, Any]]:
+    """Doses of a user covered by one reminder message, by scheduled time."""
+    async with acquire() as db:
+        cursor = await db.execute(
+            """
+            SELECT d.id, m.name, m.dosage, d.scheduled_datetime,
+                   d.status, d.taken_at
+            FROM doses d
+            JOIN medicines m ON d.medicine_id = m.id
+            JOIN users u ON m.user_id = u.id
+            WHERE d.message_id = ? AND u.telegram_id = ?
+            ORDER BY d.scheduled_at, d.id
+            """,
+            (message_id, telegram_id),
+        )
+        return [_dose_row(r) for r in await cursor.fetchall()]
 
 
 async def get_dose_by_id(dose_id: int) -> dict[str, Any] | None:
     """Gets details for a single dose."""
-    db = await get_db()
-    try:
+    async with acquire() as db:
         cursor = await db.execute(
             """
             SELECT d.id, m.name, m.dosage, d.scheduled_datetime,
@@ -328,36 +750,25 @@ async def get_dose_by_id(dose_id: int) -> dict[str, Any] | None:
         row = await cursor.fetchone()
         if not row:
             return None
-        
-        return {
-            "dose_id": row[0],
-            "medicine_name": row[1],
-            "dosage": row[2],
-            "scheduled_datetime": row[3],
-            "status": row[4],
-            "taken_at": row[5],
-        }
-    finally:
-        await db.close()
-
-
-async def unmark_dose(dose_id: int) -> bool:
-    """Reset a dose's status back to 'scheduled', clearing take times."""
-    db = await get_db()
-    try:
-        cursor = await db.execute("SELECT id FROM doses WHERE id = ?", (dose_id,))
-        if not await cursor.fetchone():
-            return False
-
-        await db.execute(
-            """
-            UPDATE doses 
-            SET status = 'scheduled', taken_at = NULL 
-            WHERE id = ?
-            """,
-            (dose_id,),
-        )
-        await db.commit()
-        return True
-    finally:
-        await db.close()
+        return _dose_row(row)
+
+
+async def unmark_dose(dose_id: int, now_ts: int) -> dict[str, Any] | None:
+    """Reset a dose's status back to 'scheduled', clearing take times.
+
+    The dose starts over: its reminder count and snooze are cleared and the
+    next (first) reminder is due at its slot, or at ``now_ts`` if that has
+    passed, plus the owner's jitter like any first reminder. So a dose that
+    had used up its reminders is not given up on again.
+    """
+    jitter = f"user_jitter({_DOSE_OWNER}, {int(REMINDER_JITTER_SECONDS)})"
+    return await _transition(
+        dose_id,
+        "reset",
+        expressions={"next_reminder_at": f"MAX(scheduled_at, :next_reminder_at) + {jitter}"},
+        taken_at=None,
+        reminder_sent=0,
+        reminder_count=0,
+        snoozed=0,
+        next_reminder_at=now_ts,
+    )
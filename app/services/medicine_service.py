@@ -2,15 +2,41 @@
 
 from __future__ import annotations
 
+from collections import OrderedDict
 from datetime import datetime, timezone
 
-from app.db import get_db
+import aiosqlite
+
+from app.db import DoseStatus, acquire, write
+from app.due_queue import due_queue
+from app.config import settings
+from app.services.dose_service import horizon_end, insert_doses, invalidate_today
+from app.services.settings_service import get_user_timezone
+from app.timeutils import DATE_FMT, get_tz, now_local
+
+# Users whose medicine list is kept in memory (LRU)
+MEDICINE_CACHE_SIZE = 10_000
+
+_medicine_cache: OrderedDict[int, list[dict]] = OrderedDict()
+
+
+async def _ensure_user(db: aiosqlite.Connection, telegram_id: int) -> int:
+    """Insert the user if missing (on the writer connection) and return its id."""
+    now = datetime.now(timezone.utc).isoformat()
+    await db.execute(
+        "INSERT OR IGNORE INTO users (telegram_id, created_at) VALUES (?, ?)",
+        (telegram_id, now),
+    )
+    cursor = await db.execute(
+        "SELECT id FROM users WHERE telegram_id = ?", (telegram_id,)
+    )
+    row = await cursor.fetchone()
+    return row[0]
 
 
 async def ensure_user(telegram_id: int) -> int:
     """Register user if not exists. Return internal user id."""
-    db = await get_db()
-    try:
+    async with acquire() as db:
         cursor = await db.execute(
             "SELECT id FROM users WHERE telegram_id = ?", (telegram_id,)
         )
@@ -18,15 +44,46 @@ async def ensure_user(telegram_id: int) -> int:
         if row:
             return row[0]
 
-        now = datetime.now(timezone.utc).isoformat()
+    async def op(db: aiosqlite.Connection) -> int:
+        return await _ensure_user(db, telegram_id)
+
+    return await write(op)
+
+
+async def reactivate_user(telegram_id: int) -> bool:
+    """Mark a user who came back (``/start`` after blocking the bot) active.
+
+    Doses are generated again from their local today through the horizon;
+    the days spent inactive are not backfilled. Returns True if the user
+    was inactive.
+    """
+    async with acquire() as db:
         cursor = await db.execute(
-            "INSERT INTO users (telegram_id, created_at) VALUES (?, ?)",
-            (telegram_id, now),
+            "SELECT 1 FROM users WHERE telegram_id = ? AND active = 0", (telegram_id,)
         )
-        await db.commit()
-        return cursor.lastrowid  # type: ignore[return-value]
-    finally:
-        await db.close()
+        if not await cursor.fetchone():
+            return False
+
+    async def op(db: aiosqlite.Connection) -> bool:
+        cursor = await db.execute(
+            """
+            UPDATE users SET active = 1 WHERE telegram_id = ? AND active = 0
+            RETURNING id, timezone
+            """,
+            (telegram_id,),
+        )
+        row = await cursor.fetchone()
+        if not row:
+            return False
+        today = now_local(row[1] or settings.timezone, DATE_FMT)
+        await insert_doses(db, today, horizon_end(today), user_id=row[0])
+        return True
+
+    if not await write(op):
+        return False
+    invalidate_today(telegram_id)
+    due_queue.request_reload()
+    return True
 
 
 async def add_medicine(
@@ -34,12 +91,17 @@ async def add_medicine(
     name: str,
     dosage: str,
     times: list[str],
+    generate_for: str | None = None,
 ) -> int:
-    """Add a medicine with schedule times. Return medicine id."""
-    user_id = await ensure_user(telegram_id)
+    """Add a medicine with schedule times. Return medicine id.
+
+    If ``generate_for`` (YYYY-MM-DD) is given, the new medicine's doses from
+    that day through the generation horizon are created in the same
+    transaction.
+    """
 
-    db = await get_db()
-    try:
+    async def op(db: aiosqlite.Connection) -> int:
+        user_id = await _ensure_user(db, telegram_id)
         now = datetime.now(timezone.utc).isoformat()
         cursor = await db.execute(
             "INSERT INTO medicines (user_id, name, dosage, created_at) VALUES (?, ?, ?, ?)",
@@ -47,44 +109,73 @@ async def add_medicine(
         )
         medicine_id: int = cursor.lastrowid  # type: ignore[assignment]
 
-        for t in times:
-            await db.execute(
-                "INSERT INTO schedules (medicine_id, time) VALUES (?, ?)",
-                (medicine_id, t),
+        await db.executemany(
+            "INSERT INTO schedules (medicine_id, time) VALUES (?, ?)",
+            [(medicine_id, t) for t in times],
+        )
+        if generate_for:
+            await insert_doses(
+                db, generate_for, horizon_end(generate_for), medicine_id=medicine_id
             )
-
-        await db.commit()
         return medicine_id
-    finally:
-        await db.close()
+
+    medicine_id = await write(op)
+    invalidate_user_medicines(telegram_id)
+    if generate_for:
+        invalidate_today(telegram_id)
+        due_queue.request_reload()
+    return medicine_id
+
+
+def _copy_medicines(medicines: list[dict]) -> list[dict]:
+    """Copy cached entries so callers cannot mutate the cache."""
+    return [{**med, "times": list(med["times"])} for med in medicines]
+
+
+def invalidate_user_medicines(telegram_id: int) -> None:
+    """Drop the cached medicine list of a user (after add/delete)."""
+    _medicine_cache.pop(telegram_id, None)
 
 
 async def get_user_medicines(telegram_id: int) -> list[dict]:
-    """Get all medicines for a user with their schedules."""
-    db = await get_db()
-    try:
+    """Get all medicines for a user with their schedules.
+
+    One query (schedules folded in with ``group_concat``), cached per user
+    until the user adds or deletes a medicine.
+    """
+    cached = _medicine_cache.get(telegram_id)
+    if cached is not None:
+        _medicine_cache.move_to_end(telegram_id)
+        return _copy_medicines(cached)
+
+    async with acquire() as db:
         cursor = await db.execute(
             """
-            SELECT m.id, m.name, m.dosage
+            SELECT m.id, m.name, m.dosage, group_concat(s.time)
             FROM medicines m
             JOIN users u ON m.user_id = u.id
+            LEFT JOIN schedules s ON s.medicine_id = m.id
             WHERE u.telegram_id = ?
+            GROUP BY m.id
             ORDER BY m.name
             """,
             (telegram_id,),
         )
-        medicines = []
-        for row in await cursor.fetchall():
-            med = {"id": row[0], "name": row[1], "dosage": row[2]}
-            sch_cursor = await db.execute(
-                "SELECT time FROM schedules WHERE medicine_id = ? ORDER BY time",
-                (med["id"],),
-            )
-            med["times"] = [r[0] for r in await sch_cursor.fetchall()]
-            medicines.append(med)
-        return medicines
-    finally:
-        await db.close()
+        medicines = [
+            {
+                "id": row[0],
+                "name": row[1],
+                "dosage": row[2],
+                "times": sorted(row[3].split(",")) if row[3] else [],
+            }
+            for row in await cursor.fetchall()
+        ]
+
+    _medicine_cache[telegram_id] = medicines
+    _medicine_cache.move_to_end(telegram_id)
+    while len(_medicine_cache) > MEDICINE_CACHE_SIZE:
+        _medicine_cache.popitem(last=False)
+    return _copy_medicines(medicines)
 
 
 async def delete_medicine(medicine_id: int) -> bool:
@@ -92,14 +183,19 @@ async def delete_medicine(medicine_id: int) -> bool:
 
     Returns True if the medicine was found and deleted.
     """
-    db = await get_db()
-    try:
-        # Check medicine exists
+
+    async def op(db: aiosqlite.Connection) -> int | None:
+        # Check medicine exists (and find its owner for cache invalidation)
         cursor = await db.execute(
-            "SELECT id FROM medicines WHERE id = ?", (medicine_id,)
+            """
+            SELECT u.telegram_id FROM medicines m JOIN users u ON m.user_id = u.id
+            WHERE m.id = ?
+            """,
+            (medicine_id,),
         )
-        if not await cursor.fetchone():
-            return False
+        row = await cursor.fetchone()
+        if not row:
+            return None
 
         # Delete all doses (scheduled, taken, missed)
         await db.execute(
@@ -114,7 +210,60 @@ async def delete_medicine(medicine_id: int) -> bool:
         await db.execute(
             "DELETE FROM medicines WHERE id = ?", (medicine_id,)
         )
-        await db.commit()
+        return row[0]
+
+    telegram_id = await write(op)
+    if telegram_id is None:
+        return False
+    invalidate_user_medicines(telegram_id)
+    invalidate_today(telegram_id)
+    return True
+
+
+async def update_schedule_time(schedule_id: int, time: str, now_ts: int) -> bool:
+    """Move a schedule to a new time and regenerate only its future doses.
+
+    Doses that already started (reminded, taken, skipped…) or are before
+    ``now_ts`` are kept; untouched future doses of this schedule are
+    replaced from the owner's local today through the generation horizon.
+    Returns False if the schedule is unknown.
+    """
+    async with acquire() as db:
+        cursor = await db.execute(
+            """
+            SELECT u.telegram_id FROM schedules s
+            JOIN medicines m ON s.medicine_id = m.id
+            JOIN users u ON m.user_id = u.id
+            WHERE s.id = ?
+            """,
+            (schedule_id,),
+        )
+        row = await cursor.fetchone()
+    if not row:
+        return False
+    telegram_id = row[0]
+    tz_name = await get_user_timezone(telegram_id)
+    today = datetime.fromtimestamp(now_ts, get_tz(tz_name)).strftime(DATE_FMT)
+
+    async def op(db: aiosqlite.Connection) -> bool:
+        cursor = await db.execute(
+            "UPDATE schedules SET time = ? WHERE id = ? RETURNING id", (time, schedule_id)
+        )
+        if not await cursor.fetchone():
+            return False
+        await db.execute(
+            """
+            DELETE FROM doses
+            WHERE schedule_id = ? AND status = ? AND reminder_count = 0 AND scheduled_at > ?
+            """,
+            (schedule_id, DoseStatus.SCHEDULED, now_ts),
+        )
+        await insert_doses(db, today, horizon_end(today), schedule_id=schedule_id)
         return True
-    finally:
-        await db.close()
+
+    if not await write(op):
+        return False
+    invalidate_user_medicines(telegram_id)
+    invalidate_today(telegram_id)
+    due_queue.request_reload()
+    return True
@@ -8,7 +8,7 @@ from typing import Any
 from aiogram import Bot
 from aiogram.types import InlineKeyboardMarkup, Message, ReplyKeyboardMarkup
 
-from app.db import get_last_message_id, set_last_message_id
+from app.message_cache import message_cache
 
 logger = logging.getLogger(__name__)
 
@@ -24,8 +24,8 @@ async def send_single_message(
     Send a message to a user, replacing the previous one if it exists.
     This maintains the 'single message' interface in the chat.
     """
-    # 1. Get the last known message ID
-    last_message_id = await get_last_message_id(chat_id)
+    # 1. Get the last known message ID (in memory once the chat is warm)
+    last_message_id = await message_cache.get(chat_id)
 
     # 2. Try to delete it (so the new message appears at the bottom with standard notification)
     if last_message_id:
@@ -40,7 +40,7 @@ async def send_single_message(
         chat_id=chat_id, text=text, reply_markup=reply_markup, **kwargs
     )
 
-    # 4. Save the new message ID
-    await set_last_message_id(chat_id, new_message.message_id)
+    # 4. Save the new message ID (persisted by the write-behind flusher)
+    message_cache.set(chat_id, new_message.message_id)
 
     return new_message
@@ -0,0 +1,342 @@
+"""Service layer for the reminder outbox: durable, retryable, idempotent delivery.
+
+Due reminders become ``outbox`` rows keyed by (dose_id, reminder_no), where
+reminder_no is the dose's ``reminder_count`` at enqueue time, so enqueueing
+the same reminder twice is a no-op. A sender claims pending rows under a
+lease, sends them and records the outcome together with the dose
+bookkeeping in one transaction.
+
+If the process dies after sending but before recording, the row is left in
+``SENDING`` with an expired lease. Such rows are marked ``UNKNOWN`` and the
+dose is advanced as if the reminder had gone out: the next repeat reminder
+follows at the usual interval, but the in-doubt one is never sent twice.
+"""
+
+from __future__ import annotations
+
+from collections.abc import Iterable
+from typing import Any
+
+import aiosqlite
+
+from app.db import DoseStatus, OutboxState, ReminderPriority, acquire, write
+from app.due_queue import due_queue
+from app.services.dose_service import (
+    apply_reminders_sent,
+    owner_is_active,
+    under_reminder_cap,
+)
+from app.services.settings_service import DEFAULT_MAX_REMINDERS, get_reminder_intervals
+from app.timeutils import REMINDER_JITTER_SECONDS
+
+OUTBOX_MAX_ATTEMPTS = 5
+OUTBOX_BACKOFF_BASE = 30  # seconds, doubled per attempt
+OUTBOX_BACKOFF_MAX = 15 * 60
+OUTBOX_LEASE_SECONDS = 60
+OUTBOX_CLAIM_BATCH = 200
+
+# Advance a dose to its next reminder using the owner's interval setting
+_ADVANCE_DOSE_SQL = """
+    UPDATE doses
+    SET reminder_count = reminder_count + 1,
+        snoozed = 0,
+        next_reminder_at = COALESCE(next_reminder_at, scheduled_at) + 60 * COALESCE(
+            (SELECT us.reminder_interval_minutes
+             FROM user_settings us JOIN medicines m ON us.user_id = m.user_id
+             WHERE m.id = doses.medicine_id),
+            5)
+    WHERE id = ? AND status = ?
+    RETURNING next_reminder_at
+"""
+
+
+def backoff_delay(attempts: int) -> int:
+    """Exponential backoff (seconds) after ``attempts`` failed tries."""
+    return min(OUTBOX_BACKOFF_BASE * 2 ** max(attempts - 1, 0), OUTBOX_BACKOFF_MAX)
+
+
+async def _advance_dose(db: aiosqlite.Connection, dose_id: int) -> int | None:
+    cursor = await db.execute(_ADVANCE_DOSE_SQL, (dose_id, DoseStatus.SCHEDULED))
+    row = await cursor.fetchone()
+    return row[0] if row else None
+
+
+async def enqueue_due_reminders(now_ts: int) -> int:
+    """Create outbox rows for every dose due at ``now_ts``. Returns rows added.
+
+    Doses are reminded until the end of their local day (``day_end_at``),
+    whatever the owner's zone, and at most ``max_reminders`` times; users
+    who blocked the bot are skipped. Each row gets its dispatch priority:
+    first reminder, repeat or snooze.
+
+    A row that is still pending or being sent is left alone. A finished row
+    for the same reminder number means the dose was reset after it was
+    answered (its reminder was cancelled, or sent before the reset), so the
+    row is reopened instead of blocking the reminder forever.
+    """
+
+    async def op(db: aiosqlite.Connection) -> int:
+        cursor = await db.execute(
+            f"""
+            INSERT INTO outbox (dose_id, reminder_no, chat_id, state, priority,
+                                available_at, created_at)
+            SELECT d.id, d.reminder_count, u.telegram_id, :pending,
+                   CASE WHEN d.snoozed THEN :snooze
+                        WHEN d.reminder_count = 0 THEN :first
+                        ELSE :repeat END,
+                   :now, :now
+            FROM doses d
+            JOIN medicines m ON d.medicine_id = m.id
+            JOIN users u ON m.user_id = u.id
+            WHERE d.status = :scheduled
+              AND d.next_reminder_at <= :now
+              AND d.day_end_at > :now
+              AND {under_reminder_cap()}
+              AND {owner_is_active()}
+            ON CONFLICT (dose_id, reminder_no) DO UPDATE SET
+                state = excluded.state,
+                priority = excluded.priority,
+                chat_id = excluded.chat_id,
+                attempts = 0,
+                available_at = excluded.available_at,
+                lease_until = NULL,
+                message_id = NULL,
+                last_error = NULL
+            WHERE outbox.state NOT IN (:pending, :sending)
+            """,
+            {
+                "pending": OutboxState.PENDING,
+                "sending": OutboxState.SENDING,
+                "scheduled": DoseStatus.SCHEDULED,
+                "first": ReminderPriority.FIRST,
+                "repeat": ReminderPriority.REPEAT,
+                "snooze": ReminderPriority.SNOOZE,
+                "now": now_ts,
+                "max_reminders": DEFAULT_MAX_REMINDERS,
+            },
+        )
+        return cursor.rowcount
+
+    return await write(op)
+
+
+async def outbox_depth(now_ts: int) -> dict[str, int]:
+    """Pending rows ready to send at ``now_ts``, per priority label."""
+    async with acquire() as db:
+        cursor = await db.execute(
+            """
+            SELECT priority, COUNT(*) FROM outbox
+            WHERE state = ? AND available_at <= ?
+            GROUP BY priority
+            """,
+            (OutboxState.PENDING, now_ts),
+        )
+        counts = dict(await cursor.fetchall())
+    return {p.label: counts.get(p, 0) for p in ReminderPriority}
+
+
+async def claim_deliveries(
+    now_ts: int, limit: int = OUTBOX_CLAIM_BATCH
+) -> list[dict[str, Any]]:
+    """Lease up to ``limit`` pending rows that are ready to send.
+
+    Rows are taken in priority order (first reminders, then repeats, then
+    snoozes), the longest-due first within a priority. Rows whose dose is
+    no longer scheduled (taken, skipped…) or was rescheduled past ``now_ts``
+    (snoozed while the row waited for a retry or a slot) are cancelled
+    instead of claimed; the dose is enqueued again once it is due.
+    Returns the claimed rows with everything needed to render the reminder,
+    its ``priority`` label and ``nominal_at``: the due time, without the
+    user's jitter for a first reminder.
+    """
+
+    async def op(db: aiosqlite.Connection) -> list[aiosqlite.Row]:
+        cursor = await db.execute(
+            """
+            SELECT o.id, o.dose_id, o.chat_id, o.attempts, d.status,
+                   d.scheduled_datetime, m.name, m.dosage, d.message_id, m.user_id,
+                   d.next_reminder_at - CASE WHEN o.priority = :first
+                       THEN user_jitter(m.user_id, :jitter) ELSE 0 END,
+                   o.priority, d.next_reminder_at <= :now
+            FROM outbox o
+            JOIN doses d ON o.dose_id = d.id
+            JOIN medicines m ON d.medicine_id = m.id
+            WHERE o.state = :pending AND o.available_at <= :now
+            ORDER BY o.priority, d.next_reminder_at, o.id
+            LIMIT :limit
+            """,
+            {
+                "first": ReminderPriority.FIRST,
+                "jitter": REMINDER_JITTER_SECONDS,
+                "pending": OutboxState.PENDING,
+                "now": now_ts,
+                "limit": limit,
+            },
+        )
+        rows = await cursor.fetchall()
+        claimed = [r for r in rows if r[4] == DoseStatus.SCHEDULED and r[12]]
+        stale = [
+            (OutboxState.CANCELLED, r[0])
+            for r in rows
+            if not (r[4] == DoseStatus.SCHEDULED and r[12])
+        ]
+        if stale:
+            await db.executemany("UPDATE outbox SET state = ? WHERE id = ?", stale)
+        if claimed:
+            await db.executemany(
+                """
+                UPDATE outbox SET state = ?, attempts = attempts + 1, lease_until = ?
+                WHERE id = ?
+                """,
+                [(OutboxState.SENDING, now_ts + OUTBOX_LEASE_SECONDS, r[0]) for r in claimed],
+            )
+        return claimed
+
+    claimed = await write(op)
+    # Intervals come from the settings cache rather than a per-claim JOIN
+    intervals = await get_reminder_intervals(r[9] for r in claimed)
+    return [
+        {
+            "outbox_id": r[0],
+            "dose_id": r[1],
+            "telegram_id": r[2],
+            "attempts": r[3] + 1,
+            "scheduled_datetime": r[5],
+            "medicine_name": r[6],
+            "dosage": r[7],
+            "message_id": r[8],
+            "user_id": r[9],
+            "interval_minutes": intervals[r[9]],
+            "nominal_at": r[10],
+            "priority": ReminderPriority(r[11]).label,
+        }
+        for r in claimed
+    ]
+
+
+async def complete_deliveries(sent: list[tuple[int, int, int, int]]) -> None:
+    """Record a batch of sent reminders in one transaction.
+
+    ``sent`` holds (outbox_id, dose_id, message_id, interval_minutes) tuples;
+    outbox rows and dose bookkeeping are each written with one
+    ``executemany``.
+    """
+    if not sent:
+        return
+
+    async def op(db: aiosqlite.Connection) -> list[tuple[int, int]]:
+        await db.executemany(
+            "UPDATE outbox SET state = ?, message_id = ?, lease_until = NULL WHERE id = ?",
+            [(OutboxState.SENT, message_id, outbox_id) for outbox_id, _, message_id, _ in sent],
+        )
+        return await apply_reminders_sent(
+            db, [(dose_id, message_id, interval) for _, dose_id, message_id, interval in sent]
+        )
+
+    for dose_id, next_at in await write(op):
+        due_queue.schedule(dose_id, next_at)
+
+
+async def fail_delivery(
+    outbox_id: int,
+    dose_id: int,
+    error: str,
+    now_ts: int,
+    retry_after: int | None = None,
+) -> int | None:
+    """Record a failed attempt.
+
+    Schedules a retry after exponential backoff (or the server's
+    ``retry_after`` hint) and returns its epoch. After OUTBOX_MAX_ATTEMPTS
+    the row is marked FAILED, the dose moves on to its next reminder and
+    None is returned.
+    """
+
+    async def op(db: aiosqlite.Connection) -> tuple[int | None, int | None]:
+        cursor = await db.execute("SELECT attempts FROM outbox WHERE id = ?", (outbox_id,))
+        row = await cursor.fetchone()
+        if not row:
+            return None, None
+        attempts = row[0]
+        if attempts >= OUTBOX_MAX_ATTEMPTS:
+            await db.execute(
+                "UPDATE outbox SET state = ?, last_error = ?, lease_until = NULL WHERE id = ?",
+                (OutboxState.FAILED, error, outbox_id),
+            )
+            return None, await _advance_dose(db, dose_id)
+
+        retry_at = now_ts + (retry_after if retry_after is not None else backoff_delay(attempts))
+        await db.execute(
+            """
+            UPDATE outbox SET state = ?, available_at = ?, last_error = ?, lease_until = NULL
+            WHERE id = ?
+            """,
+            (OutboxState.PENDING, retry_at, error, outbox_id),
+        )
+        return retry_at, None
+
+    retry_at, next_at = await write(op)
+    wake_at = retry_at if retry_at is not None else next_at
+    if wake_at is not None:
+        due_queue.schedule(dose_id, wake_at)
+    return retry_at
+
+
+async def recover_stale_deliveries(now_ts: int) -> int:
+    """Resolve rows whose sender died mid-send (expired lease) as UNKNOWN.
+
+    Their doses are advanced without resending, so a crash never produces a
+    duplicate notification. Returns the number of rows recovered.
+    """
+
+    async def op(db: aiosqlite.Connection) -> list[tuple[int, int | None]]:
+        cursor = await db.execute(
+            """
+            UPDATE outbox SET state = ?, lease_until = NULL
+            WHERE state = ? AND lease_until < ?
+            RETURNING dose_id
+            """,
+            (OutboxState.UNKNOWN, OutboxState.SENDING, now_ts),
+        )
+        dose_ids = [r[0] for r in await cursor.fetchall()]
+        return [(dose_id, await _advance_dose(db, dose_id)) for dose_id in dose_ids]
+
+    advanced = await write(op)
+    for dose_id, next_at in advanced:
+        if next_at is not None:
+            due_queue.schedule(dose_id, next_at)
+    return len(advanced)
+
+
+async def deactivate_chats(chat_ids: Iterable[int], error: str) -> int:
+    """Mark the users of unreachable chats inactive (blocked bot, chat gone).
+
+    Their pending and in-flight outbox rows fail at once instead of being
+    retried, and the doses move on to their next reminder, which is not
+    sent until the user comes back (see ``reactivate_user``). Returns the
+    number of users deactivated.
+    """
+    chat_ids = list(set(chat_ids))
+    if not chat_ids:
+        return 0
+    placeholders = ",".join("?" * len(chat_ids))
+
+    async def op(db: aiosqlite.Connection) -> int:
+        cursor = await db.execute(
+            f"UPDATE users SET active = 0 WHERE active = 1 AND telegram_id IN ({placeholders})",
+            chat_ids,
+        )
+        deactivated = cursor.rowcount
+        cursor = await db.execute(
+            f"""
+            UPDATE outbox SET state = ?, last_error = ?, lease_until = NULL
+            WHERE state IN (?, ?) AND chat_id IN ({placeholders})
+            RETURNING dose_id
+            """,
+            (OutboxState.FAILED, error, OutboxState.PENDING, OutboxState.SENDING, *chat_ids),
+        )
+        for (dose_id,) in await cursor.fetchall():
+            await _advance_dose(db, dose_id)
+        return deactivated
+
+    return await write(op)
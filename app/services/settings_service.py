@@ -1,90 +1,262 @@
-"""Service layer for user notification settings."""
+"""Service layer for user notification settings.
+
+Reads go through :data:`settings_cache`, a bounded read-through cache with a
+TTL keyed by telegram_id and by internal user_id; :func:`update_settings`
+invalidates both keys, so handlers and the reminder tick rarely touch the DB.
+Settings include the user's time zone (``users.timezone``, NULL meaning the
+configured default).
+"""
 
 from __future__ import annotations
 
-from app.db import get_db
+import time
+from collections import OrderedDict
+from collections.abc import Iterable
+from typing import Any
+
+import aiosqlite
+
+from app.config import settings
+from app.db import DoseStatus, acquire, write
+from app.timeutils import DATE_FMT, now_local
 
 # Defaults
 DEFAULT_MAX_REMINDERS = 3
 DEFAULT_REMINDER_INTERVAL = 5  # minutes
 
+SETTINGS_CACHE_TTL = 300.0  # seconds
+SETTINGS_CACHE_SIZE = 10_000
+
+
+class SettingsCache:
+    """Bounded LRU cache of settings dicts with a TTL.
+
+    Keys are ``("telegram", telegram_id)`` or ``("user", user_id)``; the
+    same user may be cached under both. Callers get copies, so the cached
+    dicts cannot be mutated from outside.
+    """
+
+    def __init__(
+        self, ttl: float = SETTINGS_CACHE_TTL, max_size: int = SETTINGS_CACHE_SIZE
+    ) -> None:
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries: OrderedDict[tuple[str, int], tuple[float, dict[str, Any]]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, kind: str, key: int) -> dict[str, Any] | None:
+        entry = self._entries.get((kind, key))
+        if entry is None or entry[0] <= time.monotonic():
+            if entry is not None:
+                del self._entries[(kind, key)]
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end((kind, key))
+        return dict(entry[1])
+
+    def put(self, kind: str, key: int, value: dict[str, Any]) -> None:
+        self._entries[(kind, key)] = (time.monotonic() + self.ttl, dict(value))
+        self._entries.move_to_end((kind, key))
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, *, telegram_id: int | None = None, user_id: int | None = None) -> None:
+        if telegram_id is not None:
+            self._entries.pop(("telegram", telegram_id), None)
+        if user_id is not None:
+            self._entries.pop(("user", user_id), None)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+settings_cache = SettingsCache()
+
+
+def _settings_row(row: aiosqlite.Row | tuple | None) -> dict[str, Any]:
+    """Map (max_reminders, reminder_interval_minutes, timezone) to a dict.
+
+    Missing values (no row, no custom settings) fall back to the defaults.
+    """
+    max_reminders, interval, tz_name = row if row else (None, None, None)
+    return {
+        "max_reminders": DEFAULT_MAX_REMINDERS if max_reminders is None else max_reminders,
+        "reminder_interval_minutes": DEFAULT_REMINDER_INTERVAL if interval is None else interval,
+        "timezone": tz_name or settings.timezone,
+    }
+
 
 async def get_user_settings(user_id: int) -> dict:
     """Get notification settings for a user (by internal user_id).
 
     Returns defaults if no custom settings exist.
     """
-    db = await get_db()
-    try:
+    cached = settings_cache.get("user", user_id)
+    if cached is not None:
+        return cached
+
+    async with acquire() as db:
         cursor = await db.execute(
-            "SELECT max_reminders, reminder_interval_minutes FROM user_settings WHERE user_id = ?",
+            """
+            SELECT us.max_reminders, us.reminder_interval_minutes, u.timezone
+            FROM users u
+            LEFT JOIN user_settings us ON us.user_id = u.id
+            WHERE u.id = ?
+            """,
             (user_id,),
         )
-        row = await cursor.fetchone()
-        if row:
-            return {
-                "max_reminders": row[0],
-                "reminder_interval_minutes": row[1],
-            }
-        return {
-            "max_reminders": DEFAULT_MAX_REMINDERS,
-            "reminder_interval_minutes": DEFAULT_REMINDER_INTERVAL,
-        }
-    finally:
-        await db.close()
+        result = _settings_row(await cursor.fetchone())
+    settings_cache.put("user", user_id, result)
+    return result
 
 
 async def get_settings_by_telegram_id(telegram_id: int) -> dict:
     """Get notification settings for a user by telegram_id."""
-    db = await get_db()
-    try:
+    cached = settings_cache.get("telegram", telegram_id)
+    if cached is not None:
+        return cached
+
+    async with acquire() as db:
         cursor = await db.execute(
             """
-            SELECT us.max_reminders, us.reminder_interval_minutes
-            FROM user_settings us
-            JOIN users u ON us.user_id = u.id
+            SELECT us.max_reminders, us.reminder_interval_minutes, u.timezone
+            FROM users u
+            LEFT JOIN user_settings us ON us.user_id = u.id
             WHERE u.telegram_id = ?
             """,
             (telegram_id,),
         )
-        row = await cursor.fetchone()
-        if row:
-            return {
-                "max_reminders": row[0],
-                "reminder_interval_minutes": row[1],
-            }
-        return {
-            "max_reminders": DEFAULT_MAX_REMINDERS,
-            "reminder_interval_minutes": DEFAULT_REMINDER_INTERVAL,
-        }
-    finally:
-        await db.close()
+        result = _settings_row(await cursor.fetchone())
+    settings_cache.put("telegram", telegram_id, result)
+    return result
+
+
+async def get_reminder_intervals(user_ids: Iterable[int]) -> dict[int, int]:
+    """Reminder interval (minutes) per internal user id.
+
+    Served from the cache; all misses are loaded with a single query.
+    """
+    intervals: dict[int, int] = {}
+    missing: list[int] = []
+    for user_id in set(user_ids):
+        cached = settings_cache.get("user", user_id)
+        if cached is not None:
+            intervals[user_id] = cached["reminder_interval_minutes"]
+        else:
+            missing.append(user_id)
+
+    if missing:
+        placeholders = ",".join("?" * len(missing))
+        async with acquire() as db:
+            cursor = await db.execute(
+                f"""
+                SELECT u.id, us.max_reminders, us.reminder_interval_minutes, u.timezone
+                FROM users u
+                LEFT JOIN user_settings us ON us.user_id = u.id
+                WHERE u.id IN ({placeholders})
+                """,
+                missing,
+            )
+            rows = {r[0]: (r[1], r[2], r[3]) for r in await cursor.fetchall()}
+        for user_id in missing:
+            result = _settings_row(rows.get(user_id))
+            settings_cache.put("user", user_id, result)
+            intervals[user_id] = result["reminder_interval_minutes"]
+    return intervals
 
 
 async def update_settings(
     telegram_id: int,
-    reminder_interval_minutes: int,
+    reminder_interval_minutes: int | None = None,
+    max_reminders: int | None = None,
 ) -> None:
-    """Update (or create) notification settings for a user."""
-    db = await get_db()
-    try:
+    """Update (or create) notification settings for a user.
+
+    Only the given values change; the others keep their current (or
+    default) value.
+    """
+
+    async def op(db: aiosqlite.Connection) -> int | None:
         cursor = await db.execute(
             "SELECT id FROM users WHERE telegram_id = ?", (telegram_id,)
         )
         row = await cursor.fetchone()
         if not row:
-            return
+            return None
         user_id = row[0]
 
         await db.execute(
             """
             INSERT INTO user_settings (user_id, max_reminders, reminder_interval_minutes)
-            VALUES (?, 999, ?)
+            VALUES (:user_id, COALESCE(:max_reminders, :default_max),
+                    COALESCE(:interval, :default_interval))
             ON CONFLICT(user_id) DO UPDATE SET
-                reminder_interval_minutes = excluded.reminder_interval_minutes
+                max_reminders = COALESCE(:max_reminders, max_reminders),
+                reminder_interval_minutes = COALESCE(:interval, reminder_interval_minutes)
+            """,
+            {
+                "user_id": user_id,
+                "max_reminders": max_reminders,
+                "interval": reminder_interval_minutes,
+                "default_max": DEFAULT_MAX_REMINDERS,
+                "default_interval": DEFAULT_REMINDER_INTERVAL,
+            },
+        )
+        return user_id
+
+    user_id = await write(op)
+    settings_cache.invalidate(telegram_id=telegram_id, user_id=user_id)
+
+
+async def get_user_timezone(telegram_id: int) -> str:
+    """IANA time zone of a user (the configured default if not chosen)."""
+    return (await get_settings_by_telegram_id(telegram_id))["timezone"]
+
+
+async def set_user_timezone(telegram_id: int, tz_name: str) -> bool:
+    """Change a user's time zone and regenerate their untouched future doses.
+
+    Doses that are past, already reminded or answered keep their instants;
+    pending future ones are recreated in the new zone through the horizon.
+    Returns False if the user is unknown.
+    """
+    from app.due_queue import due_queue
+    from app.services.dose_service import horizon_end, insert_doses, invalidate_today
+
+    now_ts = int(time.time())
+    today = now_local(tz_name, DATE_FMT)
+
+    async def op(db: aiosqlite.Connection) -> int | None:
+        cursor = await db.execute(
+            "UPDATE users SET timezone = ? WHERE telegram_id = ? RETURNING id",
+            (tz_name, telegram_id),
+        )
+        row = await cursor.fetchone()
+        if not row:
+            return None
+        user_id = row[0]
+        await db.execute(
+            """
+            DELETE FROM doses
+            WHERE status = ? AND reminder_count = 0 AND scheduled_at > ?
+              AND medicine_id IN (SELECT id FROM medicines WHERE user_id = ?)
             """,
-            (user_id, reminder_interval_minutes),
+            (DoseStatus.SCHEDULED, now_ts, user_id),
         )
-        await db.commit()
-    finally:
-        await db.close()
+        await insert_doses(db, today, horizon_end(today), user_id=user_id)
+        return user_id
+
+    user_id = await write(op)
+    if user_id is None:
+        return False
+    settings_cache.invalidate(telegram_id=telegram_id, user_id=user_id)
+    invalidate_today(telegram_id)
+    due_queue.request_reload()
+    return True
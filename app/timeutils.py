@@ -0,0 +1,71 @@
+"""Conversions between local wall-clock strings and UTC epoch seconds.
+
+Doses are stored with integer UTC instants so that queries can use plain
+index range predicates; the local ``YYYY-MM-DD HH:MM`` strings are kept
+only for display and for the inputs coming from handlers. Seconds are
+optional everywhere (``HH:MM:SS``).
+
+Each user's reminders are shifted by a small deterministic offset
+(:func:`user_jitter`) so that everyone who picked 08:00 is not sent at the
+same instant.
+"""
+
+from __future__ import annotations
+
+import os
+from datetime import datetime, tzinfo
+from functools import lru_cache
+
+import pytz
+
+DATE_FMT = "%Y-%m-%d"
+DATETIME_FMT = "%Y-%m-%d %H:%M"
+DATETIME_SECONDS_FMT = DATETIME_FMT + ":%S"
+
+# Reminders of a user are delayed by 0..REMINDER_JITTER_SECONDS (0 disables)
+REMINDER_JITTER_SECONDS = int(os.getenv("REMINDER_JITTER_SECONDS", "30"))
+
+
+@lru_cache(maxsize=None)
+def get_tz(name: str) -> tzinfo:
+    """Return a (cached) pytz time zone object."""
+    return pytz.timezone(name)
+
+
+def parse_local(value: str) -> datetime:
+    """Parse ``YYYY-MM-DD HH:MM`` (seconds optional) into a naive datetime."""
+    if len(value) > 16:
+        return datetime.strptime(value, DATETIME_SECONDS_FMT)
+    return datetime.strptime(value, DATETIME_FMT)
+
+
+def local_to_epoch(value: str, tz_name: str) -> int:
+    """Convert a local wall-clock string in ``tz_name`` to UTC epoch seconds.
+
+    Non-existent or ambiguous times around DST switches resolve to the
+    standard-time offset instead of raising.
+    """
+    tz = get_tz(tz_name)
+    local_dt = tz.localize(parse_local(value), is_dst=False)  # type: ignore[attr-defined]
+    return int(local_dt.timestamp())
+
+
+def now_local(tz_name: str, fmt: str = DATETIME_FMT) -> str:
+    """Current wall-clock time in ``tz_name``."""
+    return datetime.now(get_tz(tz_name)).strftime(fmt)
+
+
+def is_valid_tz(name: str) -> bool:
+    """True if ``name`` is a known IANA time zone."""
+    return name in pytz.all_timezones_set
+
+
+def user_jitter(user_id: int, window: int = REMINDER_JITTER_SECONDS) -> int:
+    """Deterministic per-user reminder offset in seconds, in ``[0, window]``.
+
+    A multiplicative hash of the internal user id spreads consecutive ids
+    over the whole window; the same user always gets the same offset.
+    """
+    if window <= 0:
+        return 0
+    return (user_id * 2654435761) % 2**32 % (window + 1)
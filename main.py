@@ -6,9 +6,10 @@ import asyncio
 import logging
 
 from app.bot import create_bot, create_dispatcher
-from app.db import init_db
-from app.scheduler import setup_scheduler
-from app.services.dose_service import generate_daily_doses
+from app.config import settings
+from app.db import close_db, init_db
+from app.message_cache import message_cache
+from app.scheduler import reconcile, setup_reminder_engine, setup_scheduler
 
 logging.basicConfig(
     level=logging.INFO,
@@ -22,6 +23,9 @@ async def main() -> None:
     logger.info("Initializing database...")
     await init_db()
 
+    # Generate doses for every day missed while the bot was down, before polling
+    await reconcile(settings.timezone)
+
     bot = create_bot()
     dp = create_dispatcher()
 
@@ -43,25 +47,21 @@ async def main() -> None:
     scheduler.start()
     logger.info("Scheduler started")
 
-    # Generate doses for today on startup (in case bot was down at 00:01)
-    from datetime import datetime
-
-    import pytz
-
-    from app.config import settings
+    message_cache.start()
 
-    tz = pytz.timezone(settings.timezone)
-    today = datetime.now(tz).strftime("%Y-%m-%d")
-    created = await generate_daily_doses(today)
-    if created:
-        logger.info("Generated %d doses for today on startup", created)
+    engine = setup_reminder_engine(bot)
+    engine.start()
+    logger.info("Reminder engine started")
 
     logger.info("Starting bot polling...")
     try:
         await dp.start_polling(bot)
     finally:
+        await engine.stop()
         scheduler.shutdown(wait=False)
+        await message_cache.stop()
         await bot.session.close()
+        await close_db()
 
 
 if __name__ == "__main__":
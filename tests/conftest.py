@@ -1 +1,29 @@
 """Shared test fixtures."""
+
+from __future__ import annotations
+
+import os
+
+import pytest_asyncio
+
+# app.config requires a token at import time; CI provides one, local runs may not
+os.environ.setdefault("BOT_TOKEN", "123456789:TEST")
+# Reminders fire exactly at their schedule time unless a test opts into jitter
+os.environ.setdefault("REMINDER_JITTER_SECONDS", "0")
+
+import app.db as db_module  # noqa: E402
+from app.services import medicine_service  # noqa: E402
+from app.services.dose_service import invalidate_today  # noqa: E402
+from app.services.settings_service import settings_cache  # noqa: E402
+
+
+@pytest_asyncio.fixture(autouse=True)
+async def db_path(tmp_path):
+    """Point the pool and the writer at a fresh temp database for each test."""
+    path = str(tmp_path / "test.db")
+    db_module.configure_db(path)
+    settings_cache.clear()
+    medicine_service._medicine_cache.clear()
+    invalidate_today()
+    yield path
+    await db_module.close_db()
@@ -0,0 +1,219 @@
+"""Tests for the SQLite connection pool."""
+
+from __future__ import annotations
+
+import asyncio
+
+import pytest
+
+from app.config import settings
+from app.db import (
+    ConnectionPool,
+    DoseStatus,
+    get_db,
+    get_last_message_id,
+    init_db,
+    set_last_message_id,
+)
+from app.timeutils import local_to_epoch
+
+
+@pytest.mark.asyncio
+async def test_pool_reuses_connections(db_path):
+    pool = ConnectionPool(db_path, size=2)
+    try:
+        async with pool.acquire() as db:
+            first = db
+        async with pool.acquire() as db:
+            assert db is first
+            cursor = await db.execute("PRAGMA foreign_keys")
+            assert (await cursor.fetchone())[0] == 1
+    finally:
+        await pool.close()
+
+
+@pytest.mark.asyncio
+async def test_pool_is_bounded(db_path):
+    pool = ConnectionPool(db_path, size=1)
+    try:
+        borrowed: list[str] = []
+
+        async def borrow() -> None:
+            async with pool.acquire():
+                borrowed.append("second")
+
+        async with pool.acquire():
+            task = asyncio.create_task(borrow())
+            await asyncio.sleep(0.05)
+            assert borrowed == []
+        await asyncio.wait_for(task, timeout=1)
+        assert borrowed == ["second"]
+    finally:
+        await pool.close()
+
+
+@pytest.mark.asyncio
+async def test_pool_replaces_dead_connection(db_path):
+    pool = ConnectionPool(db_path, size=1, health_check_after=0)
+    try:
+        async with pool.acquire() as db:
+            dead = db
+        await dead.close()
+        async with pool.acquire() as db:
+            assert db is not dead
+            await db.execute("SELECT 1")
+    finally:
+        await pool.close()
+
+
+@pytest.mark.asyncio
+async def test_pool_rolls_back_uncommitted_work(db_path):
+    pool = ConnectionPool(db_path, size=1)
+    try:
+        async with pool.acquire() as db:
+            await db.execute("CREATE TABLE t (x INTEGER)")
+            await db.commit()
+        with pytest.raises(RuntimeError):
+            async with pool.acquire() as db:
+                await db.execute("INSERT INTO t VALUES (1)")
+                raise RuntimeError("boom")
+        async with pool.acquire() as db:
+            cursor = await db.execute("SELECT COUNT(*) FROM t")
+            assert (await cursor.fetchone())[0] == 0
+    finally:
+        await pool.close()
+
+
+@pytest.mark.asyncio
+async def test_last_message_id_roundtrip():
+    await init_db()
+    from app.services.medicine_service import ensure_user
+
+    await ensure_user(111)
+    assert await get_last_message_id(111) is None
+    await set_last_message_id(111, 42)
+    assert await get_last_message_id(111) == 42
+
+
+@pytest.mark.asyncio
+async def test_migrations_are_versioned_and_idempotent():
+    from app.migrations import SCHEMA_VERSION
+
+    await init_db()
+    await init_db()
+
+    db = await get_db()
+    try:
+        cursor = await db.execute("PRAGMA user_version")
+        assert (await cursor.fetchone())[0] == SCHEMA_VERSION
+        cursor = await db.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND name LIKE 'idx_%'"
+        )
+        names = {r[0] for r in await cursor.fetchall()}
+        assert {"idx_doses_status_next_reminder", "idx_medicines_user"} <= names
+    finally:
+        await db.close()
+
+
+@pytest.mark.asyncio
+async def test_migrations_upgrade_legacy_schema(db_path):
+    db = await get_db()
+    try:
+        await db.executescript(
+            """
+            CREATE TABLE users (id INTEGER PRIMARY KEY, telegram_id INTEGER UNIQUE NOT NULL,
+                                created_at TEXT NOT NULL);
+            CREATE TABLE doses (id INTEGER PRIMARY KEY, medicine_id INTEGER NOT NULL,
+                                schedule_id INTEGER, scheduled_datetime TEXT NOT NULL,
+                                status TEXT NOT NULL, taken_at TEXT,
+                                reminder_sent INTEGER DEFAULT 0,
+                                reminder_count INTEGER DEFAULT 0, next_reminder_at TEXT);
+            INSERT INTO doses (medicine_id, schedule_id, scheduled_datetime, status,
+                               next_reminder_at)
+            VALUES (1, 1, '2025-06-15 08:00', 'taken', NULL),
+                   (1, 2, '2025-06-15 20:00', 'scheduled', '2025-06-15 20:10');
+            """
+        )
+        await db.commit()
+    finally:
+        await db.close()
+
+    await init_db()
+
+    db = await get_db()
+    try:
+        cursor = await db.execute("PRAGMA table_info(doses)")
+        assert "message_id" in {r[1] for r in await cursor.fetchall()}
+        cursor = await db.execute("PRAGMA table_info(users)")
+        assert "last_message_id" in {r[1] for r in await cursor.fetchall()}
+
+        cursor = await db.execute(
+            "SELECT status, scheduled_at, dose_date, next_reminder_at FROM doses ORDER BY id"
+        )
+        rows = [tuple(r) for r in await cursor.fetchall()]
+        morning = local_to_epoch("2025-06-15 08:00", settings.timezone)
+        evening = local_to_epoch("2025-06-15 20:00", settings.timezone)
+        assert rows == [
+            (DoseStatus.TAKEN, morning, "2025-06-15", morning),
+            (DoseStatus.SCHEDULED, evening, "2025-06-15", evening + 600),
+        ]
+    finally:
+        await db.close()
+
+
+@pytest.mark.asyncio
+async def test_write_queue_group_commits_and_isolates_failures(db_path):
+    from app.db import WriteQueue
+
+    await init_db()
+    writer = WriteQueue(db_path, batch_window=0.05)
+
+    async def insert(telegram_id: int) -> int:
+        async def op(db):
+            cursor = await db.execute(
+                "INSERT INTO users (telegram_id, created_at) VALUES (?, 'now')",
+                (telegram_id,),
+            )
+            return cursor.lastrowid
+
+        return await writer.submit(op)
+
+    try:
+        results = await asyncio.gather(
+            insert(1), insert(2), insert(1), insert(3), return_exceptions=True
+        )
+        assert isinstance(results[2], Exception)  # UNIQUE violation
+        assert all(isinstance(r, int) for i, r in enumerate(results) if i != 2)
+        assert writer.batches_committed == 1
+        assert writer.operations_committed == 4
+    finally:
+        await writer.close()
+
+    db = await get_db()
+    try:
+        cursor = await db.execute("SELECT telegram_id FROM users ORDER BY telegram_id")
+        assert [r[0] for r in await cursor.fetchall()] == [1, 2, 3]
+        cursor = await db.execute("PRAGMA journal_mode")
+        assert (await cursor.fetchone())[0] == "wal"
+    finally:
+        await db.close()
+
+
+@pytest.mark.asyncio
+async def test_closed_database_is_not_reopened_implicitly(db_path):
+    from app.db import acquire, close_db, configure_db, write
+
+    await init_db()
+    await close_db()
+
+    async def op(db):
+        await db.execute("SELECT 1")
+
+    with pytest.raises(RuntimeError, match="closed"):
+        await write(op)
+    with pytest.raises(RuntimeError, match="closed"):
+        async with acquire():
+            pass
+
+    configure_db(db_path)
+    await write(op)
@@ -0,0 +1,50 @@
+"""Tests for the rate-limited delivery engine."""
+
+from __future__ import annotations
+
+import time
+
+import pytest
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import SendMessage
+
+from app.delivery import DeliveryEngine, DeliveryJob, RateLimiter, TokenBucket
+
+
+def test_token_bucket_reservations_are_spaced_by_rate():
+    bucket = TokenBucket(rate=10, capacity=1)
+    delays = [bucket.reserve() for _ in range(3)]
+    assert delays[0] == 0
+    assert delays[1] == pytest.approx(0.1, abs=0.01)
+    assert delays[2] == pytest.approx(0.2, abs=0.01)
+
+
+@pytest.mark.asyncio
+async def test_delivery_limits_per_chat_and_retries_after_flood():
+    limiter = RateLimiter(global_rate=1000, private_rate=20)
+    engine = DeliveryEngine(limiter, concurrency=8)
+    sent_at: dict[int, list[float]] = {}
+    flooded = {"done": False}
+
+    def make_job(chat_id: int) -> DeliveryJob:
+        async def send() -> int:
+            if chat_id == 3 and not flooded["done"]:
+                flooded["done"] = True
+                raise TelegramRetryAfter(
+                    method=SendMessage(chat_id=chat_id, text="x"), message="", retry_after=0
+                )
+            sent_at.setdefault(chat_id, []).append(time.monotonic())
+            return chat_id
+
+        return DeliveryJob(chat_id=chat_id, send=send, key=chat_id)
+
+    jobs = [make_job(1) for _ in range(3)] + [make_job(2), make_job(3)]
+    stats = await engine.deliver(jobs)
+
+    assert stats.queued == 5
+    assert stats.sent == 5
+    assert stats.failed == 0
+    assert stats.retried == 1
+    times = sent_at[1]
+    # Same chat is throttled to ~20 msg/s
+    assert times[2] - times[0] >= 0.09
@@ -4,23 +4,18 @@ from __future__ import annotations
 
 import pytest
 
-import app.db as db_module
-from app.db import get_db
+from app.config import settings
+from app.db import get_db, init_db
+from app.timeutils import local_to_epoch
+
+
+def _ts(local_str: str) -> int:
+    return local_to_epoch(local_str, settings.timezone)
 
 
 async def _reset_db() -> None:
-    """Drop all tables and recreate the schema."""
-    db = await get_db()
-    try:
-        await db.execute("DROP TABLE IF EXISTS user_settings")
-        await db.execute("DROP TABLE IF EXISTS doses")
-        await db.execute("DROP TABLE IF EXISTS schedules")
-        await db.execute("DROP TABLE IF EXISTS medicines")
-        await db.execute("DROP TABLE IF EXISTS users")
-        await db.executescript(db_module.SCHEMA)
-        await db.commit()
-    finally:
-        await db.close()
+    """Create the schema in the (fresh, per-test) database."""
+    await init_db()
 
 
 async def _seed_data() -> None:
@@ -61,6 +56,27 @@ async def test_generate_daily_doses():
     assert created2 == 0
 
 
+@pytest.mark.asyncio
+async def test_generate_daily_doses_chunked_and_concurrent():
+    await _seed_data()
+    import asyncio
+
+    from app.services.dose_service import generate_daily_doses
+
+    results = await asyncio.gather(
+        generate_daily_doses("2025-06-15", chunk_size=1),
+        generate_daily_doses("2025-06-15", chunk_size=1),
+    )
+    assert sum(results) == 2
+
+    db = await get_db()
+    try:
+        cursor = await db.execute("SELECT COUNT(*) FROM doses")
+        assert (await cursor.fetchone())[0] == 2
+    finally:
+        await db.close()
+
+
 @pytest.mark.asyncio
 async def test_mark_taken():
     await _seed_data()
@@ -68,11 +84,13 @@ async def test_mark_taken():
 
     await generate_daily_doses("2025-06-15")
 
-    success = await mark_taken(1, "2025-06-15 08:03")
-    assert success is True
+    dose = await mark_taken(1, "2025-06-15 08:03")
+    assert dose["status"] == "taken"
+    assert dose["taken_at"] == "2025-06-15 08:03"
+    assert dose["medicine_name"] == "TestMed"
 
-    success2 = await mark_taken(1, "2025-06-15 08:05")
-    assert success2 is True
+    # A second tap is rejected instead of overwriting taken_at
+    assert await mark_taken(1, "2025-06-15 08:05") is None
 
 
 @pytest.mark.asyncio
@@ -82,17 +100,21 @@ async def test_snooze():
 
     await generate_daily_doses("2025-06-15")
 
-    success, interval = await snooze(1)
-    assert success is True
+    dose = await snooze(1, 10, _ts("2025-06-15 08:05"))
+    assert dose["status"] == "scheduled"
+    assert dose["medicine_name"] == "TestMed"
+    assert dose["next_reminder_at"] == _ts("2025-06-15 08:15")
 
     db = await get_db()
     try:
         cursor = await db.execute(
-            "SELECT scheduled_datetime, reminder_sent FROM doses WHERE id = 1"
+            "SELECT scheduled_at, next_reminder_at, reminder_sent, snoozed FROM doses WHERE id = 1"
         )
         row = await cursor.fetchone()
-        assert row[0] == "2025-06-15 08:10"
-        assert row[1] == 0
+        # The dose keeps its slot; only the next reminder moves
+        assert row[0] == _ts("2025-06-15 08:00")
+        assert row[1] == _ts("2025-06-15 08:15")
+        assert (row[2], row[3]) == (0, 1)
     finally:
         await db.close()
 
@@ -104,11 +126,14 @@ async def test_process_missed():
 
     await generate_daily_doses("2025-06-15")
 
-    count = await process_missed_doses("2025-06-15 09:59")
+    # Doses are reminded until the end of their local day…
+    count = await process_missed_doses(_ts("2025-06-15 23:59"))
     assert count == 0
 
-    count = await process_missed_doses("2025-06-15 10:01")
-    assert count == 1
+    # …and both roll over to missed at midnight
+    count = await process_missed_doses(_ts("2025-06-16 00:00"))
+    assert count == 2
+    assert await process_missed_doses(_ts("2025-06-16 00:01")) == 0
 
 
 @pytest.mark.asyncio
@@ -121,23 +146,48 @@ async def test_allowed_transition_missed_to_taken():
     )
 
     await generate_daily_doses("2025-06-15")
-    await process_missed_doses("2025-06-15 10:01")
+    assert await process_missed_doses(_ts("2025-06-16 00:00")) == 2
 
-    success = await mark_taken(1, "2025-06-15 10:05")
-    assert success is True
+    dose = await mark_taken(1, "2025-06-16 08:05")
+    assert dose["status"] == "taken"
 
 
 @pytest.mark.asyncio
-async def test_get_due_reminders():
+async def test_transitions_follow_allowed_table():
     await _seed_data()
-    from app.services.dose_service import generate_daily_doses, get_due_reminders
+    from app.services.dose_service import (
+        generate_daily_doses,
+        mark_skipped,
+        mark_taken,
+        snooze,
+        unmark_dose,
+    )
 
     await generate_daily_doses("2025-06-15")
+    assert await unmark_dose(1, _ts("2025-06-15 08:05")) is None  # already scheduled
+    assert (await mark_skipped(1))["status"] == "skipped"
+    assert await snooze(1, 10, _ts("2025-06-15 08:05")) is None
+    assert (await mark_taken(1, "2025-06-15 08:06"))["status"] == "taken"
+
+    dose = await unmark_dose(1, _ts("2025-06-15 08:07"))
+    assert dose["status"] == "scheduled"
+    assert dose["taken_at"] is None
+    assert await mark_taken(999, "2025-06-15 08:06") is None
+
 
-    due = await get_due_reminders("2025-06-15 07:59")
-    assert len(due) == 0
+@pytest.mark.asyncio
+async def test_due_reminders_are_enqueued_and_claimed():
+    await _seed_data()
+    from app.services.dose_service import generate_daily_doses
+    from app.services.outbox_service import claim_deliveries, enqueue_due_reminders
 
-    due = await get_due_reminders("2025-06-15 08:00")
+    await generate_daily_doses("2025-06-15")
+
+    assert await enqueue_due_reminders(_ts("2025-06-15 07:59")) == 0
+
+    now = _ts("2025-06-15 08:00")
+    assert await enqueue_due_reminders(now) == 1
+    due = await claim_deliveries(now)
     assert len(due) == 1
     assert due[0]["medicine_name"] == "TestMed"
     assert due[0]["telegram_id"] == 12345
@@ -154,3 +204,171 @@ async def test_get_today_doses():
     assert len(doses) == 2
     assert doses[0]["scheduled_datetime"] == "2025-06-15 08:00"
     assert doses[1]["scheduled_datetime"] == "2025-06-15 20:00"
+
+
+@pytest.mark.asyncio
+async def test_today_cache_patched_by_transitions():
+    await _seed_data()
+    from app.services import dose_service
+    from app.services.dose_service import (
+        generate_daily_doses,
+        get_today_entry,
+        mark_taken,
+    )
+
+    await generate_daily_doses("2025-06-15")
+    entry = await get_today_entry(12345, "2025-06-15")
+    entry.rendered = "rendered"
+
+    await mark_taken(1, "2025-06-15 08:03")
+    assert await get_today_entry(12345, "2025-06-15") is entry  # patched, not reloaded
+    assert entry.rendered is None
+    assert [d["status"] for d in entry.doses] == ["taken", "scheduled"]
+    assert entry.doses[0]["taken_at"] == "2025-06-15 08:03"
+
+    # Generating another day keeps the cached one; new doses for it drop it
+    await generate_daily_doses("2025-06-16")
+    assert dose_service._today_cache[12345] is entry
+    db = await get_db()
+    try:
+        await db.execute("INSERT INTO schedules (medicine_id, time) VALUES (1, '12:00')")
+        await db.commit()
+    finally:
+        await db.close()
+    await generate_daily_doses("2025-06-15")
+    assert 12345 not in dose_service._today_cache
+    assert len((await get_today_entry(12345, "2025-06-15")).doses) == 3
+
+
+@pytest.mark.asyncio
+async def test_catch_up_fills_downtime_window():
+    await _seed_data()
+    from app.db import set_state
+    from app.services.dose_service import LAST_PROCESSED_KEY, catch_up
+
+    # Fresh database: today plus the two-day horizon
+    result = await catch_up("2025-06-13", _ts("2025-06-13 09:00"))
+    assert (result["start"], result["days"], result["created"]) == ("2025-06-13", 1, 6)
+
+    # Bot was down for two nights: the horizon already covered up to the 15th
+    result = await catch_up("2025-06-15", _ts("2025-06-15 09:00"))
+    assert (result["start"], result["end"], result["days"]) == ("2025-06-13", "2025-06-15", 3)
+    assert result["created"] == 4  # 16th and 17th
+    assert result["missed"] == 4  # both of the 13th and 14th
+
+    db = await get_db()
+    try:
+        cursor = await db.execute(
+            "SELECT dose_date, COUNT(*) FROM doses WHERE status = 2 GROUP BY dose_date"
+        )
+        assert [tuple(r) for r in await cursor.fetchall()] == [
+            ("2025-06-13", 2),
+            ("2025-06-14", 2),
+        ]
+        await db.execute("UPDATE medicines SET created_at = '2025-06-20T10:00:00+00:00'")
+        await db.commit()
+    finally:
+        await db.close()
+
+    # Days before the medicine existed are not backfilled
+    await set_state(LAST_PROCESSED_KEY, "2025-06-16")
+    result = await catch_up("2025-06-21", _ts("2025-06-21 09:00"))
+    assert result["created"] == 8  # 20th through the horizon (23rd) only
+
+
+@pytest.mark.asyncio
+async def test_first_reminder_is_jittered_per_user(monkeypatch):
+    await _reset_db()
+    from app.services import dose_service
+    from app.services.medicine_service import add_medicine
+    from app.timeutils import user_jitter
+
+    monkeypatch.setattr(dose_service, "REMINDER_JITTER_SECONDS", 30)
+    for telegram_id in range(100, 110):
+        await add_medicine(telegram_id, "Med", "", ["08:00:15"], generate_for="2025-06-15")
+
+    db = await get_db()
+    try:
+        cursor = await db.execute(
+            """
+            SELECT m.user_id, d.scheduled_at, d.next_reminder_at, d.scheduled_datetime
+            FROM doses d JOIN medicines m ON d.medicine_id = m.id
+            WHERE d.dose_date = '2025-06-15'
+            """
+        )
+        rows = await cursor.fetchall()
+    finally:
+        await db.close()
+
+    assert len(rows) == 10
+    assert {r[3] for r in rows} == {"2025-06-15 08:00:15"}
+    assert len({r[1] for r in rows}) == 1  # same nominal instant, to the second
+    offsets = [r[2] - r[1] for r in rows]
+    assert offsets == [user_jitter(r[0], 30) for r in rows]
+    assert all(0 <= o <= 30 for o in offsets)
+    assert len(set(offsets)) > 5  # spread across the window
+
+
+@pytest.mark.asyncio
+async def test_take_pending_doses_in_bulk():
+    await _seed_data()
+    from app.services.dose_service import (
+        generate_daily_doses,
+        get_today_doses,
+        mark_skipped,
+        take_pending_doses,
+    )
+
+    for day in ("2025-06-14", "2025-06-15", "2025-06-16"):
+        await generate_daily_doses(day)
+    doses = await get_today_doses(12345, "2025-06-15")
+    morning, evening = (d["dose_id"] for d in doses)
+    await mark_skipped(evening)
+
+    # Everything due by noon on the 15th: both of the 14th's doses and the 08:00 one
+    noon = _ts("2025-06-15 12:00")
+    taken = await take_pending_doses(12345, "2025-06-15 12:00", due_by=noon)
+    assert sorted(d["scheduled_datetime"] for d in taken) == [
+        "2025-06-14 08:00", "2025-06-14 20:00", "2025-06-15 08:00",
+    ]
+    assert await take_pending_doses(12345, "2025-06-15 12:01", due_by=noon) == []
+    assert await take_pending_doses(99999, "2025-06-15 12:01") == []
+
+    # One time slot; the skipped dose is left alone
+    assert await take_pending_doses(12345, "2025-06-15 12:02", slot_of=evening) == []
+    tomorrow = [d["dose_id"] for d in await get_today_doses(12345, "2025-06-16")]
+    taken = await take_pending_doses(12345, "2025-06-15 12:03", slot_of=tomorrow[0])
+    assert [d["dose_id"] for d in taken] == [tomorrow[0]]
+    assert [d["status"] for d in await get_today_doses(12345, "2025-06-15")] == [
+        "taken", "skipped",
+    ]
+
+
+@pytest.mark.asyncio
+async def test_reset_reminder_keeps_the_user_jitter(monkeypatch):
+    await _reset_db()
+    from app.services import dose_service, outbox_service
+    from app.services.dose_service import get_today_doses, mark_taken, unmark_dose
+    from app.services.medicine_service import add_medicine, ensure_user
+    from app.services.outbox_service import claim_deliveries, enqueue_due_reminders
+    from app.timeutils import user_jitter
+
+    monkeypatch.setattr(dose_service, "REMINDER_JITTER_SECONDS", 30)
+    monkeypatch.setattr(outbox_service, "REMINDER_JITTER_SECONDS", 30)
+    await add_medicine(12345, "Med", "", ["08:00", "20:00"], generate_for="2025-06-15")
+    offset = user_jitter(await ensure_user(12345), 30)
+    first, second = (d["dose_id"] for d in await get_today_doses(12345, "2025-06-15"))
+    await mark_taken(first, "2025-06-15 07:55")
+    await mark_taken(second, "2025-06-15 07:55")
+
+    # Reset after the 08:00 slot: reminded from now, jittered as usual
+    reset_at = _ts("2025-06-15 09:00")
+    assert (await unmark_dose(first, reset_at))["next_reminder_at"] == reset_at + offset
+    # Reset before the 20:00 slot: reminded at the slot, jittered the same way
+    evening = _ts("2025-06-15 20:00")
+    assert (await unmark_dose(second, reset_at))["next_reminder_at"] == evening + offset
+
+    # …so the lag is measured from the unjittered due time
+    await enqueue_due_reminders(evening + offset)
+    batch = {r["dose_id"]: r for r in await claim_deliveries(evening + offset)}
+    assert (batch[first]["nominal_at"], batch[second]["nominal_at"]) == (reset_at, evening)
@@ -0,0 +1,59 @@
+"""Tests for the in-memory due queue and reminder engine."""
+
+from __future__ import annotations
+
+import asyncio
+import time
+
+import pytest
+
+from app.due_queue import DueQueue, ReminderEngine
+
+
+def test_due_queue_orders_and_reschedules():
+    queue = DueQueue()
+    queue.schedule(1, 300)
+    queue.schedule(2, 100)
+    queue.schedule(3, 200)
+    assert queue.peek() == 100
+
+    queue.schedule(2, 400)  # snoozed past the others
+    queue.discard(3)  # taken
+    assert queue.peek() == 300
+    assert queue.pop_due(350) == [1]
+    assert queue.pop_due(350) == []
+    assert len(queue) == 1
+    assert queue.pop_due(400) == [2]
+    assert queue.peek() is None
+
+
+@pytest.mark.asyncio
+async def test_engine_fires_at_deadline_and_reloads():
+    queue = DueQueue()
+    fired: list[list[int]] = []
+    deadlines: list[int] = []
+    loaded = asyncio.Event()
+
+    first_at = int(time.time()) - 1
+
+    async def reload(until_ts: int) -> list[tuple[int, int]]:
+        loaded.set()
+        return [(7, first_at)]
+
+    async def on_due(dose_ids: list[int], deadline: int) -> None:
+        fired.append(dose_ids)
+        deadlines.append(deadline)
+
+    engine = ReminderEngine(queue, on_due=on_due, reload=reload, reload_interval=60)
+    engine.start()
+    try:
+        await asyncio.wait_for(loaded.wait(), timeout=1)
+        await asyncio.sleep(0.05)
+        assert fired == [[7]]
+        assert deadlines == [first_at]
+
+        queue.schedule(8, int(time.time()))
+        await asyncio.sleep(0.05)
+        assert fired == [[7], [8]]
+    finally:
+        await engine.stop()
@@ -4,23 +4,18 @@ from __future__ import annotations
 
 import pytest
 
-import app.db as db_module
-from app.db import get_db
+from app.config import settings
+from app.db import get_db, init_db
+from app.timeutils import local_to_epoch
+
+
+def _ts(local_str: str) -> int:
+    return local_to_epoch(local_str, settings.timezone)
 
 
 async def _reset_db() -> None:
-    """Drop all tables and recreate the schema."""
-    db = await get_db()
-    try:
-        await db.execute("DROP TABLE IF EXISTS user_settings")
-        await db.execute("DROP TABLE IF EXISTS doses")
-        await db.execute("DROP TABLE IF EXISTS schedules")
-        await db.execute("DROP TABLE IF EXISTS medicines")
-        await db.execute("DROP TABLE IF EXISTS users")
-        await db.executescript(db_module.SCHEMA)
-        await db.commit()
-    finally:
-        await db.close()
+    """Create the schema in the (fresh, per-test) database."""
+    await init_db()
 
 
 @pytest.mark.asyncio
@@ -119,3 +114,101 @@ async def test_delete_medicine():
     # Delete non-existent returns False
     result = await delete_medicine(99999)
     assert result is False
+
+
+@pytest.mark.asyncio
+async def test_add_medicine_generates_only_its_doses():
+    await _reset_db()
+    from app.services.dose_service import generate_doses, get_today_doses
+    from app.services.medicine_service import add_medicine
+
+    await add_medicine(11111, "Other", "1 tab", ["09:00"])
+    med_id = await add_medicine(
+        99999, "Fresh", "1 tab", ["08:00", "20:00"], generate_for="2025-06-15"
+    )
+
+    assert len(await get_today_doses(99999, "2025-06-15")) == 2
+    assert await get_today_doses(11111, "2025-06-15") == []
+
+    # Date range scoped to the medicine: the horizon (to the 17th) already
+    # exists, 2 more for the day after it
+    created = await generate_doses("2025-06-15", "2025-06-18", medicine_id=med_id)
+    assert created == 2
+    assert len(await get_today_doses(99999, "2025-06-18")) == 2
+    assert await get_today_doses(11111, "2025-06-18") == []
+
+
+@pytest.mark.asyncio
+async def test_schedule_edit_regenerates_only_future_doses():
+    await _reset_db()
+    from app.services.dose_service import get_today_doses, mark_taken
+    from app.services.medicine_service import add_medicine, update_schedule_time
+
+    await add_medicine(99999, "Med", "1 tab", ["08:00", "20:00"], generate_for="2025-06-15")
+    await mark_taken(1, "2025-06-15 08:01")
+
+    assert await update_schedule_time(1, "09:30", _ts("2025-06-15 12:00")) is True
+    times = [d["scheduled_datetime"] for d in await get_today_doses(99999, "2025-06-15")]
+    assert times == ["2025-06-15 08:00", "2025-06-15 20:00"]  # today's taken dose kept
+    times = [d["scheduled_datetime"] for d in await get_today_doses(99999, "2025-06-16")]
+    assert times == ["2025-06-16 09:30", "2025-06-16 20:00"]
+
+    db = await get_db()
+    try:
+        cur = await db.execute("SELECT COUNT(*) FROM doses WHERE schedule_id = 2")
+        assert (await cur.fetchone())[0] == 3  # untouched schedule kept its rows
+    finally:
+        await db.close()
+    assert await update_schedule_time(999, "10:00", _ts("2025-06-15 12:00")) is False
+
+
+@pytest.mark.asyncio
+async def test_schedule_edit_uses_owner_time_zone():
+    await _reset_db()
+    from app.services.dose_service import get_today_doses
+    from app.services.medicine_service import add_medicine, ensure_user, update_schedule_time
+    from app.services.settings_service import set_user_timezone
+
+    await ensure_user(99999)
+    await set_user_timezone(99999, "Pacific/Auckland")
+    await add_medicine(99999, "Med", "1 tab", ["08:00"], generate_for="2025-06-16")
+
+    # 22:00 in the default zone is already the morning of the 16th in Auckland:
+    # the regeneration starts there, not on the (past) 15th
+    now_ts = _ts("2025-06-15 22:00")
+    assert await update_schedule_time(1, "09:30", now_ts) is True
+    assert await get_today_doses(99999, "2025-06-15") == []
+    times = [d["scheduled_datetime"] for d in await get_today_doses(99999, "2025-06-16")]
+    assert times == ["2025-06-16 09:30"]
+
+
+@pytest.mark.asyncio
+async def test_user_medicines_cached_until_add_or_delete():
+    await _reset_db()
+    from app.services.medicine_service import (
+        add_medicine,
+        delete_medicine,
+        get_user_medicines,
+    )
+
+    med_id = await add_medicine(99999, "Med A", "1 tab", ["21:00", "08:00"])
+    medicines = await get_user_medicines(99999)
+    assert medicines[0]["times"] == ["08:00", "21:00"]
+
+    # Served from the cache: a direct DB change is not visible…
+    db = await get_db()
+    try:
+        await db.execute("UPDATE medicines SET name = 'Renamed'")
+        await db.commit()
+    finally:
+        await db.close()
+    medicines[0]["times"].append("23:00")  # …and callers get copies
+    assert await get_user_medicines(99999) == [
+        {"id": med_id, "name": "Med A", "dosage": "1 tab", "times": ["08:00", "21:00"]}
+    ]
+
+    # …until add/delete invalidates it
+    await add_medicine(99999, "Med B", "2 tab", ["09:00"])
+    assert [m["name"] for m in await get_user_medicines(99999)] == ["Med B", "Renamed"]
+    await delete_medicine(med_id)
+    assert [m["name"] for m in await get_user_medicines(99999)] == ["Med B"]
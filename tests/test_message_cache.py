@@ -0,0 +1,82 @@
+"""Tests for the last-message-id LRU cache with write-behind."""
+
+from __future__ import annotations
+
+import pytest
+
+from app.db import get_db, get_last_message_id, init_db
+from app.message_cache import LastMessageCache
+
+
+async def _seed_users(*telegram_ids: int) -> None:
+    await init_db()
+    db = await get_db()
+    try:
+        await db.executemany(
+            "INSERT INTO users (telegram_id, created_at, last_message_id) VALUES (?, ?, ?)",
+            [(tid, "2025-01-01T00:00:00", tid * 10) for tid in telegram_ids],
+        )
+        await db.commit()
+    finally:
+        await db.close()
+
+
+@pytest.mark.asyncio
+async def test_loads_lazily_and_writes_behind():
+    await _seed_users(1, 2)
+    cache = LastMessageCache()
+
+    assert await cache.get(1) == 10
+    assert await cache.get(1) == 10
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    cache.set(1, 11)
+    cache.set(2, 21)
+    assert await cache.get(1) == 11
+    assert await get_last_message_id(1) == 10  # not yet persisted
+    assert cache.pending == 2
+
+    assert await cache.flush() == 2
+    assert cache.pending == 0
+    assert await get_last_message_id(1) == 11
+    assert await get_last_message_id(2) == 21
+
+
+@pytest.mark.asyncio
+async def test_lru_eviction_keeps_unflushed_ids():
+    await _seed_users(1, 2, 3)
+    cache = LastMessageCache(capacity=2)
+
+    cache.set(1, 100)
+    await cache.get(2)
+    await cache.get(3)  # evicts chat 1, which is still dirty
+    assert len(cache) == 2
+    assert await cache.get(1) == 100
+
+    await cache.stop()
+    assert await get_last_message_id(1) == 100
+
+
+@pytest.mark.asyncio
+async def test_reads_during_flush_see_the_pending_id(monkeypatch):
+    await _seed_users(1, 2)
+    from app import message_cache as module
+
+    cache = LastMessageCache(capacity=1)
+    cache.set(1, 100)
+    await cache.get(2)  # evicts chat 1, which is still dirty
+
+    seen = []
+    write = module.set_last_message_ids
+
+    async def slow_write(pairs):
+        # Mid-flush: chat 1 is neither in the LRU nor committed yet
+        seen.append(await cache.get(1))
+        cache.set(2, 200)
+        await write(pairs)
+
+    monkeypatch.setattr(module, "set_last_message_ids", slow_write)
+    assert await cache.flush() == 1
+    assert seen == [100]
+    assert cache.pending == 1  # chat 2 changed during the flush
+    assert await get_last_message_id(1) == 100
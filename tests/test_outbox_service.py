@@ -0,0 +1,274 @@
+"""Tests for outbox_service — enqueue, claim, retries and crash recovery."""
+
+from __future__ import annotations
+
+import pytest
+
+from app.config import settings
+from app.db import OutboxState, get_db, init_db
+from app.timeutils import local_to_epoch
+
+
+def _ts(local_str: str) -> int:
+    return local_to_epoch(local_str, settings.timezone)
+
+
+async def _seed_doses() -> None:
+    """Create one user with a single 08:00 dose on 2025-06-15."""
+    await init_db()
+    from app.services.medicine_service import add_medicine
+
+    await add_medicine(12345, "TestMed", "1 tab", ["08:00"], generate_for="2025-06-15")
+
+
+async def _outbox_rows() -> list[tuple]:
+    db = await get_db()
+    try:
+        cursor = await db.execute("SELECT state, attempts, available_at FROM outbox ORDER BY id")
+        return [tuple(r) for r in await cursor.fetchall()]
+    finally:
+        await db.close()
+
+
+async def _dose_ids() -> list[int]:
+    db = await get_db()
+    try:
+        cursor = await db.execute("SELECT id FROM doses ORDER BY scheduled_at")
+        return [r[0] for r in await cursor.fetchall()]
+    finally:
+        await db.close()
+
+
+async def _dose_counters() -> tuple:
+    db = await get_db()
+    try:
+        cursor = await db.execute("SELECT reminder_count, next_reminder_at, message_id FROM doses")
+        return tuple(await cursor.fetchone())
+    finally:
+        await db.close()
+
+
+@pytest.mark.asyncio
+async def test_enqueue_is_idempotent_and_claim_completes():
+    await _seed_doses()
+    from app.services.outbox_service import (
+        claim_deliveries,
+        complete_deliveries,
+        enqueue_due_reminders,
+    )
+
+    now = _ts("2025-06-15 08:00")
+    assert await enqueue_due_reminders(now - 60) == 0
+    assert await enqueue_due_reminders(now) == 1
+    assert await enqueue_due_reminders(now) == 0
+
+    batch = await claim_deliveries(now)
+    assert len(batch) == 1
+    assert batch[0]["medicine_name"] == "TestMed"
+    assert batch[0]["telegram_id"] == 12345
+    assert await claim_deliveries(now) == []
+
+    await complete_deliveries([(batch[0]["outbox_id"], batch[0]["dose_id"], 777, 5)])
+    assert (await _outbox_rows())[0][0] == OutboxState.SENT
+    assert await _dose_counters() == (1, now + 300, 777)
+
+    # The next reminder gets its own outbox row once due
+    assert await enqueue_due_reminders(now + 300) == 1
+
+
+@pytest.mark.asyncio
+async def test_failures_back_off_then_give_up():
+    await _seed_doses()
+    from app.services import outbox_service
+    from app.services.outbox_service import (
+        claim_deliveries,
+        enqueue_due_reminders,
+        fail_delivery,
+    )
+
+    now = _ts("2025-06-15 08:00")
+    await enqueue_due_reminders(now)
+
+    row = (await claim_deliveries(now))[0]
+    retry_at = await fail_delivery(row["outbox_id"], row["dose_id"], "boom", now)
+    assert retry_at == now + outbox_service.OUTBOX_BACKOFF_BASE
+    assert await claim_deliveries(now) == []
+
+    # A RetryAfter hint overrides the backoff
+    row = (await claim_deliveries(retry_at))[0]
+    flood_at = retry_at
+    retry_at = await fail_delivery(row["outbox_id"], row["dose_id"], "flood", flood_at, 7)
+    assert retry_at == flood_at + 7
+
+    for _ in range(outbox_service.OUTBOX_MAX_ATTEMPTS - 2):
+        row = (await claim_deliveries(retry_at))[0]
+        retry_at = await fail_delivery(row["outbox_id"], row["dose_id"], "boom", retry_at)
+    assert retry_at is None
+    assert (await _outbox_rows())[0][0] == OutboxState.FAILED
+    # The dose moved on to its next reminder
+    assert (await _dose_counters())[0] == 1
+
+
+@pytest.mark.asyncio
+async def test_interrupted_send_is_not_repeated():
+    await _seed_doses()
+    from app.services import outbox_service
+    from app.services.outbox_service import (
+        claim_deliveries,
+        enqueue_due_reminders,
+        recover_stale_deliveries,
+    )
+
+    now = _ts("2025-06-15 08:00")
+    await enqueue_due_reminders(now)
+    await claim_deliveries(now)  # … and the process dies before recording
+
+    later = now + outbox_service.OUTBOX_LEASE_SECONDS + 1
+    assert await recover_stale_deliveries(later) == 1
+    assert (await _outbox_rows())[0][0] == OutboxState.UNKNOWN
+    assert await claim_deliveries(later) == []
+    assert await enqueue_due_reminders(later) == 0
+    assert (await _dose_counters())[:2] == (1, now + 300)
+
+
+@pytest.mark.asyncio
+async def test_complete_deliveries_batches_bookkeeping():
+    await init_db()
+    from app.services.medicine_service import add_medicine
+    from app.services.outbox_service import (
+        claim_deliveries,
+        complete_deliveries,
+        enqueue_due_reminders,
+    )
+
+    await add_medicine(12345, "TestMed", "1 tab", ["08:00", "08:00"], generate_for="2025-06-15")
+    now = _ts("2025-06-15 08:00")
+    await enqueue_due_reminders(now)
+    batch = await claim_deliveries(now)
+    assert len(batch) == 2
+
+    await complete_deliveries([
+        (row["outbox_id"], row["dose_id"], 500 + i, 10) for i, row in enumerate(batch)
+    ])
+    db = await get_db()
+    try:
+        cursor = await db.execute(
+            """
+            SELECT reminder_count, next_reminder_at, message_id FROM doses
+            WHERE dose_date = '2025-06-15' ORDER BY id
+            """
+        )
+        assert [tuple(r) for r in await cursor.fetchall()] == [
+            (1, now + 600, 500),
+            (1, now + 600, 501),
+        ]
+    finally:
+        await db.close()
+    assert [r[0] for r in await _outbox_rows()] == [OutboxState.SENT, OutboxState.SENT]
+
+
+@pytest.mark.asyncio
+async def test_reminder_cap_ends_in_unanswered():
+    await _seed_doses()
+    from app.services.dose_service import (
+        mark_taken,
+        process_unanswered_doses,
+        snooze,
+        unmark_dose,
+    )
+    from app.services.outbox_service import (
+        claim_deliveries,
+        complete_deliveries,
+        enqueue_due_reminders,
+    )
+    from app.services.settings_service import update_settings
+
+    await update_settings(12345, max_reminders=2)
+    now = _ts("2025-06-15 08:00")
+    for i in range(2):
+        at = now + i * 300
+        assert await enqueue_due_reminders(at) == 1
+        row = (await claim_deliveries(at))[0]
+        await complete_deliveries([(row["outbox_id"], row["dose_id"], 700 + i, 5)])
+
+    # The cap is used up: no third reminder, the dose gives up once it is due
+    later = now + 600
+    assert await enqueue_due_reminders(later) == 0
+    assert await process_unanswered_doses(later - 1) == 0
+    assert await process_unanswered_doses(later) == 1
+    assert await process_unanswered_doses(later) == 0
+
+    db = await get_db()
+    try:
+        cursor = await db.execute(
+            "SELECT id, status FROM doses WHERE dose_date = '2025-06-15'"
+        )
+        dose_id, status = await cursor.fetchone()
+    finally:
+        await db.close()
+    assert status == 4
+
+    # A snooze still gets its reminder past the cap; a late answer is accepted
+    assert (await snooze(dose_id, 5, _ts("2025-06-15 08:10")))["status"] == "scheduled"
+    assert await enqueue_due_reminders(later + 300) == 1
+    assert (await mark_taken(dose_id, "2025-06-15 08:16"))["status"] == "taken"
+
+    # Reset starts the dose over: it is reminded again, not given up on
+    reset_at = _ts("2025-06-15 08:20")
+    assert (await unmark_dose(dose_id, reset_at))["next_reminder_at"] == reset_at
+    assert await process_unanswered_doses(reset_at) == 0
+    assert await enqueue_due_reminders(reset_at) == 1
+    row = (await claim_deliveries(reset_at))[0]
+    assert (row["dose_id"], row["priority"]) == (dose_id, "first")
+
+
+@pytest.mark.asyncio
+async def test_reset_dose_reopens_cancelled_reminder():
+    await _seed_doses()
+    from app.services.dose_service import get_pending_reminders, mark_taken, unmark_dose
+    from app.services.outbox_service import claim_deliveries, enqueue_due_reminders
+
+    now = _ts("2025-06-15 08:00")
+    assert await enqueue_due_reminders(now) == 1
+    dose_id = (await _dose_ids())[0]
+    await mark_taken(dose_id, "2025-06-15 08:00")
+    assert await claim_deliveries(now) == []
+    assert (await _outbox_rows())[0][0] == OutboxState.CANCELLED
+
+    # Reset: the same reminder number is due again and goes out
+    await unmark_dose(dose_id, now)
+    later = now + 60
+    assert (dose_id, now) in await get_pending_reminders(later)
+    assert await enqueue_due_reminders(later) == 1
+    assert await enqueue_due_reminders(later) == 0
+    assert await _outbox_rows() == [(OutboxState.PENDING, 0, later)]
+    batch = await claim_deliveries(later)
+    assert [row["dose_id"] for row in batch] == [dose_id]
+
+
+@pytest.mark.asyncio
+async def test_snooze_during_retry_cancels_the_early_send():
+    await _seed_doses()
+    from app.services.dose_service import snooze
+    from app.services.outbox_service import (
+        claim_deliveries,
+        enqueue_due_reminders,
+        fail_delivery,
+    )
+
+    now = _ts("2025-06-15 08:00")
+    await enqueue_due_reminders(now)
+    row = (await claim_deliveries(now))[0]
+    retry_at = await fail_delivery(row["outbox_id"], row["dose_id"], "boom", now)
+    await snooze(row["dose_id"], 60, now)
+
+    # The retry would fire 59 minutes early: it is dropped instead
+    assert await claim_deliveries(retry_at + 1) == []
+    assert (await _outbox_rows())[0][0] == OutboxState.CANCELLED
+
+    # The snooze itself goes out when due
+    snoozed_at = now + 3600
+    assert await enqueue_due_reminders(snoozed_at - 1) == 0
+    assert await enqueue_due_reminders(snoozed_at) == 1
+    batch = await claim_deliveries(snoozed_at)
+    assert [(r["dose_id"], r["priority"]) for r in batch] == [(row["dose_id"], "snooze")]
@@ -0,0 +1,226 @@
+"""Tests for the reminder tick pipeline."""
+
+from __future__ import annotations
+
+import asyncio
+import time
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+import pytz
+
+from app.config import settings
+from app.db import OutboxState, get_db, init_db
+
+
+class FakeBot:
+    """Records sends; optionally blocks until released."""
+
+    def __init__(self) -> None:
+        self.sent: list[int] = []
+        self.release = asyncio.Event()
+        self.release.set()
+
+    async def send_message(self, chat_id: int, text: str, reply_markup=None):
+        await self.release.wait()
+        self.sent.append(chat_id)
+        return SimpleNamespace(message_id=100 + len(self.sent))
+
+    async def delete_message(self, chat_id: int, message_id: int) -> None:
+        return None
+
+
+async def _seed_due_dose() -> None:
+    """One dose today whose first reminder fell due a second ago."""
+    await init_db()
+    from app.services.medicine_service import add_medicine
+
+    today = datetime.now(pytz.timezone(settings.timezone)).strftime("%Y-%m-%d")
+    await add_medicine(12345, "TestMed", "1 tab", ["00:00"], generate_for=today)
+    db = await get_db()
+    try:
+        await db.execute(
+            "UPDATE doses SET next_reminder_at = ? WHERE dose_date = ?",
+            (int(time.time()) - 1, today),
+        )
+        await db.commit()
+    finally:
+        await db.close()
+
+
+@pytest.mark.asyncio
+async def test_tick_runs_pipeline_and_reports_stages():
+    await _seed_due_dose()
+    from app.scheduler import run_tick
+
+    bot = FakeBot()
+    scheduled_for = time.time() - 2
+    report = await run_tick(bot, scheduled_for=scheduled_for)
+
+    assert bot.sent == [12345]
+    assert (report.enqueued, report.sent, report.failed) == (1, 1, 0)
+    assert set(report.stages) == {"rollover", "select", "dispatch", "bookkeeping"}
+    assert report.lateness >= 2
+    # Delivery lag is measured against the due time (a second ago)
+    assert list(report.lags) == ["first"] and report.lags["first"][0] >= 1
+    assert "lag[first] p50=" in report.summary()
+
+    # Already sent: the next tick has nothing to do
+    report = await run_tick(bot)
+    assert (report.enqueued, report.sent) == (0, 0)
+    assert report.lateness is None
+
+
+@pytest.mark.asyncio
+async def test_ticks_never_overlap():
+    await _seed_due_dose()
+    from app.scheduler import run_tick
+
+    bot = FakeBot()
+    bot.release.clear()
+    first = asyncio.create_task(run_tick(bot))
+    await asyncio.sleep(0.05)
+
+    # A safety-net tick is skipped while one is running…
+    assert await run_tick(bot, trigger="safety", skip_if_running=True) is None
+    # …a due-driven tick waits for it and finds nothing left to send
+    second = asyncio.create_task(run_tick(bot))
+    await asyncio.sleep(0.05)
+    assert not second.done()
+
+    bot.release.set()
+    assert (await first).sent == 1
+    assert (await second).sent == 0
+    assert bot.sent == [12345]
+
+
+@pytest.mark.asyncio
+async def test_dispatch_paces_slots_in_priority_order(monkeypatch):
+    await init_db()
+    from app import scheduler
+    from app.delivery import SlotPacer
+    from app.services.medicine_service import add_medicine
+
+    today = datetime.now(pytz.timezone(settings.timezone)).strftime("%Y-%m-%d")
+    for telegram_id in (1, 2, 3, 4):
+        await add_medicine(telegram_id, "Med", "", ["00:00"], generate_for=today)
+    now = int(time.time())
+    db = await get_db()
+    try:
+        # 1 and 4: first reminders; 2: a repeat due long ago; 3: a snooze
+        await db.execute(
+            "UPDATE doses SET next_reminder_at = ? WHERE dose_date = ?", (now - 1, today)
+        )
+        await db.execute(
+            """
+            UPDATE doses SET reminder_count = 1, next_reminder_at = ?
+            WHERE dose_date = ? AND medicine_id = 2
+            """,
+            (now - 120, today),
+        )
+        await db.execute(
+            "UPDATE doses SET snoozed = 1 WHERE dose_date = ? AND medicine_id = 3", (today,)
+        )
+        await db.commit()
+    finally:
+        await db.close()
+
+    # One message per 50 ms slot
+    monkeypatch.setattr(
+        scheduler, "dispatch_pacer", SlotPacer(rate=1, window=3600, slot=0.05, max_rate=1)
+    )
+    bot = FakeBot()
+    report = await scheduler.run_tick(bot)
+
+    assert bot.sent == [1, 4, 2, 3]
+    assert report.depth == {"first": 2, "repeat": 1, "snooze": 1}
+    assert report.deferred == 3  # the backlog behind the first slot, counted once
+    assert set(report.lags) == {"first", "repeat", "snooze"}
+    assert report.lags["repeat"][0] >= 120
+
+
+def test_pacer_capacity_drains_backlog_within_window():
+    from app.delivery import SlotPacer
+
+    pacer = SlotPacer(rate=20, window=60, slot=1.0, max_rate=30)
+    assert pacer.capacity(10) == 20
+    assert pacer.capacity(1500) == 25  # 1500 / 60 s
+    assert pacer.capacity(100_000) == 30
+
+
+@pytest.mark.asyncio
+async def test_same_chat_doses_share_one_digest():
+    await init_db()
+    from app.scheduler import run_tick
+    from app.services.dose_service import get_message_doses, take_pending_doses
+    from app.services.medicine_service import add_medicine
+
+    today = datetime.now(pytz.timezone(settings.timezone)).strftime("%Y-%m-%d")
+    await add_medicine(12345, "Med A", "", ["00:00"], generate_for=today)
+    await add_medicine(12345, "Med B", "", ["00:00"], generate_for=today)
+    db = await get_db()
+    try:
+        await db.execute(
+            "UPDATE doses SET next_reminder_at = ? WHERE dose_date = ?",
+            (int(time.time()) - 1, today),
+        )
+        await db.commit()
+    finally:
+        await db.close()
+
+    bot = FakeBot()
+    report = await run_tick(bot)
+    assert bot.sent == [12345]
+    assert report.sent == 1
+
+    doses = await get_message_doses(12345, 101)
+    assert [d["medicine_name"] for d in doses] == ["Med A", "Med B"]
+    assert await get_message_doses(999, 101) == []
+
+    taken = await take_pending_doses(12345, f"{today} 00:05", message_id=101)
+    assert {d["status"] for d in taken} == {"taken"} and len(taken) == 2
+    assert await take_pending_doses(12345, f"{today} 00:06", message_id=101) == []
+
+
+class BlockedBot(FakeBot):
+    """The user blocked the bot: every send is forbidden."""
+
+    async def send_message(self, chat_id: int, text: str, reply_markup=None):
+        from aiogram.exceptions import TelegramForbiddenError
+
+        raise TelegramForbiddenError(method=None, message="Forbidden: bot was blocked by the user")
+
+
+@pytest.mark.asyncio
+async def test_blocked_user_is_deactivated_until_start():
+    await _seed_due_dose()
+    from app.scheduler import run_tick
+    from app.services.dose_service import generate_daily_doses, get_pending_reminders
+    from app.services.medicine_service import reactivate_user
+
+    report = await run_tick(BlockedBot())
+    assert (report.sent, report.failed, report.deactivated) == (0, 1, 1)
+    assert "deactivated=1" in report.summary()
+
+    # No retries, no due reminders, no new doses while inactive
+    db = await get_db()
+    try:
+        cursor = await db.execute("SELECT state FROM outbox")
+        assert [r[0] for r in await cursor.fetchall()] == [OutboxState.FAILED]
+        await db.execute("UPDATE doses SET next_reminder_at = ?", (int(time.time()) - 1,))
+        await db.commit()
+    finally:
+        await db.close()
+    bot = FakeBot()
+    assert (await run_tick(bot)).enqueued == 0
+    assert await get_pending_reminders(int(time.time())) == []
+    assert await generate_daily_doses("2030-01-01") == 0
+    assert await reactivate_user(99999) is False
+
+    # /start brings the user back
+    assert await reactivate_user(12345) is True
+    assert await reactivate_user(12345) is False
+    report = await run_tick(bot)
+    assert report.sent == 1 and bot.sent == [12345]
+    assert await generate_daily_doses("2030-01-01") == 1
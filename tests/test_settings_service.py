@@ -0,0 +1,110 @@
+"""Tests for settings_service — read-through cache, invalidation and time zones."""
+
+from __future__ import annotations
+
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+from app.config import settings
+from app.db import get_db, init_db
+from app.services.settings_service import (
+    DEFAULT_REMINDER_INTERVAL,
+    SettingsCache,
+    get_reminder_intervals,
+    get_settings_by_telegram_id,
+    get_user_settings,
+    get_user_timezone,
+    set_user_timezone,
+    settings_cache,
+    update_settings,
+)
+from app.timeutils import DATE_FMT, local_to_epoch, now_local
+
+
+@pytest.mark.asyncio
+async def test_settings_are_cached_and_invalidated_on_update():
+    await init_db()
+    from app.services.medicine_service import ensure_user
+
+    user_id = await ensure_user(12345)
+    first = await get_settings_by_telegram_id(12345)
+    assert first["reminder_interval_minutes"] == DEFAULT_REMINDER_INTERVAL
+    first["reminder_interval_minutes"] = 99  # callers get copies
+    assert (await get_settings_by_telegram_id(12345))["reminder_interval_minutes"] == 5
+    assert (settings_cache.hits, settings_cache.misses) == (1, 1)
+
+    assert (await get_user_settings(user_id))["reminder_interval_minutes"] == 5
+    await update_settings(12345, 15)
+    assert (await get_settings_by_telegram_id(12345))["reminder_interval_minutes"] == 15
+    assert (await get_user_settings(user_id))["reminder_interval_minutes"] == 15
+    assert await get_reminder_intervals([user_id, 777]) == {user_id: 15, 777: 5}
+
+    # Each value is updated on its own
+    await update_settings(12345, max_reminders=10)
+    assert await get_settings_by_telegram_id(12345) == {
+        "max_reminders": 10,
+        "reminder_interval_minutes": 15,
+        "timezone": settings.timezone,
+    }
+
+
+def test_cache_expires_and_is_bounded():
+    cache = SettingsCache(ttl=0, max_size=10)
+    cache.put("user", 1, {"reminder_interval_minutes": 5})
+    assert cache.get("user", 1) is None
+
+    cache = SettingsCache(ttl=60, max_size=2)
+    for user_id in (1, 2, 3):
+        cache.put("user", user_id, {"reminder_interval_minutes": user_id})
+    assert len(cache) == 2
+    assert cache.get("user", 1) is None
+    assert cache.get("user", 3) == {"reminder_interval_minutes": 3}
+
+
+@pytest.mark.asyncio
+async def test_timezone_change_regenerates_untouched_future_doses():
+    await init_db()
+    from app.services.medicine_service import add_medicine
+
+    today = now_local(settings.timezone, DATE_FMT)
+    await add_medicine(12345, "TestMed", "", ["00:00", "23:59"], generate_for=today)
+    assert await get_user_timezone(12345) == settings.timezone
+    db = await get_db()
+    try:
+        # One future dose has already been reminded and must keep its instant
+        cursor = await db.execute(
+            "SELECT id, scheduled_at FROM doses WHERE scheduled_at > ? ORDER BY scheduled_at LIMIT 1",
+            (int(time.time()),),
+        )
+        kept_id, kept_at = await cursor.fetchone()
+        await db.execute("UPDATE doses SET reminder_count = 1 WHERE id = ?", (kept_id,))
+        await db.commit()
+    finally:
+        await db.close()
+
+    assert await set_user_timezone(12345, "Asia/Tokyo") is True
+    assert await set_user_timezone(99999, "Asia/Tokyo") is False
+    assert await get_user_timezone(12345) == "Asia/Tokyo"
+
+    db = await get_db()
+    try:
+        cursor = await db.execute(
+            """
+            SELECT id, dose_date, scheduled_datetime, scheduled_at, day_end_at FROM doses
+            WHERE scheduled_at > ? AND id != ?
+            """,
+            (int(time.time()), kept_id),
+        )
+        rows = await cursor.fetchall()
+        cursor = await db.execute("SELECT scheduled_at FROM doses WHERE id = ?", (kept_id,))
+        assert (await cursor.fetchone())[0] == kept_at
+    finally:
+        await db.close()
+
+    assert rows
+    for _, dose_date, scheduled, scheduled_at, day_end_at in rows:
+        next_day = datetime.strptime(dose_date, DATE_FMT) + timedelta(days=1)
+        assert scheduled_at == local_to_epoch(scheduled, "Asia/Tokyo")
+        assert day_end_at == local_to_epoch(f"{next_day:%Y-%m-%d} 00:00", "Asia/Tokyo")